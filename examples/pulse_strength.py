@@ -8,7 +8,6 @@ from demo import load_image
 from viewer import BaseViewer
 
 import lulu
-import lulu.connected_region_handler as crh
 
 from traits.api import HasTraits, Instance, Array, Int, Range, \
                                  on_trait_change, Dict, Bool, Button, \
@@ -38,10 +37,8 @@ class StrengthViewer(BaseViewer):
     def __init__(self, **kwargs):
         HasTraits.__init__(self, **kwargs)
 
-        self.pulse_strength = np.zeros_like(self.image)
-        for area in self.pulses:
-            for cr in self.pulses[area]:
-                crh.set_array(self.pulse_strength, cr, 1, 'add')
+        self.pulse_strength = lulu.feature_maps(self.pulses, self.image.shape,
+                                                maps=['count'])['count']
 
         self.result = self.pulse_strength.copy()
 
@@ -28,8 +28,7 @@ for area in sorted(regions.keys()):
     centre = height + height_diff / 2.0
 
     pulse_values = np.zeros_like(img)
-    for p in pulses:
-        crh.set_array(pulse_values, p, crh.get_value(p))
+    crh.paint(pulse_values, pulses)
 
     y, x = np.where(pulse_values)
     s = pulse_values[y, x]
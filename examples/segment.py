@@ -11,18 +11,14 @@ from scipy.cluster.vq import kmeans2
 import matplotlib.pyplot as plt
 
 import lulu
-import lulu.connected_region_handler as crh
 
 img = load_image('truck_and_apcs_small.jpg')
 
 pulses = lulu.decompose(img)
 
-impulse_strength = np.zeros(img.shape, dtype=int)
-for area in pulses:
-    if area > min_area:
-        for cr in pulses[area]:
-            crh.set_array(impulse_strength, cr,
-                          np.abs(crh.get_value(cr)), 'add')
+impulse_strength = lulu.feature_maps(pulses, img.shape, maps=['strength'],
+                                     area_range=(min_area + 1, None))
+impulse_strength = impulse_strength['strength']
 
 def ICM(data, N, beta):
     print("Performing ICM segmentation...")
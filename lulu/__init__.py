@@ -1,5 +1,8 @@
 from lulu.base import *
 from lulu.connected_region import *
+from lulu.pulse_table import *
+from lulu.parallel import *
+from lulu.dpt1d import *
 import lulu.connected_region_handler
 
 import os.path as _path
@@ -0,0 +1,9 @@
+from int_array cimport IntArray
+
+cdef class AreaQueue:
+    cdef IntArray heap
+
+cpdef push(AreaQueue q, int area)
+cpdef int pop(AreaQueue q) except? -1
+cpdef int peek(AreaQueue q) except? -1
+cpdef int empty(AreaQueue q)
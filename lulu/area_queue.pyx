@@ -0,0 +1,94 @@
+#cython: cdivision=True
+# -*- python -*-
+"""
+A monotone priority queue of region areas, used by the decomposition to
+visit only those areas at which regions occur.
+
+The queue is a binary min-heap stored in an IntArray.  Pushing an area
+that is already queued is harmless, since `pop` discards duplicates.
+
+"""
+
+cimport int_array as iarr
+from int_array cimport IntArray
+
+cdef class AreaQueue:
+    """See area_queue.pxd for members.
+
+    """
+    def __cinit__(self):
+        self.heap = IntArray()
+
+cpdef push(AreaQueue q, int area):
+    """Add an area to the queue.
+
+    """
+    cdef int* h
+    cdef int i, parent
+
+    iarr.append(q.heap, area)
+    h = q.heap.buf
+
+    # Sift up
+    i = q.heap.size - 1
+    while i > 0:
+        parent = (i - 1) / 2
+        if h[parent] <= area:
+            break
+        h[i] = h[parent]
+        i = parent
+
+    h[i] = area
+
+cdef _pop_top(AreaQueue q):
+    """Remove the smallest element from the heap.
+
+    """
+    cdef int* h = q.heap.buf
+    cdef int n = q.heap.size - 1
+    cdef int last = h[n]
+    cdef int i = 0, child
+
+    q.heap.size = n
+
+    # Sift down
+    while True:
+        child = 2 * i + 1
+        if child >= n:
+            break
+        if child + 1 < n and h[child + 1] < h[child]:
+            child += 1
+        if h[child] >= last:
+            break
+        h[i] = h[child]
+        i = child
+
+    if n > 0:
+        h[i] = last
+
+cpdef int pop(AreaQueue q) except? -1:
+    """Remove and return the smallest area in the queue.
+
+    Duplicate entries of the returned area are discarded.
+
+    """
+    if q.heap.size == 0:
+        raise IndexError("Pop from empty area queue.")
+
+    cdef int area = q.heap.buf[0]
+    while q.heap.size > 0 and q.heap.buf[0] == area:
+        _pop_top(q)
+
+    return area
+
+cpdef int peek(AreaQueue q) except? -1:
+    """Return the smallest area in the queue without removing it.
+
+    """
+    if q.heap.size == 0:
+        raise IndexError("Peek into empty area queue.")
+
+    return q.heap.buf[0]
+
+cpdef int empty(AreaQueue q):
+    return q.heap.size == 0
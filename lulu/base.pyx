@@ -1,34 +1,49 @@
 #cython: cdivision=True
 # -*- python -*-
 
-__all__ = ['connected_regions', 'decompose', 'reconstruct']
+__all__ = ['connected_regions', 'decompose', 'iter_decompose', 'reconstruct',
+           'ReconstructionCache', 'feature_maps', 'BoundaryCache']
 
 import numpy as np
 
 cimport numpy as np
 
 import cython
+import gc
 import sys
 
-from lulu.ccomp import label
-from lulu.connected_region cimport ConnectedRegion
+from lulu.ccomp import label_runs
+from lulu.connected_region cimport ConnectedRegion, _rowptr, _colptr, \
+     set_runs
 
 cimport lulu.connected_region_handler as crh
 cimport int_array as iarr
 cimport libc.stdlib as stdlib
+from libc.limits cimport INT_MIN, INT_MAX
 from int_array cimport IntArray
-
-def connected_regions(np.ndarray[np.int_t, ndim=2] img):
+cimport area_queue as aq
+from area_queue cimport AreaQueue
+cimport pulse_table as pt
+from pulse_table cimport PulseTableBuilder, PulseStats
+from lulu.pulse_table import PulseTable, _feature_maps, _rows_shape, \
+                              _row_index
+import lulu.kernel as kernel
+
+def connected_regions(img, int threads=1):
     """Return ConnectedRegions that, together, compose the whole image.
 
     Parameters
     ----------
     img : ndarray
-        Input image.
+        Input image, of a type supported by `lulu.ccomp.label`.  Region
+        values are stored as ints.
+    threads : int
+        Number of threads used for labelling.  See
+        `lulu.ccomp.label_runs`.
 
     Returns
     -------
-    labels : ndarray
+    labels : ndarray of int32
         `img`, labeled by connectivity.
     c : dict
         Dictionary of ConnectedRegions, indexed by label value.
@@ -37,157 +52,454 @@ def connected_regions(np.ndarray[np.int_t, ndim=2] img):
     cdef int rows = img.shape[0]
     cdef int columns = img.shape[1]
 
-    cdef ConnectedRegion cr, cur_region
-
     # perform initial labeling
-    cdef np.ndarray[np.int_t, ndim=2] labels = label(img)
-
+    labels, runs = label_runs(img, threads)
+    n_labels = runs[:, 3].max() + 1 if len(runs) else 0
+
+    # Runs of each region, in raster order
+    runs = runs[np.argsort(runs[:, 3], kind='mergesort')]
+    row, start, end, run_label = runs.T
+
+    cdef np.ndarray[np.int32_t, ndim=1] run_ptr = \
+         np.zeros(n_labels + 1, dtype=np.int32)
+    np.cumsum(np.bincount(run_label, minlength=n_labels),
+              out=run_ptr[1:])
+
+    first = run_ptr[:-1]
+    cdef np.ndarray[np.int32_t, ndim=1] start_row = row[first]
+    n_rows = row[run_ptr[1:] - 1] - start_row + 1
+    cdef np.ndarray[np.int_t, ndim=1] values = \
+         np.ascontiguousarray(img)[start_row, start[first]].astype(np.int_)
+    cdef np.ndarray[np.int64_t, ndim=1] area = \
+         np.bincount(run_label, weights=end - start,
+                     minlength=n_labels).astype(np.int64)
+
+    # Row pointers of all regions, one after the other: rowptr[k] counts
+    # the column pointers of the rows before row k of a region
+    cdef np.ndarray[np.int32_t, ndim=1] row_base = \
+         np.zeros(n_labels + 1, dtype=np.int32)
+    np.cumsum(n_rows + 1, out=row_base[1:])
+
+    slot = row_base[run_label] + (row - start_row[run_label]) + 1
+    counts = np.cumsum(np.bincount(slot, minlength=row_base[n_labels]))
+    cdef np.ndarray[np.int32_t, ndim=1] rowptr = \
+         (2 * (counts - np.repeat(run_ptr[:-1], n_rows + 1))).astype(np.int32)
+    cdef np.ndarray[np.int32_t, ndim=1] colptr = \
+         np.ascontiguousarray(runs[:, 1:3]).ravel()
+
+    cdef int* rp = <int*>rowptr.data
+    cdef int* cp = <int*>colptr.data
     cdef dict regions = {}
+    cdef ConnectedRegion cr
+    cdef int i
+
+    # Regions do not refer to one another, so there is nothing for the
+    # cyclic garbage collector to find while creating them
+    gc_enabled = gc.isenabled()
+    gc.disable()
+
+    shape = (rows, columns)
+    try:
+        for i in range(n_labels):
+            cr = ConnectedRegion(shape=shape, value=values[i],
+                                 start_row=start_row[i])
+            set_runs(cr, rp + row_base[i], row_base[i + 1] - row_base[i],
+                     cp + 2 * run_ptr[i], 2 * (run_ptr[i + 1] - run_ptr[i]))
+            cr._nnz = area[i]
+            regions[i] = cr
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    return labels, regions
 
-    # create the first level components
-    cdef int r = 0, c = 0, connect_from, prev_label = 0, cur_label = 0
+# The labels image is never updated after the initial labelling.  Instead,
+# a union-find forest maps each initial (leaf) label to the label of the
+# region that currently owns it.
 
-    for r in range(rows):
-        connect_from = 0
+cdef inline int _find(int* forest, int n):
+    """Find the label of the region that owns leaf label n.
 
-        for c in range(1, columns + 1):
-            prev_label = labels[r, c - 1]
+    Uses path halving, so that repeated lookups stay cheap.
 
-            if c < columns:
-                cur_label = labels[r, c]
-            else:
-                cur_label = prev_label
+    """
+    while forest[n] != n:
+        forest[n] = forest[forest[n]]
+        n = forest[n]
+    return n
+
+cdef class RegionGraph:
+    """Region adjacency graph, used by the 'rag' engine of `decompose`.
+
+    Attributes
+    ----------
+    neighbours : list of IntArray
+        For each label, the labels of neighbouring regions.  After
+        merging, these may refer to absorbed regions or contain
+        duplicates; see `_neighbours`.
+    values : int*
+        Value of each region, indexed by label.
+    mark : int*
+        For each label, the value of `stamp` when it was last seen by
+        `_neighbours`.  Used to remove duplicate neighbours.
 
-            # Different region or end of row reached
-            if prev_label != cur_label or c == columns:
+    """
+    cdef list neighbours
+    cdef int* values
+    cdef int* mark
+    cdef int stamp
 
-                # New region?
-                if prev_label > len(regions) - 1:
-                    regions[prev_label] = ConnectedRegion(
-                        shape=(rows, columns),
-                        value=img[r, connect_from],
-                        start_row=r,
-                        rowptr=[0])
+    def __dealloc__(self):
+        stdlib.free(self.values)
+        stdlib.free(self.mark)
 
-                cur_region = regions[prev_label]
+cdef RegionGraph _region_graph(np.ndarray[np.int32_t, ndim=2] labels,
+                               dict regions):
+    """Build the region adjacency graph of an 8-connected labelling.
 
-                # New row?
-                if crh._current_row(cur_region) != r:
-                    crh._new_row(cur_region)
+    """
+    cdef int n_labels = len(regions)
+    cdef RegionGraph g = RegionGraph()
+    cdef ConnectedRegion cr
+    cdef IntArray nb
+    cdef int i, j, k
 
-                # Add connected region
-                iarr.append(cur_region.colptr, connect_from)
-                iarr.append(cur_region.colptr, c)
+    pairs = []
+    for a, b in ((labels[:, :-1], labels[:, 1:]),
+                 (labels[:-1, :], labels[1:, :]),
+                 (labels[:-1, :-1], labels[1:, 1:]),
+                 (labels[:-1, 1:], labels[1:, :-1])):
+        edge = (a != b)
+        a = a[edge].astype(np.int64)
+        b = b[edge].astype(np.int64)
+        pairs.append(np.minimum(a, b) * n_labels + np.maximum(a, b))
 
-                connect_from = c
+    cdef np.ndarray[np.int64_t, ndim=1] keys = \
+         np.unique(np.concatenate(pairs))
 
-    # finalise rows
-    for cr in regions.itervalues():
-        crh._new_row(cr)
-        cr._nnz = crh.nnz(cr)
+    g.neighbours = [IntArray() for i in range(n_labels)]
+    g.values = <int*>stdlib.malloc(sizeof(int) * n_labels)
+    g.mark = <int*>stdlib.malloc(sizeof(int) * n_labels)
 
-    return labels, regions
+    for i in range(n_labels):
+        cr = regions[i]
+        g.values[i] = cr._value
+        g.mark[i] = -1
+
+    for k in range(keys.shape[0]):
+        i = keys[k] // n_labels
+        j = keys[k] % n_labels
+        iarr.append(<IntArray>g.neighbours[i], j)
+        iarr.append(<IntArray>g.neighbours[j], i)
+
+    return g
+
+cdef IntArray _neighbours(RegionGraph g, int* forest, int label):
+    """Return the labels of the regions neighbouring region `label`.
+
+    Neighbours that have since been merged are resolved through
+    `forest`, and duplicates are removed, in place.
 
-cdef _merge_all(dict merges, dict regions, int area, dict regions_by_area,
-                np.int_t* labels, int rows, int cols):
     """
-    Merge all regions that have connections on their boundaries.
+    cdef IntArray nb = g.neighbours[label]
+    cdef int i, root, n = 0
+
+    g.stamp += 1
+    g.mark[label] = g.stamp
+    for i in range(nb.size):
+        root = _find(forest, nb.buf[i])
+        if g.mark[root] != g.stamp:
+            g.mark[root] = g.stamp
+            nb.buf[n] = root
+            n += 1
+
+    nb.size = n
+    return nb
+
+cdef _join_neighbours(RegionGraph g, int a, int b):
+    """Merge the neighbours of region b into those of region a.
 
     """
-    cdef ConnectedRegion cr_a, cr_b
-    cdef int idx0, idx1, a_label, b_label
+    cdef IntArray nb_a = g.neighbours[a]
+    cdef IntArray nb_b = g.neighbours[b]
 
-    for idx0 in merges:
-        a_label = labels[idx0]
-        cr_a = regions[a_label]
+    # Keep the larger array, so that less is copied
+    if nb_b.size > nb_a.size:
+        nb_a, nb_b = nb_b, nb_a
+        g.neighbours[a] = nb_a
 
-        for idx1 in merges[idx0]:
-            b_label = labels[idx1]
-            cr_b = regions[b_label]
+    iarr.extend(nb_a, nb_b.buf, nb_b.size)
+    g.neighbours[b] = None
+
+cdef class BoundaryCache:
+    """Outside boundaries of regions, kept between area levels by the
+    'pixel' engine.
+
+    Pass an instance to `decompose` or `iter_decompose`, as
+    `boundary_cache`, to inspect its memory use afterwards.  The
+    boundaries themselves are released when the decomposition ends.
+
+    Parameters
+    ----------
+    limit : int
+        Maximum memory, in bytes, held by the cached boundaries.
+
+    Attributes
+    ----------
+    limit : int
+        See above.
+    peak : int
+        Largest memory, in bytes, held at any time by the cache, over
+        all decompositions that used it.
+
+    Examples
+    --------
+    >>> cache = BoundaryCache(16 * 1024 * 1024)
+    >>> pulses = decompose(img, engine='pixel', boundary_cache=cache)
+    >>> cache.peak
+
+    """
+    # Boundary parts (see crh._fold_boundary), indexed by region label
+    cdef dict parts
+
+    # Memory, in bytes, held by the parts
+    cdef long used
+    cdef readonly long peak
+    cdef readonly long limit
+
+    def __init__(self, long limit=64 * 1024 * 1024):
+        self.parts = {}
+        self.used = 0
+        self.peak = 0
+        self.limit = limit
+
+cdef bint _cache_boundary(BoundaryCache cache, int label, list parts):
+    """Keep the boundary parts of a region, if the cache has room.
 
-            # Always merge a region with a larger index into a
-            # region with a smaller index.  This results in an ordered
-            # connected component labelling.
-            if b_label < a_label:
-                cr_a, cr_b = cr_b, cr_a
-                a_label, b_label = b_label, a_label
+    """
+    cdef long n = crh._boundary_nbytes(parts)
+
+    if cache.used + n > cache.limit:
+        return False
+
+    cache.parts[label] = parts
+    cache.used += n
+    if cache.used > cache.peak:
+        cache.peak = cache.used
+
+    return True
+
+cdef _clear_boundaries(BoundaryCache cache):
+    cache.parts.clear()
+    cache.used = 0
+
+cdef _merge_all(dict merges, dict regions, int area, dict regions_by_area,
+                AreaQueue queue, int* forest, BoundaryCache cache,
+                RegionGraph graph):
+    """
+    Merge all regions that have connections on their boundaries.
+
+    Each region is merged with all the regions it touches at once:
+    the smaller regions are merged into the largest one, whose label
+    becomes the owner of all of them in `forest`.
 
-            # Regions have alreay been merged
+    Areas that become occupied as a result of merging are scheduled
+    on `queue`.  The cached boundary of the merged region is kept
+    only if all regions had one.  If a `graph` is given, the
+    neighbours of the regions are joined.
+
+    """
+    cdef ConnectedRegion cr_a, cr_b
+    cdef int a_label, b_label, label0, label1
+    cdef set group
+    cdef list others, parts_a, parts_b
+
+    for label0 in merges:
+        group = set([_find(forest, label0)])
+        for label1 in merges[label0]:
+            group.add(_find(forest, label1))
+
+        # Regions have already been merged
+        if len(group) == 1:
+            continue
+
+        # Largest region first, ties broken by label for
+        # reproducibility
+        a_label = -1
+        for b_label in sorted(group):
+            cr_b = regions[b_label]
+            if a_label == -1 or cr_b._nnz > cr_a._nnz:
+                cr_a = cr_b
+                a_label = b_label
+
+        if cr_a._nnz >= area:
+            (<set>regions_by_area[cr_a._nnz]).remove(cr_a)
+        parts_a = cache.parts.pop(a_label, None)
+        cache.used -= crh._boundary_nbytes(parts_a)
+
+        # Merge; update regions, forest
+        # Image has already been updated in identify_pulses_and_merges
+        others = []
+        for b_label in sorted(group):
             if b_label == a_label:
                 continue
 
-            # Merge; update regions, labels
-            # Image has already been updated in identify_pulses_and_merges
-            del regions[b_label]
-            crh._set_array(labels, rows, cols, cr_b, a_label)
+            cr_b = regions.pop(b_label)
+            forest[b_label] = a_label
+            others.append(cr_b)
 
             # If we merge a larger region with a smaller region,
             # we have to update the regions_by_area, since that
             # area will still be visited.
-
             if cr_b._nnz >= area:
                 (<set>regions_by_area[cr_b._nnz]).remove(cr_b)
-            if cr_a._nnz >= area:
-                (<set>regions_by_area[cr_a._nnz]).remove(cr_a)
 
-            # Update labels of cr_b
-            crh.merge(cr_a, cr_b) # merge b into a
+            # The boundary of the union follows from those of the parts
+            parts_b = cache.parts.pop(b_label, None)
+            cache.used -= crh._boundary_nbytes(parts_b)
+            if parts_a is not None and parts_b is not None:
+                parts_a.extend(parts_b)
+            else:
+                parts_a = None
+
+            if graph is not None:
+                _join_neighbours(graph, a_label, b_label)
+
+        crh.merge_many(cr_a, others)
+
+        if parts_a is not None:
+            _cache_boundary(cache, a_label, parts_a)
+
+        try:
+            (<set>regions_by_area[cr_a._nnz]).add(cr_a)
+        except KeyError:
+            regions_by_area[cr_a._nnz] = set([cr_a])
+            aq.push(queue, cr_a._nnz)
 
-            try:
-                (<set>regions_by_area[cr_a._nnz]).add(cr_a)
-            except KeyError:
-                regions_by_area[cr_a._nnz] = set([cr_a])
+cdef _save_pulse(pulses, ConnectedRegion cr, int area, int height,
+                 bint to_table):
+    """Add a copy of cr, with the given height, to pulses.
 
-cdef dict _identify_pulses_and_merges(set regions, int area, dict pulses,
-                                      np.int_t* img_data, np.int_t* labels,
-                                      int rows, int cols, int* workspace,
-                                      int mode=0):
+    """
+    cdef ConnectedRegion cr_save
+
+    if to_table:
+        pt.append(pulses, cr, area, height)
+    else:
+        cr_save = crh.copy(cr)
+        cr_save._value = height
+        (<list>pulses[area]).append(cr_save)
+
+cdef dict _identify_pulses_and_merges(set regions, int area, pulses,
+                                      np.int_t* img_data, int* labels,
+                                      int* forest, int rows, int cols,
+                                      int* workspace, BoundaryCache cache,
+                                      RegionGraph graph, int mode=0,
+                                      keep=None, PulseStats stats=None):
     """Save pulses of this area, and return regions that need to be merged.
 
     Parameters
     ----------
+    pulses : dict or PulseTableBuilder
+        Pulses are added to this dictionary, indexed by area, or to
+        this table.
+    cache : BoundaryCache
+        Outside boundaries of regions are kept while `cache` has room.
+    graph : RegionGraph
+        If given, the values and merge candidates around a region are
+        looked up in the graph, rather than on its outside boundary.
     mode : int
         0 - U (upper), raise minima
         1 - L (lower), lower maxima
         2 - B (both), do both
+    keep : callable, optional
+        ``keep(area, height)``; pulses for which this returns False are
+        not saved.
+    stats : PulseStats, optional
+        Every pulse found, whether saved or not, is added to `stats`.
 
     Returns
     -------
     merges : dict
-        {idx: [cr0_idx, cr1_idx, ...]}
+        {label: set([label0, label1, ...])}
 
-        idx is the index (row*max_cols + col) of the current region
-        cr0, cr1, ... are the indices of the connected_regions with which it
-                      must be merged
+        label is the label of the current region
+        label0, label1, ... are the labels of the regions with which it
+                            must be merged
 
     """
-    cdef ConnectedRegion cr, cr_save
+    cdef ConnectedRegion cr, boundary
 
     cdef int b_max
     cdef int b_min
     cdef int old_value
 
     cdef dict merges = {}
-    cdef list merge_indices = []
-    cdef IntArray y, x
-    cdef int i, idx0, idx1
-    cdef int xi, yi
+    cdef set merge_labels
+    cdef list parts
+    cdef int i, k, r, idx0, row_start, start, end, label
+    cdef IntArray neighbours
     cdef bint do_merge
 
-    if area not in pulses:
+    cdef bint to_table = isinstance(pulses, PulseTableBuilder)
+
+    if not to_table and area not in pulses:
         pulses[area] = []
 
     for cr in regions:
-        idx0 = cr._start_row * cols + cr.colptr.buf[0]
+        idx0 = cr._start_row * cols + _colptr(cr)[0]
         old_value = cr._value
         do_merge = False
 
-        y, x = crh._outside_boundary(cr, workspace)
+        label = _find(forest, labels[idx0])
+
+        # The region that covers the whole image has no neighbours, and
+        # is saved as a single pulse, in the upper pass.  As with every
+        # other pulse, it is only saved if it has a non-zero height.
+        if cr._nnz == rows * cols:
+            if mode == 0 and old_value != 0:
+                if stats is not None:
+                    pt.add_pulse(stats, area, old_value)
+                if keep is None or keep(area, old_value):
+                    _save_pulse(pulses, cr, area, old_value, to_table)
+            if mode == 0:
+                cr._value = 0
+                crh._set_array(img_data, rows, cols, cr, 0)
+                if graph is not None:
+                    graph.values[label] = 0
+            continue
+
+        if graph is not None:
+            neighbours = _neighbours(graph, forest, label)
+
+            b_min = INT_MAX
+            b_max = INT_MIN
+            for i in range(neighbours.size):
+                k = graph.values[neighbours.buf[i]]
+                if k < b_min:
+                    b_min = k
+                if k > b_max:
+                    b_max = k
+
+        else:
+            parts = cache.parts.get(label)
+            if parts is None:
+                boundary = crh._boundary_runs(cr, workspace)
+                parts = [boundary]
+            else:
+                cache.used -= crh._boundary_nbytes(parts)
+                boundary = crh._fold_boundary(cr, parts)
+
+            if not _cache_boundary(cache, label, parts):
+                cache.parts.pop(label, None)
+
+            if mode == 0 or mode == 2:
+                b_min = crh._boundary_minimum(boundary, img_data, rows, cols)
+            if mode == 1 or mode == 2:
+                b_max = crh._boundary_maximum(boundary, img_data, rows, cols)
 
         # Upper
         if mode == 0 or mode == 2:
-            b_min = crh._boundary_minimum(x, y, img_data, rows, cols)
-
             # Minimal set
             if b_min > old_value: # Note that this needs to be strictly
                                   # greater than.  It may happen that,
@@ -198,8 +510,6 @@ cdef dict _identify_pulses_and_merges(set regions, int area, dict pulses,
 
         # Lower
         if mode == 1 or mode == 2:
-            b_max = crh._boundary_maximum(x, y, img_data, rows, cols)
-
             # Maximal set
             if b_max < old_value:
                 cr._value = b_max
@@ -207,106 +517,309 @@ cdef dict _identify_pulses_and_merges(set regions, int area, dict pulses,
 
         # Minimal or maximal region detected
         if do_merge:
-            # This should occur exactly once: on the last
-            # pulse that covers the whole image
-            if cr._value == -1:
-                cr._value = 0
-
             # By setting the region value here, we prevent neighbouring
             # regions from picking it up in consequent iterations of this
             # loop
             crh._set_array(img_data, rows, cols, cr, cr._value)
-            merge_indices = []
+            merge_labels = set()
+
+            if stats is not None:
+                pt.add_pulse(stats, area, old_value - cr._value)
+            if keep is None or keep(area, old_value - cr._value):
+                _save_pulse(pulses, cr, area, old_value - cr._value,
+                            to_table)
 
-            cr_save = crh.copy(cr)
-            cr_save._value = old_value - cr._value # == pulse height
-            (<list>pulses[area]).append(cr_save)
+            if graph is not None:
+                graph.values[label] = cr._value
 
-            for i in range(x.size):
-                xi = x.buf[i]
-                yi = y.buf[i]
+                for i in range(neighbours.size):
+                    if graph.values[neighbours.buf[i]] == cr._value:
+                        merge_labels.add(neighbours.buf[i])
 
-                if (xi < 0) or (xi >= cols) or (yi < 0) or (yi >= rows):
-                    # Position outside boundary
+                merges[label] = merge_labels
+                continue
+
+            for r in range(boundary._n_rowptr - 1):
+                if (r + boundary._start_row < 0) or \
+                   (r + boundary._start_row >= rows):
+                    # Row outside image
                     continue
 
-                idx1 = yi * cols + xi
+                row_start = (r + boundary._start_row) * cols
+
+                for i in range(_rowptr(boundary)[r],
+                               _rowptr(boundary)[r + 1], 2):
+                    start = crh.max2(_colptr(boundary)[i], 0)
+                    end = crh.min2(_colptr(boundary)[i + 1], cols)
 
-                if img_data[idx1] == cr._value:
-                    merge_indices.append(idx1)
+                    for k in range(row_start + start, row_start + end):
+                        if img_data[k] == cr._value:
+                            merge_labels.add(_find(forest, labels[k]))
 
-            merges[idx0] = merge_indices
+            merges[label] = merge_labels
 
-    if len(pulses[area]) == 0:
+    if not to_table and len(pulses[area]) == 0:
         del pulses[area]
 
     return merges
 
-def decompose(np.ndarray[np.int_t, ndim=2] img, quiet=False, operator='LU'):
-    """Decompose a two-dimensional signal into pulses.
+cdef class _Decomposition:
+    """State of a decomposition, advanced one area level at a time by
+    `_decompose_level`.
+
+    """
+    cdef np.ndarray img, labels
+    cdef dict regions, regions_by_area
+    cdef np.int_t* img_data
+    cdef int* labels_data
+    cdef int rows, cols
+    cdef int* workspace
+    cdef int* forest
+    cdef RegionGraph graph
+    cdef BoundaryCache cache
+    cdef AreaQueue queue
+    cdef bint order
+
+    # Whether the int_array pool is held (see iarr.acquire_pool)
+    cdef bint holds_pool
+
+    def __dealloc__(self):
+        stdlib.free(self.workspace)
+        stdlib.free(self.forest)
+
+        # The buffers of the regions are freed along with them
+        if self.cache is not None:
+            _clear_boundaries(self.cache)
+        if self.holds_pool:
+            iarr.release_pool()
+
+def _int_image(img):
+    """Return `img` as a C-contiguous array of np.int_, as used by the
+    'pixel' and 'rag' engines.
+
+    """
+    if img.dtype.kind == 'f':
+        raise ValueError("Float images require engine='nogil'.")
+
+    return np.ascontiguousarray(img, dtype=np.int_)
+
+cdef _Decomposition _start_decomposition(np.ndarray[np.int_t, ndim=2] img,
+                                         operator, boundary_cache,
+                                         engine, int threads):
+    """Label the image and set up the state of a decomposition.
+
+    See `decompose` for a description of the parameters.
+
+    """
+    if engine not in ('pixel', 'rag'):
+        raise ValueError("Unknown engine '%s'." % engine)
+
+    cdef _Decomposition d = _Decomposition()
+    cdef ConnectedRegion cr
+    cdef int i, n_labels
+
+    # Regions created and merged reuse buffers until d is freed
+    iarr.acquire_pool()
+    d.holds_pool = True
+
+    d.img = img.copy()
+    d.img_data = <np.int_t*>d.img.data
+    d.rows = img.shape[0]
+    d.cols = img.shape[1]
+    d.order = (operator == 'LU')
+
+    # labels (array): `img`, numbered according to connected region
+    # regions (dict): ConnectedRegions, indexed by label value.
+    d.labels, d.regions = connected_regions(d.img, threads)
+    d.labels_data = <int*>d.labels.data
+
+    d.workspace = <int*>stdlib.malloc(sizeof(int) * (d.cols + 2) * 3)
+
+    # Union-find forest over the initial labels; every region starts
+    # out owning only itself.
+    n_labels = len(d.regions)
+    d.forest = <int*>stdlib.malloc(sizeof(int) * n_labels)
+    for i in range(n_labels):
+        d.forest[i] = i
+
+    d.graph = None
+    if engine == 'rag':
+        d.graph = _region_graph(d.labels, d.regions)
+
+    if isinstance(boundary_cache, BoundaryCache):
+        d.cache = boundary_cache
+        _clear_boundaries(d.cache)
+    else:
+        d.cache = BoundaryCache(boundary_cache)
+
+    # Areas are visited in increasing order, but only those at which
+    # regions occur.  Merged regions are scheduled by _merge_all.
+    d.queue = AreaQueue()
+
+    d.regions_by_area = {}
+    for cr in d.regions.itervalues():
+        try:
+            d.regions_by_area[cr._nnz].add(cr)
+        except KeyError:
+            d.regions_by_area[cr._nnz] = set([cr])
+            aq.push(d.queue, cr._nnz)
+
+    return d
+
+cdef int _decompose_level(_Decomposition d, pulses, keep=None,
+                          PulseStats stats=None) except -1:
+    """Find all pulses at the next area level, and merge the regions
+    involved.  Returns the area of the level.
+
+    """
+    cdef int area = aq.pop(d.queue)
+    cdef set level = d.regions_by_area[area]
+    cdef int mode
+
+    # Upper (0) then lower (1), or vice versa
+    for mode in ((0, 1) if d.order else (1, 0)):
+        merges = \
+               _identify_pulses_and_merges(level, area,
+                                           pulses, d.img_data, d.labels_data,
+                                           d.forest, d.rows, d.cols,
+                                           d.workspace, d.cache, d.graph,
+                                           mode, keep, stats)
+
+        _merge_all(merges, d.regions, area, d.regions_by_area, d.queue,
+                   d.forest, d.cache, d.graph)
+
+    del d.regions_by_area[area]
+
+    return area
+
+def decompose(np.ndarray img, quiet=False, operator='LU',
+              boundary_cache=64 * 1024 * 1024, engine=None,
+              output='dict', int max_area=-1, return_residual=False,
+              connectivity=None, int threads=1, PulseStats stats=None):
+    """Decompose a two- or three-dimensional signal into pulses.
 
     Parameters
     ----------
-    img : 2-D ndarray of ints
-        Input signal.
+    img : 2-D or 3-D ndarray
+        Input signal.  The 'nogil' engine handles uint8, uint16, int32,
+        int64, float32 and float64 without conversion; other engines
+        convert integer images to int, and do not support floats.
+        Volumes and float images are only supported by the 'nogil'
+        engine, with 'table' output.
     quiet : bool
-        Whether or not to print progress.
+        Whether or not to print progress.  The 'nogil' engine never
+        prints progress.
     operator : {'LU', 'UL'}
         Order in which to apply the L and U operators.  By default, 'LU',
         i.e. first U then L.
+    boundary_cache : int or BoundaryCache
+        Maximum memory, in bytes, used by the 'pixel' engine to cache the
+        outside boundaries of regions between area levels, or a
+        BoundaryCache that records the peak usage.  With the 'pixel'
+        engine, the peak usage is also printed unless `quiet` is set.
+    engine : {'pixel', 'rag', 'nogil'}, optional
+        How the neighbours of a region are found.  'pixel' examines the
+        outside boundary of a region in the image.  'rag' builds a region
+        adjacency graph once, and joins neighbour sets as regions merge,
+        so that the work per region scales with the number of
+        neighbours rather than with the length of its boundary.
+        'nogil' does the same using only C data structures (see
+        `lulu.kernel`), and releases the GIL for the whole area loop,
+        so that threads can decompose images concurrently.  Its
+        ConnectedRegions all have the shape of the image.  By default,
+        'pixel' for 'dict' output, and 'nogil' for 'table' output.
+    output : {'dict', 'table'}
+        Format of the output.  A PulseTable stores all pulses in a few
+        contiguous arrays, and is much smaller than a dictionary of
+        ConnectedRegions.
+    max_area : int
+        If given, stop after extracting the pulses of area `max_area`.
+        By default, the decomposition continues up to the pulse that
+        covers the whole image.
+    return_residual : bool
+        Whether to return the residual image as well.
+    connectivity : {8} or {6, 18, 26}
+        Connectivity of regions.  Images are 8-connected; volumes are
+        26-connected by default.
+    threads : int
+        Number of threads used to label the connected regions.  See
+        `lulu.ccomp.label_runs`.
+    stats : PulseStats, optional
+        If given, per-area statistics of the pulses are added to it.
 
     Returns
     -------
-    pulses : dict
-        Dictionary of ConnectedRegion objects, indexed by pulse area.
+    pulses : dict or PulseTable
+        Dictionary of ConnectedRegion objects, indexed by pulse area,
+        or a PulseTable.
+    residual : ndarray
+        Only returned if `return_residual` is set.  The input, with all
+        extracted pulses removed.  For a partial decomposition, this is
+        the image smoothed by the LULU operators up to `max_area`, and
+        ``reconstruct(pulses, img.shape)[0] + residual == img``.
 
     See Also
     --------
-    reconstruct
+    iter_decompose, reconstruct
 
     """
-    img = img.copy()
+    if output not in ('dict', 'table'):
+        raise ValueError("Unknown output format '%s'." % output)
 
-    cdef np.ndarray[np.int_t, ndim=2] labels
-    cdef dict regions
+    if engine is None:
+        engine = 'nogil' if output == 'table' or img.ndim == 3 else 'pixel'
 
-    cdef ConnectedRegion cr
-    cdef int nz
+    if img.ndim == 3:
+        if engine != 'nogil' or output != 'table':
+            raise ValueError("Volumes require engine='nogil' and "
+                             "output='table'.")
+        if connectivity is None:
+            connectivity = 26
+    elif connectivity not in (None, 8):
+        raise ValueError("Images are 8-connected.")
 
-    cdef np.int_t* img_data = <np.int_t*>img.data
-    cdef int max_rows = img.shape[0]
-    cdef int max_cols = img.shape[1]
+    if img.dtype.kind == 'f' and output != 'table':
+        raise ValueError("Float images require output='table'.")
 
-    cdef bint order = (operator == 'LU')
+    if engine == 'nogil':
+        pulses, residual = kernel.decompose(img, operator == 'LU', max_area,
+                                            connectivity or 26,
+                                            threads=threads)
 
-    # labels (array): `img`, numbered according to connected region
-    # regions (dict): ConnectedRegions, indexed by label value.
-    labels, regions = connected_regions(img)
-    cdef np.int_t* labels_data = <np.int_t*>labels.data
+        if stats is not None:
+            stats.update(pulses)
 
-    cdef set merge_region_positions
-    cdef int* workspace = <int*>stdlib.malloc(sizeof(int) * (max_cols + 2) * 3)
+        if output == 'dict':
+            pulses = pulses.to_dict()
 
-    cdef dict pulses = {}
+        if return_residual:
+            return pulses, residual
 
-    cdef int old_value, levels, percentage_done, percentage
+        return pulses
 
-    cdef dict regions_by_area = {}
-    for cr in regions.itervalues():
-        try:
-            regions_by_area[cr._nnz].add(cr)
-        except KeyError:
-            regions_by_area[cr._nnz] = set([cr])
+    cdef _Decomposition d = _start_decomposition(_int_image(img), operator,
+                                                 boundary_cache, engine,
+                                                 threads)
 
-    if not quiet:
+    pulses = {}
+    if output == 'table':
+        pulses = PulseTableBuilder()
+
+    cdef int area, levels, percentage_done, percentage
+
+    levels = d.rows * d.cols + 1
 
-        levels = max_cols * max_rows + 1
+    if not quiet:
         percentage_done = 0
 
         print "[> 0%% %s ]" % (" "*50),
         sys.stdout.flush()
 
-    for area in range(levels):
+    while not aq.empty(d.queue):
+        if max_area >= 0 and aq.peek(d.queue) > max_area:
+            break
+
+        area = _decompose_level(d, pulses, None, stats)
 
         if not quiet:
             percentage = area*100/levels
@@ -315,76 +828,97 @@ def decompose(np.ndarray[np.int_t, ndim=2] img, quiet=False, operator='LU'):
                 sys.stdout.flush()
                 percentage_done = percentage
 
-        if (order == 1):
-            # Upper
-            if not area in regions_by_area:
-                continue
-
-            merges = \
-                   _identify_pulses_and_merges(regions_by_area[area], area,
-                                               pulses, img_data, labels_data,
-                                               max_rows, max_cols, workspace, 0)
-
-            _merge_all(merges, regions, area, regions_by_area,
-                       labels_data, max_rows, max_cols)
-
-            # Lower
-            if not area in regions_by_area:
-                continue
+    if not quiet:
+        print
+        if engine == 'pixel':
+            print "Boundary cache: %d kB peak, %d kB limit" % \
+                  (d.cache.peak / 1024, d.cache.limit / 1024)
 
-            merges = \
-                   _identify_pulses_and_merges(regions_by_area[area], area,
-                                               pulses, img_data, labels_data,
-                                               max_rows, max_cols, workspace, 1)
+    if output == 'table':
+        pulses = pt.finalise(pulses, (d.rows, d.cols))
 
-            _merge_all(merges, regions, area, regions_by_area,
-                       labels_data, max_rows, max_cols)
+    residual = d.img
 
-        else:
-            # Lower
-            if not area in regions_by_area:
-                continue
+    # Free the buffers of merged and discarded regions
+    d = None
 
-            merges = \
-                   _identify_pulses_and_merges(regions_by_area[area], area,
-                                               pulses, img_data, labels_data,
-                                               max_rows, max_cols, workspace, 1)
+    if return_residual:
+        return pulses, residual
 
-            _merge_all(merges, regions, area, regions_by_area,
-                       labels_data, max_rows, max_cols)
+    return pulses
 
-            # Upper
-            if not area in regions_by_area:
-                continue
+def iter_decompose(np.ndarray img, operator='LU',
+                   boundary_cache=64 * 1024 * 1024, engine='pixel',
+                   keep=None, int threads=1, PulseStats stats=None):
+    """Decompose a two-dimensional signal into pulses, one area at a time.
 
-            merges = \
-                   _identify_pulses_and_merges(regions_by_area[area], area,
-                                               pulses, img_data, labels_data,
-                                               max_rows, max_cols, workspace, 0)
+    Parameters
+    ----------
+    img : 2-D ndarray of ints
+        Input signal, converted to int.
+    operator, boundary_cache, threads
+        See `decompose`.
+    engine : {'pixel', 'rag'}
+        See `decompose`.  As there, 'pixel' is the default for
+        ConnectedRegions.
+    keep : callable, optional
+        ``keep(area, height)`` is called for every pulse found.  Pulses
+        for which it returns False are discarded without being copied.
+    stats : PulseStats, optional
+        If given, per-area statistics of all pulses found, kept or not,
+        are added to it.
+
+    Yields
+    ------
+    area : int
+        Area of the pulses.
+    pulses : list of ConnectedRegion
+        Pulses of this area, as soon as the area level is completed.
+        Levels without pulses are skipped, so that
+        ``dict(iter_decompose(img))`` equals ``decompose(img)``.
 
-            _merge_all(merges, regions, area, regions_by_area,
-                       labels_data, max_rows, max_cols)
+    See Also
+    --------
+    decompose
 
+    """
+    cdef _Decomposition d = _start_decomposition(_int_image(img), operator,
+                                                 boundary_cache, engine,
+                                                 threads)
+    cdef dict pulses = {}
+    cdef int area
 
-        del regions_by_area[area]
+    while not aq.empty(d.queue):
+        area = _decompose_level(d, pulses, keep, stats)
 
+        if area in pulses:
+            yield area, pulses.pop(area)
 
-    stdlib.free(workspace)
-    if not quiet: print
-    return pulses
+    d = None
 
-def reconstruct(dict regions, tuple shape, int min_area=-1, int max_area=-1):
+def reconstruct(regions, tuple shape, int min_area=-1, int max_area=-1,
+                min_height=None, max_height=None, out=None, dtype=None):
     """Reconstruct an image from the given connected regions / pulses.
 
     Parameters
     ----------
-    regions : dict
+    regions : dict or PulseTable
         Impulses indexed by area.  This is the output of `decompose`.
     shape : tuple
         Shape of the output image.
     min_area, max_area : int
         Impulses with areas in [min_area, max_area] are used for the
         reconstruction.
+    min_height, max_height : scalar, optional
+        If given, only impulses with heights in [min_height, max_height]
+        are used.
+    out : ndarray, optional
+        C-contiguous array in which to store the reconstruction.  Its
+        previous contents are overwritten.
+    dtype : dtype, optional
+        Data type of the reconstruction, one of uint8, int16, int32,
+        int64, float32 or float64.  Ignored if `out` is given.  Default
+        is int, or float64 for pulses with float heights.
 
     Returns
     -------
@@ -396,36 +930,318 @@ def reconstruct(dict regions, tuple shape, int min_area=-1, int max_area=-1):
         For each area in the above list, there are this many impulses.
 
     """
-    cdef ConnectedRegion cr
+    if not isinstance(regions, PulseTable):
+        # Only convert the areas that are painted
+        regions = PulseTable.from_dict(
+            dict((a, regions[a]) for a in regions
+                 if a >= min_area and (max_area == -1 or a <= max_area)),
+            shape)
+
+    if dtype is None:
+        dtype = float if regions.height.dtype.kind == 'f' else int
 
-    cdef np.ndarray[np.int_t, ndim=2] out = np.zeros(shape, dtype=int)
+    if out is None:
+        out = np.zeros(shape, dtype=dtype)
+    else:
+        out[...] = 0
 
     if max_area == -1:
-        max_area = out.shape[0] * out.shape[1] + 1
+        max_area = out.size + 1
 
     if min_area == -1:
         min_area = 0
 
-    cdef list areas = []
-    cdef list area_count = []
-    cdef int a
+    area = regions.area
+    height = regions.height
+
+    selected = (area >= min_area) & (area <= max_area)
+    if min_height is not None:
+        selected &= (height >= min_height)
+    if max_height is not None:
+        selected &= (height <= max_height)
+
+    regions.paint(out, selected)
+
+    # Sorted by area
+    areas, area_count = np.unique(area[selected], return_counts=True)
 
-    for a in regions:
-        if a >= min_area and a <= max_area:
-            areas.append(a)
-            area_count.append(0)
+    return out, areas, area_count
 
-            area_count[-1] += len(regions[a])
+# Maps computed by feature_maps
+FEATURE_MAPS = ('count', 'strength', 'scale', 'peak')
 
-            for cr in regions[a]:
-                crh._set_array(<np.int_t*>out.data, out.shape[0], out.shape[1],
-                               cr, cr._value, 1)
+def feature_maps(pulses, shape=None, maps=('count', 'strength', 'scale'),
+                 area_range=None):
+    """Compute per-pixel maps of the pulses, in one pass over their runs.
 
-    areas_arr, area_count_arr = np.array(areas), np.array(area_count)
+    Parameters
+    ----------
+    pulses : dict or PulseTable
+        Pulses, as returned by `decompose`.
+    shape : tuple, optional
+        Shape of the image.  Required if `pulses` is a dict.
+    maps : sequence of str
+        Maps to compute, any of:
+
+        - 'count' : number of pulses covering a pixel, i.e. the pulse
+          strength of ``examples/pulse_strength.py``
+        - 'strength' : sum of the absolute heights of those pulses
+        - 'scale' : area of the pulse with the largest absolute height
+          covering a pixel (the smallest such area on ties), or 0
+        - 'peak' : absolute height of that pulse
+    area_range : tuple of int, optional
+        Only pulses with areas in ``[min_area, max_area]`` are used.
+        Either end may be None.
+
+    Returns
+    -------
+    maps : dict of ndarray
+        The requested maps, by name.  'count' and 'scale' are int32;
+        'strength' and 'peak' are int64, or float64 for pulses with
+        float heights.
+
+    Examples
+    --------
+    >>> m = feature_maps(pulses, img.shape, maps=['strength', 'scale'],
+    ...                  area_range=(500, None))
+
+    """
+    for name in maps:
+        if name not in FEATURE_MAPS:
+            raise ValueError("Unknown map '%s'." % name)
+
+    if not isinstance(pulses, PulseTable):
+        pulses = PulseTable.from_dict(pulses, shape)
+    shape = pulses.shape
+
+    # Pulses are visited by increasing area, so that the smallest scale
+    # wins ties
+    if np.any(np.diff(pulses.area) < 0):
+        pulses = pulses.take(np.argsort(pulses.area, kind='mergesort'))
+
+    area = pulses.area
+    selected = np.ones(len(area), dtype=bool)
+    if area_range is not None:
+        min_area, max_area = area_range
+        if min_area is not None:
+            selected &= (area >= min_area)
+        if max_area is not None:
+            selected &= (area <= max_area)
+
+    rows, cols = _rows_shape(shape)
+    size = rows * cols
+
+    def buffer(names, dtype):
+        for name in names:
+            if name in maps:
+                return np.zeros(size, dtype=dtype)
+        return np.zeros(0, dtype=dtype)
+
+    out = {'count': buffer(['count'], np.int32),
+           'strength': buffer(['strength'], np.float64),
+           'peak': buffer(['scale', 'peak'], np.float64),
+           'scale': buffer(['scale', 'peak'], np.int32)}
+
+    _feature_maps(np.abs(pulses.height.astype(np.float64)),
+                  area.astype(np.int32), pulses.start_row,
+                  _row_index(pulses), pulses.offsets,
+                  pulses.rowptr, pulses.colptr,
+                  np.flatnonzero(selected).astype(np.intp), rows, cols,
+                  out['count'], out['strength'], out['peak'], out['scale'])
+
+    if pulses.height.dtype.kind != 'f':
+        out['strength'] = out['strength'].astype(np.int64)
+        out['peak'] = out['peak'].astype(np.int64)
+
+    return dict((name, out[name].reshape(shape)) for name in maps)
+
+class ReconstructionCache(object):
+    """Reconstruct an image from a band of pulses, and update it as the
+    band moves.
+
+    Pulses are sorted by area, so that the pulses in an area band are a
+    contiguous range of the table, and the reconstruction of
+    ``[min_area, max_area]`` is the difference of two prefix sums.  When
+    the band moves, only the pulses that enter or leave it are painted.
+    Prefix sums may be stored at checkpoint areas, after which a jump
+    costs a few operations on the whole image instead of painting the
+    pulses in between.
+
+    Parameters
+    ----------
+    pulses : dict or PulseTable
+        Pulses, as returned by `decompose`.
+    shape : tuple, optional
+        Shape of the image.  Required if `pulses` is a dict.
+    checkpoints : sequence of int, optional
+        Areas at which to store the sum of all pulses up to that area.
+        Each checkpoint holds an image, so choose a handful.
+    dtype : dtype, optional
+        Data type of the reconstruction.  Default is int, or float64 for
+        pulses with float heights.
+
+    Attributes
+    ----------
+    image : ndarray
+        Current reconstruction.  It is updated in place by `update`.
+
+    Examples
+    --------
+    >>> cache = ReconstructionCache(pulses, img.shape, checkpoints=[10, 100])
+    >>> out = cache.update(min_area=5, max_area=50)
+    >>> out = cache.update(min_area=5, max_area=60, min_height=10)
 
-    # Sort by area
-    ind = np.argsort(areas_arr)
-    areas_arr = areas_arr[ind]
-    area_count_arr = area_count_arr[ind]
+    """
+    def __init__(self, pulses, shape=None, checkpoints=None, dtype=None):
+        if not isinstance(pulses, PulseTable):
+            pulses = PulseTable.from_dict(pulses, shape)
+
+        if np.any(np.diff(pulses.area) < 0):
+            pulses = pulses.take(np.argsort(pulses.area, kind='mergesort'))
+
+        if dtype is None:
+            dtype = float if pulses.height.dtype.kind == 'f' else int
+
+        self.pulses = pulses
+        self._negated = PulseTable(pulses.shape, pulses.area, -pulses.height,
+                                   pulses.start_row, pulses.offsets,
+                                   pulses.rowptr, pulses.colptr,
+                                   pulses.row_index)
+        self.image = np.zeros(pulses.shape, dtype=dtype)
+
+        # Number of pixels painted by the pulses before index i
+        self._cost = np.zeros(len(pulses) + 1, dtype=np.int64)
+        np.cumsum(pulses.area, out=self._cost[1:])
+
+        # Current band: pulses [i0, i1), and height limits
+        self._band = (0, 0)
+        self._heights = (None, None)
+
+        # Prefix sums, by pulse index.  None stands for zeros.
+        self._prefix = {0: None}
+        last, prefix = 0, None
+        for area in sorted(checkpoints or []):
+            i = np.searchsorted(pulses.area, area, 'right')
+            if i == last:
+                continue
+
+            prefix = np.zeros_like(self.image) if prefix is None \
+                     else prefix.copy()
+            self._paint_range(prefix, last, i)
+            self._prefix[i] = prefix
+            last = i
+
+    def _paint_range(self, out, start, stop):
+        """Add the pulses in [start, stop) to out, or subtract those in
+        [stop, start).
+
+        """
+        if start < stop:
+            self.pulses.paint(out, np.arange(start, stop))
+        elif stop < start:
+            self._negated.paint(out, np.arange(stop, start))
+
+    def _nearest(self, i):
+        """Return the checkpoint that is cheapest to move to i from.
+
+        """
+        return min(self._prefix, key=lambda c: abs(self._cost[i] -
+                                                   self._cost[c]))
+
+    def _move(self, i0, i1):
+        """Move the area band to pulses [i0, i1).
+
+        """
+        j0, j1 = self._band
+        cost = self._cost
+
+        c0 = self._nearest(i0)
+        c1 = self._nearest(i1)
+
+        # Starting from the checkpoints costs a pass over the image
+        if 2 * self.image.size + abs(cost[i0] - cost[c0]) + \
+           abs(cost[i1] - cost[c1]) < \
+           abs(cost[i0] - cost[j0]) + abs(cost[i1] - cost[j1]):
+            if self._prefix[c1] is None:
+                self.image[...] = 0
+            else:
+                self.image[...] = self._prefix[c1]
+            if self._prefix[c0] is not None:
+                self.image -= self._prefix[c0]
+            j0, j1 = c0, c1
+
+        # The band is the sum of the pulses before i1, less those
+        # before i0
+        self._paint_range(self.image, j1, i1)
+        self._paint_range(self.image, i0, j0)
+
+        self._band = (i0, i1)
+
+    def _select(self, i0, i1, heights):
+        """Move to pulses [i0, i1) with heights in the given range, by
+        painting the pulses whose selection changes.
+
+        """
+        j0, j1 = self._band
+        lo = min(i0, j0)
+        hi = max(i1, j1)
+
+        index = np.arange(lo, hi)
+        height = self.pulses.height[lo:hi]
+
+        def selected(start, stop, limits):
+            mask = (index >= start) & (index < stop)
+            if limits[0] is not None:
+                mask &= (height >= limits[0])
+            if limits[1] is not None:
+                mask &= (height <= limits[1])
+            return mask
+
+        old = selected(j0, j1, self._heights)
+        new = selected(i0, i1, heights)
+
+        self.pulses.paint(self.image, index[new & ~old])
+        self._negated.paint(self.image, index[old & ~new])
+
+        self._band = (i0, i1)
+        self._heights = heights
+
+    def update(self, min_area=None, max_area=None, min_height=None,
+               max_height=None):
+        """Reconstruct the image from the pulses in the given band.
+
+        Parameters
+        ----------
+        min_area, max_area : int, optional
+            Pulses with areas in [min_area, max_area] are used.
+        min_height, max_height : scalar, optional
+            If given, only pulses with heights in [min_height,
+            max_height] are used.
+
+        Returns
+        -------
+        image : ndarray
+            The reconstruction, i.e. `self.image`.
+
+        See Also
+        --------
+        reconstruct
+
+        """
+        area = self.pulses.area
+
+        i0 = 0 if min_area is None else \
+             np.searchsorted(area, min_area, 'left')
+        i1 = len(area) if max_area is None else \
+             np.searchsorted(area, max_area, 'right')
+        i1 = max(i0, i1)
+
+        heights = (min_height, max_height)
+
+        # Checkpoints hold pulses of all heights
+        if heights == (None, None) and self._heights == (None, None):
+            self._move(i0, i1)
+        else:
+            self._select(i0, i1, heights)
 
-    return out, areas, area_count_arr
+        return self.image
@@ -1,6 +1,8 @@
 # -*- python -*-
 #cython: cdivision=True
 
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 cimport numpy as np
 
@@ -20,105 +22,427 @@ See also:
 
 """
 
-# Tree operations implemented by an array as described in Wu et al.
+# Image types that are labelled without conversion
+ctypedef fused image_t:
+    np.uint8_t
+    np.uint16_t
+    np.int32_t
+    np.int64_t
+    np.float32_t
+    np.float64_t
+
+# Connected components search as described in Fiorio et al., but on
+# runs of equal pixels rather than on single pixels.
 
-DTYPE = np.int
-ctypedef np.int_t DTYPE_t
+LABEL_DTYPE = np.int32
 
-cdef DTYPE_t find_root(np.int_t *work, np.int_t n):
-    """Find the root of node n.
+cdef inline int _run_root(int* parent, int n) nogil:
+    """Find the root of run n, halving the path.
 
     """
-    cdef np.int_t root = n
-    while (work[root] < root):
-        root = work[root]
-    return root
+    while parent[n] != n:
+        parent[n] = parent[parent[n]]
+        n = parent[n]
+    return n
+
+cdef inline void _join_runs(int* parent, int n, int m) nogil:
+    """Join the trees containing runs n and m.  The root is always the
+    first run of a component.
 
-cdef set_root(np.int_t *work, np.int_t n, np.int_t root):
     """
-    Set all nodes on a path to point to new_root.
+    n = _run_root(parent, n)
+    m = _run_root(parent, m)
+    if n < m:
+        parent[m] = n
+    elif m < n:
+        parent[n] = m
+
+cdef void _count_runs(image_t* d, int cols, int row0, int row1,
+                      int* counts) nogil:
+    """Count the runs on each of rows [row0, row1).
 
     """
-    cdef np.int_t j
-    while (work[n] < n):
-        j = work[n]
-        work[n] = root
-        n = j
+    cdef int i, j, n
 
-    work[n] = root
+    for i in range(row0, row1):
+        n = 0
+        for j in range(cols):
+            if j == 0 or d[i * cols + j] != d[i * cols + j - 1]:
+                n += 1
+        counts[i] = n
 
+cdef void _find_runs(image_t* d, int cols, int row0, int row1, int* r,
+                     int* rf) nogil:
+    """Store the row, start and end of the runs on rows [row0, row1).
 
-cdef join_trees(np.int_t *work, np.int_t n, np.int_t m):
-    """Join two trees containing nodes n and m.
+    """
+    cdef int i, j, k
+
+    for i in range(row0, row1):
+        k = rf[i] - 1
+        for j in range(cols):
+            if j == 0 or d[i * cols + j] != d[i * cols + j - 1]:
+                k += 1
+                r[4 * k] = i
+                r[4 * k + 1] = j
+            r[4 * k + 2] = j + 1
+
+cdef void _join_rows(image_t* d, int cols, int row0, int row1, int* r,
+                     int* rf, int* par, int* links, int n_links,
+                     int plane_rows, bint seam) nogil:
+    """Join the runs on rows [row0, row1) to touching runs of the same
+    value on the rows given by `links`.
+
+    `links` holds n_links (plane, row, touch) triples: the offset to a
+    preceding row, in a volume of planes of `plane_rows` rows, and
+    whether runs that only touch diagonally are connected.  If `seam`,
+    only rows before row0 are joined, otherwise only rows from row0 on.
 
     """
-    cdef np.int_t root = find_root(work, n)
-    cdef np.int_t root_m
+    cdef int i, j, k, l, m, n, plane, row, touch
+    cdef image_t value
+
+    for i in range(row0, row1):
+        plane = i / plane_rows
+        row = i - plane * plane_rows
 
-    if (n != m):
-        root_m = find_root(work, m)
+        for l in range(n_links):
+            touch = links[3 * l + 2]
+            if plane + links[3 * l] < 0 or row + links[3 * l + 1] < 0 or \
+               row + links[3 * l + 1] >= plane_rows:
+                continue
 
-        if (root > root_m):
-            root = root_m
+            n = i + links[3 * l] * plane_rows + links[3 * l + 1]
+            if (n < row0) != seam:
+                continue
 
-        set_root(work, n, root)
-        set_root(work, m, root)
+            m = rf[n]
+            for k in range(rf[i], rf[i + 1]):
+                value = d[i * cols + r[4 * k + 1]]
 
-# Connected components search as described in Fiorio et al.
+                while m < rf[n + 1] and r[4 * m + 2] + touch <= r[4 * k + 1]:
+                    m += 1
 
-def label(np.ndarray[DTYPE_t, ndim=2] input):
-    """Label connected regions of an integer array.
+                j = m
+                while j < rf[n + 1] and r[4 * j + 1] < r[4 * k + 2] + touch:
+                    if d[n * cols + r[4 * j + 1]] == value:
+                        _join_runs(par, k, j)
+                    j += 1
+
+cdef int _label_roots(int* r, int* par, int k0, int k1, int ctr) nogil:
+    """Number the first runs of components among runs [k0, k1), starting
+    at ctr.  Returns the next number.
 
     """
-    cdef np.int_t rows = input.shape[0]
-    cdef np.int_t cols = input.shape[1]
+    cdef int k
+
+    for k in range(k0, k1):
+        if par[k] == k:
+            r[4 * k + 3] = ctr
+            ctr += 1
 
-    cdef np.ndarray[DTYPE_t, ndim=2] data = input.copy()
-    cdef np.ndarray[DTYPE_t, ndim=2] work
+    return ctr
 
-    work = np.arange(data.size, dtype=DTYPE).reshape((rows, cols))
+cdef void _label_rest(int* r, int* par, int* out, int cols, int k0,
+                      int k1, bint shared) nogil:
+    """Label the other runs among [k0, k1) and, unless out is NULL,
+    write all of them to out.
 
-    cdef np.int_t *work_p = <np.int_t*>work.data
-    cdef np.int_t *data_p = <np.int_t*>data.data
+    If `par` is `shared` between threads, roots are found without
+    changing it.  Otherwise, this is the only strip, and roots are
+    numbered here as well.
 
-    cdef np.int_t i, j
+    """
+    cdef int j, k, root, ctr = 0
+
+    for k in range(k0, k1):
+        if shared:
+            root = k
+            while par[root] != root:
+                root = par[root]
+            r[4 * k + 3] = r[4 * root + 3]
+        elif par[k] == k:
+            r[4 * k + 3] = ctr
+            ctr += 1
+        else:
+            r[4 * k + 3] = r[4 * _run_root(par, k) + 3]
+
+        if out == NULL:
+            continue
+
+        for j in range(r[4 * k + 1], r[4 * k + 2]):
+            out[r[4 * k] * cols + j] = r[4 * k + 3]
+
+def _label_stage(np.ndarray[image_t, ndim=2, mode='c'] data,
+                 np.ndarray[np.int32_t, ndim=2, mode='c'] runs,
+                 np.ndarray[np.int32_t, ndim=1] row_first,
+                 np.ndarray[np.int32_t, ndim=1] parent,
+                 np.ndarray[np.int32_t, ndim=2, mode='c'] out,
+                 np.ndarray[np.int32_t, ndim=1] links, int plane_rows,
+                 int stage, int row0, int row1, int ctr=0,
+                 bint shared=False):
+    """Perform one stage of `label_runs` on rows [row0, row1), without
+    holding the GIL.
+
+    Stages are: 0, count runs per row (into `row_first`); 1, find runs
+    and join them within the rows; 2, join the runs on these rows to
+    those on previous rows; 3, count component roots; 4, number them
+    from `ctr`; 5, label the remaining runs (all runs, if not `shared`)
+    and the output, if it is not empty.  Returns the number of
+    roots after stage 3, and the next number after stage 4.  `shared`
+    tells whether other strips are processed concurrently.  See
+    `_join_rows` for `links` and `plane_rows`.
 
-    # Initialize the first row
-    for j in range(1, cols):
-        if data[0, j] == data[0, j-1]:
-            join_trees(work_p, j, j-1)
+    """
+    cdef image_t* d = <image_t*>data.data
+    cdef int cols = data.shape[1]
+    cdef int* r = <int*>runs.data
+    cdef int* rf = <int*>row_first.data
+    cdef int* par = <int*>parent.data
+    cdef int* lk = <int*>links.data
+    cdef int n_links = links.shape[0] / 3
+    cdef int* out_data = <int*>out.data if out.size > 0 else NULL
+    cdef int k0 = 0, k1 = 0
+
+    if stage > 2:
+        k0 = rf[row0]
+        k1 = rf[row1]
+
+    with nogil:
+        if stage == 0:
+            _count_runs(d, cols, row0, row1, rf)
+        elif stage == 1:
+            _find_runs(d, cols, row0, row1, r, rf)
+            _join_rows(d, cols, row0, row1, r, rf, par, lk, n_links,
+                       plane_rows, False)
+        elif stage == 2:
+            _join_rows(d, cols, row0, row1, r, rf, par, lk, n_links,
+                       plane_rows, True)
+        elif stage == 3:
+            for k0 in range(k0, k1):
+                if par[k0] == k0:
+                    ctr += 1
+        elif stage == 4:
+            ctr = _label_roots(r, par, k0, k1, ctr)
+        else:
+            _label_rest(r, par, out_data, cols, k0, k1, shared)
+
+    return ctr
+
+def _strips(int rows, int threads):
+    """Split rows into at most `threads` strips of consecutive rows.
 
-    for i in range(1, rows):
-        # Handle the first column
-        if data[i, 0] == data[i-1, 0]:
-            join_trees(work_p, i*cols, (i-1)*cols)
+    """
+    cdef int n = max(1, min(threads, rows))
+    cdef int step = max(1, (rows + n - 1) // n)
 
-        if data[i, 0] == data[i-1, 1]:
-            join_trees(work_p, i*cols, (i-1)*cols + 1)
+    return [(r, min(r + step, rows)) for r in range(0, rows, step)] or \
+           [(0, 0)]
 
-        for j in range(1, cols):
-            if data[i, j] == data[i-1, j-1]:
-                join_trees(work_p, i*cols + j, (i-1)*cols + j - 1)
+def _label_rows(data, int plane_rows, links, int threads,
+                bint return_labels):
+    """Label the regions of a 2-D array, whose rows are joined as given
+    by `links`.  See `_join_rows` and `label_runs`.
 
-            if data[i, j] == data[i-1, j]:
-                join_trees(work_p, i*cols + j, (i-1)*cols + j)
+    """
+    rows, cols = data.shape
+    strips = _strips(rows, threads)
+    links = np.array(links, dtype=LABEL_DTYPE).ravel()
+
+    row_first = np.zeros(rows + 1, dtype=LABEL_DTYPE)
+    out = np.empty((rows, cols) if return_labels else (0, 0),
+                   dtype=LABEL_DTYPE)
+    runs = np.empty((0, 4), dtype=LABEL_DTYPE)
+    parent = np.empty(0, dtype=LABEL_DTYPE)
+
+    pool = None
+    if len(strips) > 1:
+        pool = ThreadPoolExecutor(len(strips))
+
+    def stage(n, start=None):
+        # Run stage n on every strip; `start` gives each strip's ctr
+        if start is None:
+            start = [0] * len(strips)
+        jobs = [(data, runs, row_first, parent, out, links, plane_rows,
+                 n, row0, row1, ctr, pool is not None)
+                for (row0, row1), ctr in zip(strips, start)]
+
+        if pool is None:
+            return [_label_stage(*job) for job in jobs]
+        return list(pool.map(lambda job: _label_stage(*job), jobs))
+
+    try:
+        stage(0)
+        row_counts = row_first[:rows].copy()
+        row_first[0] = 0
+        np.cumsum(row_counts, out=row_first[1:])
+
+        runs = np.empty((row_first[rows], 4), dtype=LABEL_DTYPE)
+        parent = np.arange(row_first[rows], dtype=LABEL_DTYPE)
+
+        stage(1)
+
+        # Seams, one after the other
+        for row0, row1 in strips[1:]:
+            _label_stage(data, runs, row_first, parent, out, links,
+                         plane_rows, 2, row0, row1)
+
+        # Number the components in raster order of their first runs
+        if pool is not None:
+            roots = stage(3)
+            stage(4, [0] + list(np.cumsum(roots[:-1])))
+        stage(5)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    return (out if return_labels else None), runs
+
+def label_runs(input, int threads=1, bint return_labels=True):
+    """Label 8-connected regions of an array, one run at a time.
+
+    Every row is split into runs of equal pixels, and runs on adjacent
+    rows that touch and have the same value are joined.
+
+    Parameters
+    ----------
+    input : 2-D ndarray
+        Input image, of type uint8, uint16, int32, int64, float32 or
+        float64.  It is not copied, unless it is not C-contiguous.
+    threads : int
+        Number of threads.  The image is split into as many horizontal
+        strips, which are labelled concurrently; the runs on either side
+        of the seams between strips are then joined.  The output does
+        not depend on the number of threads.
+    return_labels : bool
+        Whether to write the label of every pixel.  If not, only the
+        runs are labelled, and `labels` is None.
+
+    Returns
+    -------
+    labels : 2-D ndarray of int32
+        Regions are numbered in order of their first pixel, in raster
+        order.
+    runs : (N, 4) ndarray of int32
+        ``(row, start, end, label)`` of every run, in raster order.  The
+        run covers columns ``start`` up to, but excluding, ``end``.
 
-            if j < cols - 1:
-                if data[i, j] == data[i - 1, j + 1]:
-                    join_trees(work_p, i*cols + j, (i-1)*cols + j + 1)
+    """
+    data = np.ascontiguousarray(input)
+    if data.ndim != 2:
+        raise ValueError("Input must be two-dimensional.")
 
-            if data[i, j] == data[i, j-1]:
-                join_trees(work_p, i*cols + j, i*cols + j - 1)
+    return _label_rows(data, data.shape[0], _row_links(8), threads,
+                       return_labels)
 
-    # Label output
+def label(input, int threads=1):
+    """Label 8-connected regions of an array.
 
-    cdef np.int_t ctr = 0
-    for i in range(rows):
-        for j in range(cols):
-            if (i*cols + j) == work[i, j]:
-                data[i, j] = ctr
-                ctr = ctr + 1
-            else:
-                data[i, j] = data_p[work[i, j]]
+    The input may be of type uint8, uint16, int32, int64, float32 or
+    float64, and is not copied.  See `label_runs`.
 
-    return data
+    Returns
+    -------
+    labels : 2-D ndarray of int32
+
+    """
+    return label_runs(input, threads)[0]
+
+def neighbour_offsets(int connectivity):
+    """Offsets (plane, row, column) to the neighbours of a voxel that
+    precede it in raster order.
+
+    Parameters
+    ----------
+    connectivity : {6, 18, 26}
+        Voxels are connected if they share a face (6), a face or an edge
+        (18), or a face, an edge or a corner (26).
+
+    """
+    if connectivity not in (6, 18, 26):
+        raise ValueError("Connectivity must be 6, 18 or 26.")
+
+    cdef int max_steps = {6: 1, 18: 2, 26: 3}[connectivity]
+
+    return [(dp, dr, dc) for dp in (-1, 0, 1)
+                         for dr in (-1, 0, 1)
+                         for dc in (-1, 0, 1)
+                         if (dp, dr, dc) < (0, 0, 0) and
+                            abs(dp) + abs(dr) + abs(dc) <= max_steps]
+
+def _row_links(int connectivity):
+    """Offsets (plane, row) to the preceding rows that a run may touch,
+    and whether runs that touch diagonally on those rows are connected.
+
+    Runs on the same row never have the same value.  Connectivity 8
+    stands for an image, i.e. a single plane.
+
+    """
+    if connectivity == 8:
+        return [(0, -1, 1)]
+
+    offsets = neighbour_offsets(connectivity)
+
+    return [(dp, dr, int((dp, dr, -1) in offsets))
+            for dp, dr in sorted(set((dp, dr) for dp, dr, dc in offsets))
+            if (dp, dr) != (0, 0)]
+
+def label_runs3d(input, int connectivity=26, int threads=1,
+                 bint return_labels=True):
+    """Label connected regions of a three-dimensional array, one run at
+    a time.
+
+    Parameters
+    ----------
+    input : 3-D ndarray
+        Input volume, of a type supported by `label_runs`.  It is not
+        copied, unless it is not C-contiguous.
+    connectivity : {6, 18, 26}
+        See `neighbour_offsets`.
+    threads : int
+        Number of threads, as for `label_runs`.
+    return_labels : bool
+        Whether to write the label of every voxel.  If not, only the
+        runs are labelled, and `labels` is None.
+
+    Returns
+    -------
+    labels : 3-D ndarray of int32
+        Regions are numbered in order of their first voxel in raster
+        order, as by `label`.
+    runs : (N, 4) ndarray of int32
+        ``(row, start, end, label)`` of every run, in raster order, as
+        for `label_runs`.  Row ``p * rows + r`` is row r of plane p.
+
+    """
+    data = np.ascontiguousarray(input)
+    if data.ndim != 3:
+        raise ValueError("Input must be three-dimensional.")
+
+    planes, rows, cols = data.shape
+    labels, runs = _label_rows(data.reshape((planes * rows, cols)), rows,
+                               _row_links(connectivity), threads,
+                               return_labels)
+    if labels is not None:
+        labels = labels.reshape(data.shape)
+
+    return labels, runs
+
+def label3d(input, int connectivity=26):
+    """Label connected regions of a three-dimensional array.
+
+    Parameters
+    ----------
+    input : 3-D ndarray
+        Input volume, of a type supported by `label`.  It is not copied.
+    connectivity : {6, 18, 26}
+        See `neighbour_offsets`.
+
+    Returns
+    -------
+    labels : 3-D ndarray of int32
+        Regions are numbered in order of their first voxel in raster
+        order, as by `label`.  See `label_runs3d`.
+
+    """
+    return label_runs3d(input, connectivity)[0]
@@ -1,12 +1,29 @@
 # -*- python -*-
 
-from int_array cimport IntArray
+cdef enum:
+    INLINE_SIZE = 6
 
 cdef class ConnectedRegion:
     cdef int _value
     cdef int _start_row
     cdef int _nnz
-    cdef tuple _shape # fixme: split into x and y
+    cdef int _rows
+    cdef int _cols
 
-    cdef IntArray rowptr
-    cdef IntArray colptr
+    # Row pointers, followed by column pointers, in a single buffer.
+    # Small regions are stored in the object itself.
+    cdef int* _buf
+    cdef int _cap
+    cdef int _n_rowptr
+    cdef int _n_colptr
+    cdef int _inline[INLINE_SIZE]
+
+cdef inline int* _rowptr(ConnectedRegion cr):
+    return cr._buf
+
+cdef inline int* _colptr(ConnectedRegion cr):
+    return cr._buf + cr._n_rowptr
+
+cdef reserve(ConnectedRegion cr, int n)
+cdef set_runs(ConnectedRegion cr, int* rp, int n_rowptr,
+              int* cp, int n_colptr)
@@ -3,7 +3,9 @@
 """
 Notes on file structure: we have a minimal data class,
 ConnectedRegion, that stores the row and column pointers, size and
-value for the ConnectedRegion.  The functions in
+value for the ConnectedRegion.  The shape is kept as two C ints, and
+the row pointers are followed by the column pointers in one buffer,
+which lives inside the object for small regions.  The functions in
 connected_region_handler do all the work on ConnectedRegions.  This
 somewhat roundabout way of doing things is to ensure that the memory
 size of ConnectedRegion is minimal, since we have to store thousands
@@ -15,7 +17,7 @@ __all__ = ['ConnectedRegion']
 
 import lulu.connected_region_handler as crh
 cimport int_array as iarr
-from int_array cimport IntArray
+from libc.string cimport memcpy
 
 cdef class ConnectedRegion:
     """
@@ -58,28 +60,74 @@ cdef class ConnectedRegion:
 
     # all class variables and their types are defined in connected_region.pxd
 
+    def __cinit__(self):
+        self._buf = self._inline
+        self._cap = INLINE_SIZE
+
+    def __dealloc__(self):
+        if self._buf != self._inline:
+            iarr._pool_release(self._buf, self._cap)
+
     def __init__(self, tuple shape, int value=0, int start_row=0,
                  list rowptr=None, list colptr=None):
         if shape is None:
             raise ValueError("Shape must be specified.")
 
-        self._shape = shape
+        self._rows, self._cols = shape
         self._value = value
 
-        self.rowptr = IntArray()
-        self.colptr = IntArray()
-        iarr.from_list(self.rowptr, rowptr)
-        iarr.from_list(self.colptr, colptr)
+        cdef int i, n
+        cdef list pointers = (rowptr or []) + (colptr or [])
+
+        reserve(self, len(pointers))
+        for i in range(len(pointers)):
+            self._buf[i] = pointers[i]
+        self._n_rowptr = len(rowptr or [])
+        self._n_colptr = len(colptr or [])
         self._start_row = start_row
 
         # Initialise nnz (nr of non-zeros or area of region)
-        cdef int i, n
-        cdef int* rp = self.rowptr.buf
-        cdef int* cp = self.colptr.buf
+        cdef int* rp = _rowptr(self)
+        cdef int* cp = _colptr(self)
 
         n = 0
-        if self.rowptr.size != 0:
-            for i in range((rp[self.rowptr.size - 1] - rp[0]) / 2):
+        if self._n_rowptr != 0:
+            for i in range((rp[self._n_rowptr - 1] - rp[0]) / 2):
                 n += cp[2*i + 1] - cp[2*i]
 
         self._nnz = n
+
+cdef reserve(ConnectedRegion cr, int n):
+    """Make room for `n` row and column pointers in total, keeping
+    the current ones.
+
+    """
+    cdef int* new_buf
+    cdef int k
+
+    if n <= cr._cap:
+        return
+
+    k = iarr._size_class(n)
+    new_buf = iarr._pool_alloc(k)
+    memcpy(new_buf, cr._buf, sizeof(int) * (cr._n_rowptr + cr._n_colptr))
+
+    if cr._buf != cr._inline:
+        iarr._pool_release(cr._buf, cr._cap)
+
+    cr._buf = new_buf
+    cr._cap = 1 << k
+
+cdef set_runs(ConnectedRegion cr, int* rp, int n_rowptr,
+              int* cp, int n_colptr):
+    """Replace the row and column pointers of cr by copies of the
+    given ones.
+
+    """
+    cr._n_rowptr = cr._n_colptr = 0
+    reserve(cr, n_rowptr + n_colptr)
+
+    memcpy(cr._buf, rp, sizeof(int) * n_rowptr)
+    memcpy(cr._buf + n_rowptr, cp, sizeof(int) * n_colptr)
+    cr._n_rowptr = n_rowptr
+    cr._n_colptr = n_colptr
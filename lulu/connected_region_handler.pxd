@@ -22,14 +22,26 @@ cdef _minimum_shape(ConnectedRegion cr)
 cpdef ConnectedRegion copy(ConnectedRegion cr)
 cpdef int contains(ConnectedRegion cr, int r, int c)
 cdef _outside_boundary(ConnectedRegion cr, int* workspace)
+cdef ConnectedRegion _boundary_runs(ConnectedRegion cr, int* workspace)
+cdef enum:
+    RUNS_UNION = 0
+    RUNS_DIFFERENCE = 1
+
+cdef _union_row(IntArray out, int* x, int nx, int* y, int ny)
+cdef _difference_row(IntArray out, int* x, int nx, int* y, int ny)
+cdef ConnectedRegion _combine_runs(ConnectedRegion a, ConnectedRegion b,
+                                   int op)
+cdef ConnectedRegion _fold_boundary(ConnectedRegion cr, list parts)
+cdef long _boundary_nbytes(list parts)
 cpdef validate(ConnectedRegion cr)
-cdef int _boundary_maximum(IntArray boundary_x, IntArray boundary_y,
+cdef int _boundary_maximum(ConnectedRegion boundary,
                            np.int_t* img,
                            int rows, int cols)
-cdef int _boundary_minimum(IntArray boundary_x, IntArray boundary_y,
+cdef int _boundary_minimum(ConnectedRegion boundary,
                            np.int_t* img,
                            int rows, int cols)
 cpdef merge(ConnectedRegion, ConnectedRegion)
+cpdef merge_many(ConnectedRegion, list)
 cdef _set_array(np.int_t* arr, int rows, int cols, ConnectedRegion c,
                 int value, int mode=?)
 cpdef bounding_box(ConnectedRegion cr)
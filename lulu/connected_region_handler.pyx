@@ -8,10 +8,13 @@ import numpy as np
 # currently part of the Cython distribution).
 cimport numpy as np
 cimport libc.stdlib as stdlib
+from libc.limits cimport INT_MIN, INT_MAX
 
 cimport lulu.connected_region_handler as crh
 cimport int_array as iarr
 from int_array cimport IntArray
+from connected_region cimport _rowptr, _colptr, reserve, set_runs
+from libc.string cimport memcpy
 
 # Cython does not make it particularly easy to cdef static methods,
 # so we define these methods in their own module so they handle
@@ -25,12 +28,12 @@ cdef _iterate_rows(ConnectedRegion cr):
     Note that this row includes the row offset.
 
     """
-    cdef int* rowptr = cr.rowptr.buf
-    cdef int* colptr = cr.colptr.buf
+    cdef int* rowptr = _rowptr(cr)
+    cdef int* colptr = _colptr(cr)
 
     cdef list out = []
     cdef int r, c, start, end
-    for r in range(cr.rowptr.size - 1):
+    for r in range(cr._n_rowptr - 1):
         for c in range((rowptr[r + 1] - rowptr[r]) / 2):
             start = colptr[rowptr[r] + 2*c]
             end = colptr[rowptr[r] + 2*c + 1]
@@ -48,22 +51,40 @@ cpdef int nnz(ConnectedRegion cr):
     cdef int i
     cdef int *rowptr, *colptr
 
-    rowptr = cr.rowptr.buf
-    colptr = cr.colptr.buf
+    rowptr = _rowptr(cr)
+    colptr = _colptr(cr)
 
-    for i in range((rowptr[cr.rowptr.size - 1] - rowptr[0]) / 2):
+    for i in range((rowptr[cr._n_rowptr - 1] - rowptr[0]) / 2):
         n += colptr[2*i + 1] - colptr[2*i]
 
     return n
 
 cpdef get_shape(ConnectedRegion cr):
-    return cr._shape
+    return (cr._rows, cr._cols)
+
+cdef int _col_max(ConnectedRegion cr):
+    cdef int* colptr = _colptr(cr)
+    cdef int i, m = colptr[0]
+    for i in range(1, cr._n_colptr):
+        if colptr[i] > m:
+            m = colptr[i]
+
+    return m
+
+cdef int _col_min(ConnectedRegion cr):
+    cdef int* colptr = _colptr(cr)
+    cdef int i, m = colptr[0]
+    for i in range(1, cr._n_colptr):
+        if colptr[i] < m:
+            m = colptr[i]
+
+    return m
 
 cdef _minimum_shape(ConnectedRegion cr):
     """Return the minimum shape into which the connected region can fit.
 
     """
-    return (cr._start_row + cr.rowptr.size - 1, iarr.max(cr.colptr))
+    return (cr._start_row + cr._n_rowptr - 1, _col_max(cr))
 
 cpdef reshape(ConnectedRegion cr, shape=None):
     """Set the shape of the connected region.
@@ -71,9 +92,9 @@ cpdef reshape(ConnectedRegion cr, shape=None):
     Useful when converting to dense.
     """
     if shape is None:
-        cr._shape = crh._minimum_shape(cr)
-    elif (shape >= crh._minimum_shape(cr)):
-        cr._shape = shape
+        cr._rows, cr._cols = crh._minimum_shape(cr)
+    elif (tuple(shape) >= crh._minimum_shape(cr)):
+        cr._rows, cr._cols = shape
     else:
         raise ValueError("Minimum shape is %s." % \
                          crh._minimum_shape(cr))
@@ -82,14 +103,20 @@ cpdef ConnectedRegion copy(ConnectedRegion cr):
     """Return a deep copy of the connected region.
 
     """
-    cdef int i
+    cdef ConnectedRegion tmp = ConnectedRegion.__new__(ConnectedRegion)
+    cdef int n = cr._n_rowptr + cr._n_colptr
 
-    cdef ConnectedRegion tmp = ConnectedRegion(shape=cr._shape, value=cr._value,
-                                               start_row=cr._start_row)
-    iarr.copy(cr.rowptr, tmp.rowptr)
-    iarr.copy(cr.colptr, tmp.colptr)
+    tmp._rows = cr._rows
+    tmp._cols = cr._cols
+    tmp._value = cr._value
+    tmp._start_row = cr._start_row
+    tmp._nnz = cr._nnz
 
-    tmp._nnz = crh.nnz(tmp)
+    # Row and column pointers are stored back to back
+    reserve(tmp, n)
+    memcpy(tmp._buf, cr._buf, sizeof(int) * n)
+    tmp._n_rowptr = cr._n_rowptr
+    tmp._n_colptr = cr._n_colptr
 
     return tmp
 
@@ -97,7 +124,7 @@ cpdef set_start_row(ConnectedRegion cr, int start_row):
     """Set the first row where values occur.
 
     """
-    if start_row <= ((<int>cr._shape[0]) - cr.rowptr.size + 1):
+    if start_row <= (cr._rows - cr._n_rowptr + 1):
         cr._start_row = start_row
     else:
         raise ValueError("Start row is too large for the current "
@@ -107,10 +134,12 @@ cpdef int get_start_row(ConnectedRegion cr):
     return cr._start_row
 
 cpdef list get_colptr(ConnectedRegion cr):
-    return iarr.to_list(cr.colptr)
+    cdef int* colptr = _colptr(cr)
+    return [colptr[i] for i in range(cr._n_colptr)]
 
 cpdef list get_rowptr(ConnectedRegion cr):
-    return iarr.to_list(cr.rowptr)
+    cdef int* rowptr = _rowptr(cr)
+    return [rowptr[i] for i in range(cr._n_rowptr)]
 
 cpdef int contains(ConnectedRegion cr, int r, int c):
     """Does the connected region contain an element at (r, c)?
@@ -118,17 +147,17 @@ cpdef int contains(ConnectedRegion cr, int r, int c):
     """
     cdef int i, rows
     cdef int *colptr, *rowptr
-    colptr = cr.colptr.buf
-    rowptr = cr.rowptr.buf
+    colptr = _colptr(cr)
+    rowptr = _rowptr(cr)
 
     r -= cr._start_row
 
-    rows = cr.rowptr.size
+    rows = cr._n_rowptr
 
     if r < 0 or r > rows - 2:
         return False
 
-    if c < 0 or c >= <int>cr._shape[1]:
+    if c < 0 or c >= cr._cols:
         return False
 
     for i in range((rowptr[r + 1] - rowptr[r]) / 2):
@@ -138,9 +167,13 @@ cpdef int contains(ConnectedRegion cr, int r, int c):
 
     return False
 
-cdef _outside_boundary(ConnectedRegion cr, int* workspace):
+cdef ConnectedRegion _boundary_runs(ConnectedRegion cr, int* workspace):
     """Calculate the outside boundary using a scanline approach.
 
+    The boundary is returned as a ConnectedRegion.  It may extend one
+    position beyond the region's shape in every direction, so its rows
+    and columns can be negative.
+
     Notes
     -----
     A scanline is constructed that is as wide as the region.  The
@@ -177,16 +210,17 @@ cdef _outside_boundary(ConnectedRegion cr, int* workspace):
     cdef int i # scanline row-position
     cdef int j # column position in scanline
     cdef int start, end, k, c
-    cdef IntArray x = IntArray()
-    cdef IntArray y = IntArray()
+    cdef ConnectedRegion b = ConnectedRegion(shape=(cr._rows, cr._cols),
+                                             start_row=cr._start_row - 1)
+    cdef IntArray b_rowptr = IntArray(), b_colptr = IntArray()
 
-    cdef int* rowptr = cr.rowptr.buf
-    cdef int* colptr = cr.colptr.buf
+    cdef int* rowptr = _rowptr(cr)
+    cdef int* colptr = _colptr(cr)
 
-    cdef int rows = cr.rowptr.size - 1
+    cdef int rows = cr._n_rowptr - 1
 
-    cdef int col_min = iarr.min(cr.colptr)
-    cdef int col_max = iarr.max(cr.colptr)
+    cdef int col_min = _col_min(cr)
+    cdef int col_max = _col_max(cr)
     cdef int columns = col_max - col_min
 
     cdef int* line_above = <int*><void*>workspace
@@ -198,7 +232,9 @@ cdef _outside_boundary(ConnectedRegion cr, int* workspace):
         line_below[j] = 0
         line_above[j] = 0
 
-    for i in range(-1, rows + 2):
+    for i in range(-1, rows + 1):
+        iarr.append(b_rowptr, b_colptr.size)
+
         # Update scanline and line above scanline
         if i >= 0:
             for j in range(columns + 2):
@@ -236,14 +272,46 @@ cdef _outside_boundary(ConnectedRegion cr, int* workspace):
                  (line_above[j + 2] == 1 or
                   line[j + 2] == 1 or
                   line_below[j + 2] == 1))):
-                iarr.append(x, j + col_min)
-                iarr.append(y, i + cr._start_row)
+                # Extend the current run, or start a new one
+                if b_colptr.size > b_rowptr.buf[b_rowptr.size - 1] and \
+                   b_colptr.buf[b_colptr.size - 1] == j + col_min:
+                    b_colptr.buf[b_colptr.size - 1] += 1
+                else:
+                    iarr.append(b_colptr, j + col_min)
+                    iarr.append(b_colptr, j + col_min + 1)
+
+    iarr.append(b_rowptr, b_colptr.size)
+    set_runs(b, b_rowptr.buf, b_rowptr.size, b_colptr.buf, b_colptr.size)
+    b._nnz = nnz(b)
+
+    return b
+
+cdef _outside_boundary(ConnectedRegion cr, int* workspace):
+    """Calculate the outside boundary as lists of coordinates.
+
+    Returns
+    -------
+    y, x : IntArray
+        Coordinates of the boundary positions, ordered from top left to
+        bottom right.  See `_boundary_runs`.
+
+    """
+    cdef ConnectedRegion b = _boundary_runs(cr, workspace)
+    cdef IntArray x = IntArray()
+    cdef IntArray y = IntArray()
+    cdef int r, i, k
+
+    for r in range(b._n_rowptr - 1):
+        for i in range(_rowptr(b)[r], _rowptr(b)[r + 1], 2):
+            for k in range(_colptr(b)[i], _colptr(b)[i + 1]):
+                iarr.append(x, k)
+                iarr.append(y, r + b._start_row)
 
     return y, x
 
 def outside_boundary(ConnectedRegion cr):
     cdef int* workspace = <int*>stdlib.malloc(sizeof(int) * 3 *
-                                              (cr._shape[1] + 2))
+                                              (cr._cols + 2))
     cdef IntArray y, x
     y, x = _outside_boundary(cr, workspace)
 
@@ -251,6 +319,268 @@ def outside_boundary(ConnectedRegion cr):
 
     return y, x
 
+# Row-wise operations on runs.  A row is described by a pointer into
+# colptr and the number of entries, 2 per run.
+
+cdef inline int _row(ConnectedRegion cr, int r, int** runs):
+    """Point `runs` to the runs of absolute row r, and return the
+    number of colptr entries in that row.
+
+    """
+    r -= cr._start_row
+    if r < 0 or r > cr._n_rowptr - 2:
+        return 0
+
+    runs[0] = _colptr(cr) + _rowptr(cr)[r]
+    return _rowptr(cr)[r + 1] - _rowptr(cr)[r]
+
+cdef _union_row(IntArray out, int* x, int nx, int* y, int ny):
+    """Append the union of two sorted rows of runs to out.
+
+    Overlapping and touching runs are joined.
+
+    """
+    cdef int i = 0, j = 0, start, end, row_start = out.size
+
+    while i < nx or j < ny:
+        # Take the run that starts first
+        if j >= ny or (i < nx and x[i] <= y[j]):
+            start = x[i]
+            end = x[i + 1]
+            i += 2
+        else:
+            start = y[j]
+            end = y[j + 1]
+            j += 2
+
+        if out.size > row_start and start <= out.buf[out.size - 1]:
+            out.buf[out.size - 1] = max2(out.buf[out.size - 1], end)
+        else:
+            iarr.append(out, start)
+            iarr.append(out, end)
+
+cdef _difference_row(IntArray out, int* x, int nx, int* y, int ny):
+    """Append the runs of x that are not covered by y to out.
+
+    """
+    cdef int i, j = 0, start, end
+
+    for i in range(0, nx, 2):
+        start = x[i]
+        end = x[i + 1]
+
+        # Skip runs of y that lie before this run
+        while j < ny and y[j + 1] <= start:
+            j += 2
+
+        # Cut out the runs of y that overlap this run
+        while j < ny and y[j] < end:
+            if y[j] > start:
+                iarr.append(out, start)
+                iarr.append(out, y[j])
+            start = max2(start, y[j + 1])
+            if y[j + 1] > end:
+                break
+            j += 2
+
+        if start < end:
+            iarr.append(out, start)
+            iarr.append(out, end)
+
+cdef ConnectedRegion _combine_runs(ConnectedRegion a, ConnectedRegion b,
+                                   int op):
+    """Combine the runs of two regions, row by row.
+
+    Parameters
+    ----------
+    a, b : ConnectedRegion
+    op : int
+        RUNS_UNION - positions in either `a` or `b`
+        RUNS_DIFFERENCE - positions in `a`, but not in `b`
+
+    Notes
+    -----
+    Each row is handled by a single sweep over the sorted runs of both
+    regions, so the cost is linear in the number of runs.
+
+    """
+    cdef int start_row = a._start_row
+    cdef int end_row = a._start_row + a._n_rowptr - 2
+
+    if op == RUNS_UNION:
+        start_row = min2(start_row, b._start_row)
+        end_row = max2(end_row, b._start_row + b._n_rowptr - 2)
+
+    cdef ConnectedRegion out = ConnectedRegion(shape=(a._rows, a._cols),
+                                               start_row=start_row)
+    cdef IntArray rowptr = IntArray(), colptr = IntArray()
+    cdef int r, nx, ny
+    cdef int *x, *y
+
+    for r in range(start_row, end_row + 1):
+        iarr.append(rowptr, colptr.size)
+
+        nx = _row(a, r, &x)
+        ny = _row(b, r, &y)
+
+        if op == RUNS_UNION:
+            _union_row(colptr, x, nx, y, ny)
+        else:
+            _difference_row(colptr, x, nx, y, ny)
+
+    iarr.append(rowptr, colptr.size)
+    set_runs(out, rowptr.buf, rowptr.size, colptr.buf, colptr.size)
+    out._nnz = nnz(out)
+
+    return out
+
+ctypedef struct Run:
+    int row
+    int start
+    int end
+
+cdef int _compare_runs(const void* a, const void* b) nogil:
+    cdef Run* x = <Run*>a
+    cdef Run* y = <Run*>b
+
+    if x.row != y.row:
+        return x.row - y.row
+    return x.start - y.start
+
+cdef int _gather_runs(list regions, Run** out) except -1:
+    """Collect the runs of all regions, ordered by row and start.
+
+    The runs are stored in a newly allocated array, pointed to by out,
+    which the caller must free.  Returns the number of runs.
+
+    """
+    cdef ConnectedRegion p
+    cdef int i, r, n = 0
+
+    for p in regions:
+        n += p._n_colptr / 2
+
+    cdef Run* runs = <Run*>stdlib.malloc(sizeof(Run) * max2(n, 1))
+    if runs == NULL:
+        raise MemoryError()
+
+    n = 0
+    for p in regions:
+        for r in range(p._n_rowptr - 1):
+            for i in range(_rowptr(p)[r], _rowptr(p)[r + 1], 2):
+                runs[n].row = r + p._start_row
+                runs[n].start = _colptr(p)[i]
+                runs[n].end = _colptr(p)[i + 1]
+                n += 1
+
+    # The runs of a single region are already in order
+    if len(regions) > 1:
+        stdlib.qsort(runs, n, sizeof(Run), _compare_runs)
+
+    out[0] = runs
+    return n
+
+cdef ConnectedRegion _fold_boundary(ConnectedRegion cr, list parts):
+    """Return the outside boundary of cr, given its cached parts.
+
+    The parts are the boundaries of all the regions that were merged
+    into cr since the boundary was last requested.  The outside
+    boundary of a union of regions is the union of their boundaries,
+    less the union of the regions themselves.  The parts are replaced
+    by the result.
+
+    The first part is already sorted, so only the runs of the others
+    are sorted by position.  Both are then joined, and the region is
+    subtracted, in a single sweep over the rows.
+
+    """
+    cdef ConnectedRegion b, p, first = parts[0]
+
+    if len(parts) == 1:
+        return first
+
+    cdef int i, k, r
+    cdef Run* runs
+    cdef int n = _gather_runs(parts[1:], &runs)
+
+    cdef int start_row = min2(first._start_row, runs[0].row)
+    cdef int end_row = max2(first._start_row + first._n_rowptr - 2,
+                            runs[n - 1].row)
+
+    b = ConnectedRegion(shape=(cr._rows, cr._cols), start_row=start_row)
+
+    cdef IntArray added = IntArray(), joined = IntArray()
+    cdef IntArray rowptr = IntArray(), colptr = IntArray()
+    cdef int nx, ny
+    cdef int *x, *y
+
+    i = 0
+    for r in range(start_row, end_row + 1):
+        iarr.append(rowptr, colptr.size)
+
+        added.size = 0
+        while i < n and runs[i].row == r:
+            iarr.append(added, runs[i].start)
+            iarr.append(added, runs[i].end)
+            i += 1
+
+        joined.size = 0
+        nx = _row(first, r, &x)
+        _union_row(joined, x, nx, added.buf, added.size)
+
+        ny = _row(cr, r, &y)
+        _difference_row(colptr, joined.buf, joined.size, y, ny)
+
+    iarr.append(rowptr, colptr.size)
+    set_runs(b, rowptr.buf, rowptr.size, colptr.buf, colptr.size)
+    b._nnz = nnz(b)
+
+    stdlib.free(runs)
+    parts[:] = [b]
+
+    return b
+
+cdef long _boundary_nbytes(list parts):
+    """Return the memory used by the parts of a cached boundary, which
+    may be None.
+
+    """
+    cdef ConnectedRegion b
+    cdef long n = 0
+
+    if parts is None:
+        return 0
+
+    for b in parts:
+        n += sizeof(int) * b._cap
+
+    return n
+
+def outside_boundary_runs(ConnectedRegion cr, list cache=None):
+    """Return the outside boundary as a ConnectedRegion.
+
+    Parameters
+    ----------
+    cr : ConnectedRegion
+    cache : list, optional
+        Cached boundary of `cr`.  If empty, the boundary is computed and
+        stored in it.  The cache of a union of regions, after `merge`,
+        is the concatenation of the caches of the regions.
+
+    """
+    cdef int* workspace
+    if cache:
+        return copy(_fold_boundary(cr, cache))
+
+    workspace = <int*>stdlib.malloc(sizeof(int) * 3 * (cr._cols + 2))
+    b = _boundary_runs(cr, workspace)
+    stdlib.free(workspace)
+
+    if cache is not None:
+        cache.append(b)
+
+    return copy(b)
+
 cpdef set_value(ConnectedRegion cr, int v):
     cr._value = v
 
@@ -259,12 +589,12 @@ cpdef int get_value(ConnectedRegion cr):
 
 
 cpdef validate(ConnectedRegion cr):
-    if cr.rowptr.buf[cr.rowptr.size - 1] != cr.colptr.size:
+    if _rowptr(cr)[cr._n_rowptr - 1] != cr._n_colptr:
         raise RuntimeError("ConnectedRegion was not finalised.  Ensure "
                            "rowptr[-1] points beyond last entry of "
                            "colptr.")
 
-    if cr.colptr.size % 2 != 0:
+    if cr._n_colptr % 2 != 0:
         raise RuntimeError("Colptr must have 2xN entries.")
 
 # Return type should be bool, but cython complains
@@ -274,7 +604,7 @@ cdef int gt(int a, int b):
 cdef int lt(int a, int b):
     return a < b
 
-cdef int _boundary_extremum(IntArray boundary_x, IntArray boundary_y,
+cdef int _boundary_extremum(ConnectedRegion boundary,
                             np.int_t* img,
                             int max_rows, int max_cols,
                             int (*func)(int, int),
@@ -284,8 +614,8 @@ cdef int _boundary_extremum(IntArray boundary_x, IntArray boundary_y,
 
     Parameters
     ----------
-    boundary_x, boundary_y : list
-        X and Y coordinates of boundary.
+    boundary : ConnectedRegion
+        Outside boundary, as returned by `_boundary_runs`.
     img : Input image as integer array
     max_rows, max_cols : int
         Dimensions of img.
@@ -296,48 +626,53 @@ cdef int _boundary_extremum(IntArray boundary_x, IntArray boundary_y,
     initial_extremum : int
 
     """
-    cdef int i, r, c
+    cdef int* rowptr = _rowptr(boundary)
+    cdef int* colptr = _colptr(boundary)
+
+    cdef int i, r, k, start, end
     cdef np.int_t img_val
+    cdef np.int_t* img_row
     cdef int extremum = initial_extremum
 
-    for i in range(boundary_y.size):
-        r = boundary_y.buf[i]
-        c = boundary_x.buf[i]
-
-        if r < 0 or r >= max_rows or c < 0 or c >= max_cols:
+    for r in range(boundary._n_rowptr - 1):
+        if r + boundary._start_row < 0 or \
+           r + boundary._start_row >= max_rows:
             continue
 
-        img_val = img[r*max_cols + c]
-        if func(img_val, extremum) == 1:
-            extremum = img_val
+        img_row = img + (r + boundary._start_row) * max_cols
+
+        for i in range(rowptr[r], rowptr[r + 1], 2):
+            start = max2(colptr[i], 0)
+            end = min2(colptr[i + 1], max_cols)
+
+            for k in range(start, end):
+                img_val = img_row[k]
+                if func(img_val, extremum) == 1:
+                    extremum = img_val
 
     return extremum
 
-cdef int _boundary_maximum(IntArray boundary_x, IntArray boundary_y,
+cdef int _boundary_maximum(ConnectedRegion boundary,
                            np.int_t* img,
                            int max_rows, int max_cols):
-    return _boundary_extremum(boundary_x, boundary_y, img,
-                              max_rows, max_cols, gt, -1)
+    return _boundary_extremum(boundary, img,
+                              max_rows, max_cols, gt, INT_MIN)
 
-cdef int _boundary_minimum(IntArray boundary_x, IntArray boundary_y,
+cdef int _boundary_minimum(ConnectedRegion boundary,
                            np.int_t* img,
                            int max_rows, int max_cols):
-    return _boundary_extremum(boundary_x, boundary_y, img,
-                              max_rows, max_cols, lt, 256)
+    return _boundary_extremum(boundary, img,
+                              max_rows, max_cols, lt, INT_MAX)
 
 # Python wrappers for the above two functions
 def boundary_maximum(ConnectedRegion cr,
                      np.ndarray[np.int_t, ndim=2] img):
-    cdef IntArray y, x
-    y, x = outside_boundary(cr)
-    return _boundary_maximum(x, y, <np.int_t*>img.data,
+    return _boundary_maximum(outside_boundary_runs(cr), <np.int_t*>img.data,
                              img.shape[0], img.shape[1])
 
 def boundary_minimum(ConnectedRegion cr,
                      np.ndarray[np.int_t, ndim=2] img):
-    cdef IntArray y, x
-    y, x = outside_boundary(cr)
-    return _boundary_minimum(x, y, <np.int_t*>img.data,
+    return _boundary_minimum(outside_boundary_runs(cr), <np.int_t*>img.data,
                              img.shape[0], img.shape[1])
 
 
@@ -357,67 +692,60 @@ cpdef merge(ConnectedRegion a, ConnectedRegion b):
     """Merge b into a.  b and a must be connected.
 
     """
-    cdef int i, r, rpt, cpt
-    cdef int start_row = min2(a._start_row, b._start_row)
-    cdef int end_row = max2(a._start_row + a.rowptr.size - 2,
-                            b._start_row + b.rowptr.size - 2)
-
-    cdef IntArray new_colptr = IntArray()
-    cdef IntArray new_rowptr = IntArray()
+    merge_many(a, [b])
 
-    cdef list cols, merged_cols
-
-    for r in range(start_row, end_row + 1):
-        iarr.append(new_rowptr, new_colptr.size)
+cpdef merge_many(ConnectedRegion a, list regions):
+    """Merge all regions into a.  Together, they must be connected.
 
-        # Non-overlapping, use b
-        if r < a._start_row or r > (a.rowptr.size + a._start_row - 2):
-            rpt = r - b._start_row
-            for i in range(b.rowptr.buf[rpt], b.rowptr.buf[rpt + 1]):
-                iarr.append(new_colptr, b.colptr.buf[i])
+    The runs of the regions are collected and sorted, and then joined
+    with those of a in a single sweep over the rows, so that the cost
+    is linear in the total number of runs (up to the sort, which is
+    skipped for a single region).  The shape of a is set to the
+    minimum shape of the union.
 
-        # Non-overlapping, use a
-        elif r < b._start_row or r > (b.rowptr.size + b._start_row - 2):
-            rpt = r - a._start_row
-            for i in range(a.rowptr.buf[rpt], a.rowptr.buf[rpt + 1]):
-                iarr.append(new_colptr, a.colptr.buf[i])
+    """
+    cdef ConnectedRegion b
+    cdef Run* runs
+    cdef int i = 0, r, nx, col_max = INT_MIN
+    cdef int* x
 
-        # Overlapping: merge
-        else:
-            cols = []
-            merged_cols = []
-            rpt = r - a._start_row
-            for i in range((a.rowptr.buf[rpt + 1] - a.rowptr.buf[rpt]) // 2):
-                cpt = a.rowptr.buf[rpt] + 2 * i
+    if not regions:
+        return
 
-                cols.append([a.colptr.buf[cpt], a.colptr.buf[cpt + 1]])
+    cdef int n = _gather_runs(regions, &runs)
+    cdef int start_row = min2(a._start_row, runs[0].row)
+    cdef int end_row = max2(a._start_row + a._n_rowptr - 2,
+                            runs[n - 1].row)
 
-            rpt = r - b._start_row
-            for i in range((b.rowptr.buf[rpt + 1] - b.rowptr.buf[rpt]) // 2):
-                cpt = b.rowptr.buf[rpt] + 2 * i
+    cdef IntArray rowptr = IntArray(), colptr = IntArray()
+    cdef IntArray added = IntArray()
 
-                cols.append([b.colptr.buf[cpt], b.colptr.buf[cpt + 1]])
+    for r in range(start_row, end_row + 1):
+        iarr.append(rowptr, colptr.size)
 
-            cols.sort()
+        added.size = 0
+        while i < n and runs[i].row == r:
+            iarr.append(added, runs[i].start)
+            iarr.append(added, runs[i].end)
+            i += 1
 
-            for i in range(len(cols) - 1):
-                if cols[i][1] == cols[i+1][0]:
-                    cols[i+1][0] = cols[i][0]
-                    continue
-                merged_cols.extend(cols[i])
+        nx = _row(a, r, &x)
+        _union_row(colptr, x, nx, added.buf, added.size)
 
-            merged_cols.extend(cols[-1])
+        # The last run of a row ends furthest to the right
+        if colptr.size > rowptr.buf[rowptr.size - 1]:
+            col_max = max2(col_max, colptr.buf[colptr.size - 1])
 
-            for i in merged_cols:
-                iarr.append(new_colptr, i)
+    iarr.append(rowptr, colptr.size)
+    stdlib.free(runs)
 
-    iarr.append(new_rowptr, new_colptr.size)
+    for b in regions:
+        a._nnz += b._nnz
 
-    a.colptr = new_colptr
-    a.rowptr = new_rowptr
+    set_runs(a, rowptr.buf, rowptr.size, colptr.buf, colptr.size)
     a._start_row = start_row
-    reshape(a)
-    a._nnz = a._nnz + b._nnz
+    a._rows = end_row + 1
+    a._cols = col_max
 
 cdef _set_array(np.int_t* arr, int rows, int cols,
                 ConnectedRegion cr, int value,
@@ -427,56 +755,182 @@ cdef _set_array(np.int_t* arr, int rows, int cols,
     Mode: 0 == replace, 1 == add
 
     """
-    cdef int* rowptr = cr.rowptr.buf
-    cdef int* colptr = cr.colptr.buf
+    cdef int* rowptr = _rowptr(cr)
+    cdef int* colptr = _colptr(cr)
 
-    cdef int r, c, start, end, k, start_row = cr._start_row
+    cdef int r, row, i, k, start, end
+    cdef np.int_t* row_data
 
-    for r in range(cr.rowptr.size - 1):
-        for c in range((rowptr[r + 1] - rowptr[r]) / 2):
-            start = colptr[rowptr[r] + 2*c]
-            end = colptr[rowptr[r] + 2*c + 1]
+    for r in range(cr._n_rowptr - 1):
+        row = r + cr._start_row
+        if row < 0 or row >= rows:
+            continue
 
-            for k in range(start, end):
-                # This could probably be done more efficiently
-                if r >= 0 and r < rows and \
-                   start >= 0 and start < cols and \
-                   end >= 0 and end <= cols:
-                    if mode == 0:
-                        arr[(r + start_row)*cols + k] = value
-                    else:
-                        arr[(r + start_row)*cols + k] += value
+        row_data = arr + row * cols
+
+        for i in range(rowptr[r], rowptr[r + 1], 2):
+            start = max2(colptr[i], 0)
+            end = min2(colptr[i + 1], cols)
+
+            if mode == 0:
+                for k in range(start, end):
+                    row_data[k] = value
+            else:
+                for k in range(start, end):
+                    row_data[k] += value
+
+ctypedef fused image_t:
+    np.uint8_t
+    np.uint16_t
+    np.int32_t
+    np.int64_t
+    np.float32_t
+    np.float64_t
+
+cdef enum:
+    PAINT_REPLACE = 0
+    PAINT_ADD = 1
+    PAINT_MAX = 2
+
+cdef inline _paint_region(image_t* data, int rows, int cols,
+                          ConnectedRegion cr, image_t v, int mode):
+    """Paint v over the connected region, clipped to the array.
+
+    """
+    cdef int* rowptr = _rowptr(cr)
+    cdef int* colptr = _colptr(cr)
+    cdef int r, row, i, k, start, end
+    cdef image_t* row_data
+
+    for r in range(cr._n_rowptr - 1):
+        row = r + cr._start_row
+        if row < 0 or row >= rows:
+            continue
+
+        row_data = data + row * cols
+
+        for i in range(rowptr[r], rowptr[r + 1], 2):
+            start = max2(colptr[i], 0)
+            end = min2(colptr[i + 1], cols)
 
-def set_array(np.ndarray[np.int_t, ndim=2] arr,
-              ConnectedRegion c, int value, str mode='replace'):
+            if mode == PAINT_REPLACE:
+                for k in range(start, end):
+                    row_data[k] = v
+            elif mode == PAINT_ADD:
+                for k in range(start, end):
+                    row_data[k] += v
+            else:
+                for k in range(start, end):
+                    if v > row_data[k]:
+                        row_data[k] = v
 
-    cdef int add_mode = 0
-    if mode == 'add':
-        add_mode = 1
+def set_array(np.ndarray[image_t, ndim=2, mode='c'] arr,
+              ConnectedRegion c, value, str mode='replace'):
+    """Set arr to `value` over the connected region.
 
-    return _set_array(<np.int_t*>arr.data, arr.shape[0], arr.shape[1],
-                      c, value, add_mode)
+    Parameters
+    ----------
+    arr : 2-D ndarray
+        C-contiguous array of type uint8, uint16, int32, int64, float32
+        or float64.
+    c : ConnectedRegion
+    value : scalar
+    mode : {'replace', 'add'}
+        Whether to replace the values in arr, or add to them.
+
+    See Also
+    --------
+    paint : Paint many regions at once.
+
+    """
+    _paint_region(<image_t*>arr.data, arr.shape[0], arr.shape[1], c,
+                  <image_t>value,
+                  PAINT_ADD if mode == 'add' else PAINT_REPLACE)
+
+def paint(np.ndarray[image_t, ndim=2, mode='c'] arr, regions, values=None,
+          str mode='replace'):
+    """Paint many connected regions onto arr.
+
+    Parameters
+    ----------
+    arr : 2-D ndarray
+        C-contiguous array of type uint8, uint16, int32, int64, float32
+        or float64.
+    regions : sequence of ConnectedRegion
+    values : scalar or 1-D array_like, optional
+        Value painted over each region.  By default, the value of the
+        region itself.  Ignored in 'count' mode.
+    mode : {'replace', 'add', 'max', 'count'}
+        Whether to replace the values in arr, add to them, keep the
+        largest, or add one for every region covering a position.
+
+    Examples
+    --------
+    Count the pulses covering each pixel:
+
+    >>> count = np.zeros(img.shape, dtype=np.int32)
+    >>> crh.paint(count, [cr for a in pulses for cr in pulses[a]],
+    ...           mode='count')
+
+    """
+    cdef ConnectedRegion cr
+    cdef int p_mode
+
+    if mode == 'replace':
+        p_mode = PAINT_REPLACE
+    elif mode == 'add' or mode == 'count':
+        p_mode = PAINT_ADD
+    elif mode == 'max':
+        p_mode = PAINT_MAX
+    else:
+        raise ValueError("Unknown mode '%s'." % mode)
+
+    cdef list crs = list(regions)
+    cdef Py_ssize_t i, n = len(crs)
+
+    if mode == 'count':
+        values = 1
+    elif values is None:
+        values = [(<ConnectedRegion?>region)._value for region in crs]
+
+    cdef np.ndarray[image_t, ndim=1] v = \
+         np.ascontiguousarray(np.broadcast_to(values, (n,)), dtype=arr.dtype)
+
+    cdef image_t* data = <image_t*>arr.data
+    cdef int rows = arr.shape[0], cols = arr.shape[1]
+
+    for i in range(n):
+        cr = crs[i]
+        _paint_region(data, rows, cols, cr, v[i], p_mode)
 
 cpdef bounding_box(ConnectedRegion cr):
-    return (cr._start_row, iarr.min(cr.colptr),
-            cr._start_row + cr.rowptr.size - 2, iarr.max(cr.colptr) - 1)
+    return (cr._start_row, _col_min(cr),
+            cr._start_row + cr._n_rowptr - 2, _col_max(cr) - 1)
 
 # These methods are needed by the lulu decomposition to build
 # connected regions incrementally
 
 cpdef _new_row(ConnectedRegion cr):
-    cdef int L = cr.colptr.size
+    cdef int L = cr._n_colptr
+    cdef int i
 
-    if not cr.rowptr.buf[cr.rowptr.size - 1] == L:
-        iarr.append(cr.rowptr, L)
+    if not _rowptr(cr)[cr._n_rowptr - 1] == L:
+        # Make room for the row pointer in front of the column pointers
+        reserve(cr, cr._n_rowptr + L + 1)
+        for i in range(cr._n_rowptr + L, cr._n_rowptr, -1):
+            cr._buf[i] = cr._buf[i - 1]
+        cr._buf[cr._n_rowptr] = L
+        cr._n_rowptr += 1
 
 cpdef int _current_row(ConnectedRegion cr):
-    return cr.rowptr.size + cr._start_row - 1
+    return cr._n_rowptr + cr._start_row - 1
 
 # This internal method is only used to construct proper test data
 def _append_colptr(ConnectedRegion cr, *ints):
     for i in ints:
-        iarr.append(cr.colptr, i)
+        reserve(cr, cr._n_rowptr + cr._n_colptr + 1)
+        _colptr(cr)[cr._n_colptr] = i
+        cr._n_colptr += 1
 
 def todense(ConnectedRegion cr):
     """Convert the connected region to a dense array.
@@ -484,11 +938,9 @@ def todense(ConnectedRegion cr):
     """
     crh.validate(cr)
 
-    shape = cr._shape
-    if shape is None:
-        shape = crh._minimum_shape(cr)
+    shape = (cr._rows, cr._cols)
 
-    cdef np.ndarray[np.int_t, ndim=2] out = np.zeros(shape, dtype=np.int)
+    cdef np.ndarray[np.int_t, ndim=2] out = np.zeros(shape, dtype=np.int_)
 
     cdef int row, start, end
 
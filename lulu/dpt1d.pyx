@@ -0,0 +1,254 @@
+#cython: cdivision=True
+# -*- python -*-
+"""
+Discrete pulse transform of one-dimensional signals.
+
+In one dimension, a connected region is a run of equal samples, with
+at most two neighbours.  The signal is kept as a doubly linked list of
+runs, and runs are visited by length through per-length lists, so that
+the transform takes time linear in the length of the signal.
+
+"""
+
+__all__ = ['decompose1d', 'reconstruct1d']
+
+import numpy as np
+cimport numpy as np
+
+ctypedef fused signal_t:
+    np.int32_t
+    np.int64_t
+    np.float32_t
+    np.float64_t
+
+def _as_signal(signal):
+    """Return `signal` as a 1-D array of int32, int64, float32 or float64.
+
+    """
+    x = np.asarray(signal)
+    if x.ndim != 1:
+        raise ValueError("Input signal must be one-dimensional.")
+
+    if x.dtype.kind == 'f':
+        dtype = np.float32 if x.dtype.itemsize <= 4 else np.float64
+    elif x.dtype.kind in 'biu':
+        if x.dtype.itemsize < 4 or x.dtype == np.int32:
+            dtype = np.int32
+        else:
+            dtype = np.int64
+    else:
+        raise ValueError("Unsupported data type %s." % x.dtype)
+
+    return np.ascontiguousarray(x, dtype=dtype)
+
+def _decompose1d(np.ndarray[signal_t, ndim=1] x, bint order):
+    cdef Py_ssize_t n = x.shape[0]
+    cdef Py_ssize_t i, r, p, q, e, n_runs = 0, n_pulses = 0, n_entries = 0
+    cdef Py_ssize_t area
+    cdef int mode, step
+    cdef signal_t v, new_value
+    cdef bint extremum
+
+    # Runs of equal samples
+    cdef np.ndarray[np.intp_t, ndim=1] run_start = np.empty(n, dtype=np.intp)
+    cdef np.ndarray[np.intp_t, ndim=1] run_len = np.empty(n, dtype=np.intp)
+    cdef np.ndarray[signal_t, ndim=1] value = np.empty(n, dtype=x.dtype)
+
+    for i in range(n):
+        if i == 0 or x[i] != x[i - 1]:
+            run_start[n_runs] = i
+            run_len[n_runs] = 1
+            value[n_runs] = x[i]
+            n_runs += 1
+        else:
+            run_len[n_runs - 1] += 1
+
+    cdef np.ndarray[np.intp_t, ndim=1] prev = np.arange(-1, n_runs - 1,
+                                                        dtype=np.intp)
+    cdef np.ndarray[np.intp_t, ndim=1] next = np.arange(1, n_runs + 1,
+                                                        dtype=np.intp)
+    cdef np.ndarray[np.uint8_t, ndim=1] alive = np.ones(n_runs,
+                                                        dtype=np.uint8)
+    if n_runs > 0:
+        next[n_runs - 1] = -1
+
+    # Runs by length, as linked lists of entries.  A run is entered
+    # again whenever it grows; entries of dead or grown runs are skipped.
+    cdef np.ndarray[np.intp_t, ndim=1] bucket = np.empty(n + 1, dtype=np.intp)
+    cdef np.ndarray[np.intp_t, ndim=1] entry_run = \
+         np.empty(2 * n_runs + 1, dtype=np.intp)
+    cdef np.ndarray[np.intp_t, ndim=1] entry_next = \
+         np.empty(2 * n_runs + 1, dtype=np.intp)
+
+    bucket[:] = -1
+    for r in range(n_runs):
+        entry_run[n_entries] = r
+        entry_next[n_entries] = bucket[run_len[r]]
+        bucket[run_len[r]] = n_entries
+        n_entries += 1
+
+    # Every pulse but the last is followed by a merge, so there are at
+    # most as many pulses as runs.  Heights are float64 or int64, so that
+    # differences of integer samples cannot overflow; only one of the
+    # two height arrays is used.
+    cdef bint floating = x.dtype.kind == 'f'
+    cdef np.ndarray[np.intp_t, ndim=1] pulse_start = \
+         np.empty(n_runs, dtype=np.intp)
+    cdef np.ndarray[np.intp_t, ndim=1] pulse_len = \
+         np.empty(n_runs, dtype=np.intp)
+    cdef np.ndarray[np.float64_t, ndim=1] float_height = \
+         np.empty(n_runs if floating else 0, dtype=np.float64)
+    cdef np.ndarray[np.int64_t, ndim=1] int_height = \
+         np.empty(0 if floating else n_runs, dtype=np.int64)
+
+    for area in range(1, n + 1):
+        if bucket[area] == -1:
+            continue
+
+        # Upper (0) then lower (1), or vice versa
+        for step in range(2):
+            mode = step if order else 1 - step
+
+            e = bucket[area]
+            while e != -1:
+                r = entry_run[e]
+                e = entry_next[e]
+
+                if not alive[r] or run_len[r] != area:
+                    continue
+
+                p = prev[r]
+                q = next[r]
+                v = value[r]
+
+                # The run covering the whole signal is the last pulse
+                if p == -1 and q == -1:
+                    pulse_start[n_pulses] = run_start[r]
+                    pulse_len[n_pulses] = area
+                    if floating:
+                        float_height[n_pulses] = v
+                    else:
+                        int_height[n_pulses] = <np.int64_t>v
+                    n_pulses += 1
+                    alive[r] = 0
+                    continue
+
+                if mode == 0:
+                    extremum = (p == -1 or value[p] > v) and \
+                               (q == -1 or value[q] > v)
+                    if p == -1 or (q != -1 and value[q] < value[p]):
+                        new_value = value[q]
+                    else:
+                        new_value = value[p]
+                else:
+                    extremum = (p == -1 or value[p] < v) and \
+                               (q == -1 or value[q] < v)
+                    if p == -1 or (q != -1 and value[q] > value[p]):
+                        new_value = value[q]
+                    else:
+                        new_value = value[p]
+
+                if not extremum:
+                    continue
+
+                pulse_start[n_pulses] = run_start[r]
+                pulse_len[n_pulses] = area
+                if floating:
+                    float_height[n_pulses] = <double>v - <double>new_value
+                else:
+                    int_height[n_pulses] = \
+                        <np.int64_t>v - <np.int64_t>new_value
+                n_pulses += 1
+
+                # Merge with the neighbours that now have the same value
+                if p != -1 and value[p] == new_value:
+                    run_len[p] += run_len[r]
+                    next[p] = q
+                    if q != -1:
+                        prev[q] = p
+                    alive[r] = 0
+                    r = p
+
+                if q != -1 and value[q] == new_value:
+                    run_len[r] += run_len[q]
+                    next[r] = next[q]
+                    if next[q] != -1:
+                        prev[next[q]] = r
+                    alive[q] = 0
+
+                value[r] = new_value
+
+                entry_run[n_entries] = r
+                entry_next[n_entries] = bucket[run_len[r]]
+                bucket[run_len[r]] = n_entries
+                n_entries += 1
+
+    return (pulse_start[:n_pulses], pulse_len[:n_pulses],
+            (float_height if floating else int_height)[:n_pulses])
+
+def decompose1d(signal, operator='LU'):
+    """Decompose a one-dimensional signal into pulses.
+
+    Parameters
+    ----------
+    signal : 1-D array_like of ints or floats
+        Input signal.  Small integer types are converted to int32.
+    operator : {'LU', 'UL'}
+        Order in which to apply the L and U operators.  By default, 'LU',
+        i.e. first U then L.
+
+    Returns
+    -------
+    start, length : 1-D ndarray of intp
+        First sample and length of each pulse, ordered by length.
+    height : 1-D ndarray
+        Height of each pulse, as float64 for floating-point signals and
+        int64 otherwise, so that heights are exact.  The last pulse
+        covers the whole signal, and its height is the value that
+        remains after all others are removed.
+
+    See Also
+    --------
+    reconstruct1d, decompose
+
+    """
+    if operator not in ('LU', 'UL'):
+        raise ValueError("Unknown operator '%s'." % operator)
+
+    return _decompose1d(_as_signal(signal), operator == 'LU')
+
+def reconstruct1d(pulses, int size, min_area=None, max_area=None):
+    """Reconstruct a one-dimensional signal from its pulses.
+
+    Parameters
+    ----------
+    pulses : tuple of ndarray
+        ``(start, length, height)``, as returned by `decompose1d`.
+    size : int
+        Length of the signal.
+    min_area, max_area : int, optional
+        Only pulses with lengths in [min_area, max_area] are used.
+
+    Returns
+    -------
+    signal : 1-D ndarray
+        Reconstructed signal, of the same type as `height`.
+
+    """
+    start, length, height = [np.asarray(a) for a in pulses]
+
+    selected = np.ones(len(start), dtype=bool)
+    if min_area is not None:
+        selected &= (length >= min_area)
+    if max_area is not None:
+        selected &= (length <= max_area)
+
+    start = start[selected]
+    height = height[selected]
+
+    # Every pulse steps up at its start and down after its end
+    out = np.zeros(size + 1, dtype=height.dtype)
+    np.add.at(out, start, height)
+    np.add.at(out, start + length[selected], -height)
+
+    return np.cumsum(out[:-1], dtype=height.dtype)
@@ -9,6 +9,7 @@ cdef class IntArray:
     cdef int heapbuf[HEAP_SIZE]
 
 cpdef append(IntArray arr, int)
+cdef extend(IntArray arr, int* values, int n)
 cpdef int max(IntArray)
 cpdef int min(IntArray)
 cdef grow(IntArray arr, int)
@@ -16,3 +17,10 @@ cpdef copy(IntArray, IntArray)
 cpdef from_list(IntArray, list)
 cpdef int get(IntArray, int)
 cpdef list to_list(IntArray arr)
+cpdef acquire_pool()
+cpdef release_pool()
+
+# Buffer pool, shared with other containers of ints
+cdef int _size_class(int cap)
+cdef int* _pool_alloc(int k) except NULL
+cdef void _pool_release(int* buf, int cap)
@@ -1,11 +1,123 @@
 #cython: cdivision=True
 # -*- python -*-
+"""
+Growable arrays of ints.
+
+Buffers beyond the in-object storage are taken from a pool of free
+lists, one per power-of-two size class.  While the pool is held (see
+`acquire_pool`), released buffers are kept in it, up to `POOL_LIMIT`
+bytes, so that regions created and merged during a decomposition mostly
+reuse memory instead of calling malloc.  Once the last holder calls
+`release_pool`, the cached buffers are returned to the system, so that
+concurrent decompositions never free each other's buffers.  The pool is
+only used with the GIL held.
+
+"""
 
 cimport int_array
 cimport libc.stdlib as stdlib
+from libc.string cimport memcpy
 
 from int_array cimport HEAP_SIZE
 
+cdef enum:
+    # Size classes hold 2**k ints, for MIN_CLASS <= k < N_CLASSES
+    MIN_CLASS = 3
+    N_CLASSES = 28
+
+# Maximum number of bytes kept in the pool
+POOL_LIMIT = 64 * 1024 * 1024
+
+# A free buffer stores the next free buffer of its class in its first
+# bytes.
+cdef struct FreeBuffer:
+    FreeBuffer* next
+
+cdef FreeBuffer* _free_lists[N_CLASSES]
+cdef size_t _pool_bytes = 0
+cdef size_t _pool_limit = POOL_LIMIT
+
+# Number of holders of the pool
+cdef int _pool_users = 0
+
+cdef int _size_class(int cap):
+    cdef int k = MIN_CLASS
+    while (1 << k) < cap:
+        k += 1
+    return k
+
+cdef int* _pool_alloc(int k) except NULL:
+    """Return a buffer of 2**k ints.
+
+    """
+    global _pool_bytes
+    cdef FreeBuffer* b
+
+    if k < N_CLASSES and _free_lists[k] != NULL:
+        b = _free_lists[k]
+        _free_lists[k] = b.next
+        _pool_bytes -= sizeof(int) << k
+        return <int*>b
+
+    b = <FreeBuffer*>stdlib.malloc(sizeof(int) << k)
+    if b == NULL:
+        raise MemoryError()
+    return <int*>b
+
+cdef void _pool_release(int* buf, int cap):
+    """Return a buffer of `cap` = 2**k ints to the pool.
+
+    """
+    global _pool_bytes
+    cdef int k = _size_class(cap)
+    cdef FreeBuffer* b = <FreeBuffer*>buf
+
+    if _pool_users == 0 or k >= N_CLASSES or \
+       _pool_bytes + (sizeof(int) << k) > _pool_limit:
+        stdlib.free(buf)
+        return
+
+    b.next = _free_lists[k]
+    _free_lists[k] = b
+    _pool_bytes += sizeof(int) << k
+
+cpdef acquire_pool():
+    """Hold the pool, so that released buffers are cached for reuse.
+
+    Every call must be matched by a call to `release_pool`.
+
+    """
+    global _pool_users
+    _pool_users += 1
+
+cpdef release_pool():
+    """Release a hold on the pool.  Once no holds remain, all buffers
+    cached in the pool are freed.
+
+    """
+    global _pool_bytes, _pool_users
+    cdef FreeBuffer* b
+    cdef int k
+
+    if _pool_users > 0:
+        _pool_users -= 1
+    if _pool_users > 0:
+        return
+
+    for k in range(N_CLASSES):
+        while _free_lists[k] != NULL:
+            b = _free_lists[k]
+            _free_lists[k] = b.next
+            stdlib.free(b)
+
+    _pool_bytes = 0
+
+def pool_size():
+    """Return the number of bytes cached in the pool.
+
+    """
+    return _pool_bytes
+
 cdef class IntArray:
     """See int_array.pxd for members.
 
@@ -17,7 +129,7 @@ cdef class IntArray:
 
     def __dealloc__(self):
         if self.buf != self.heapbuf:
-            stdlib.free(self.buf)
+            _pool_release(self.buf, self.cap)
 
 cpdef inline append(IntArray arr, int x):
     if arr.size == arr.cap:
@@ -27,6 +139,15 @@ cpdef inline append(IntArray arr, int x):
     arr.buf[arr.size] = x
     arr.size += 1
 
+cdef extend(IntArray arr, int* values, int n):
+    """Append n values to the array.
+
+    """
+    grow(arr, arr.size + n)
+
+    memcpy(arr.buf + arr.size, values, sizeof(int) * n)
+    arr.size += n
+
 cpdef int max(IntArray arr):
     cdef int i,  m = arr.buf[0]
     for i in range(1, arr.size):
@@ -47,32 +168,30 @@ cdef inline grow(IntArray arr, int cap):
     """Grow the underlying array storage so that it can
     store `cap` elements.
 
+    Storage is taken from the pool, in the smallest size class that
+    fits, and the contents are copied over.
+
     """
     cdef int* new_buf
-    cdef int i
+    cdef int k
 
-    if cap <= arr.size:
+    if cap <= arr.cap:
         return
 
-    arr.cap = cap
-    new_buf = <int*>stdlib.malloc(sizeof(int) * cap)
-
-    for i in range(arr.size):
-        new_buf[i] = arr.buf[i]
+    k = _size_class(cap)
+    new_buf = _pool_alloc(k)
+    memcpy(new_buf, arr.buf, sizeof(int) * arr.size)
 
     if arr.buf != arr.heapbuf:
-        stdlib.free(arr.buf)
+        _pool_release(arr.buf, arr.cap)
 
     arr.buf = new_buf
+    arr.cap = 1 << k
 
 cpdef copy(IntArray src, IntArray dst):
-    cdef int i
-
     grow(dst, src.size)
-
-    dst.size = 0
-    for i in range(src.size):
-        append(dst, src.buf[i])
+    memcpy(dst.buf, src.buf, sizeof(int) * src.size)
+    dst.size = src.size
 
 cpdef from_list(IntArray arr, list ii):
     if ii is not None:
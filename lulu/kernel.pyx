@@ -0,0 +1,1035 @@
+#cython: cdivision=True
+# -*- python -*-
+"""
+Decomposition kernel that runs without the GIL, for images and volumes.
+
+The input is given as labelled runs of equal pixels, as found by
+`lulu.ccomp.label_runs`, and all state lives in C arrays, indexed by
+initial region label:
+
+- a union-find forest, mapping labels to the regions that own them,
+- the size of each region,
+- the runs of each region, as a linked list through `next_run`,
+- the neighbours of each region, as a growable array,
+- a binary min-heap of regions by area.
+
+Nothing is stored per pixel, other than the residual, so that memory
+use is proportional to the number of runs.  Merging appends the run
+list of one region to that of the other, so the runs of any region, at
+any time, remain a contiguous stretch of the final lists.  A pulse is
+therefore recorded as its first run and its area, and converted to rows
+and columns after the area loop.
+
+Images with few distinct levels, such as uint8 images, use a level
+engine: the adjacencies of every region are counted by whether they
+lead to a lower, an equal or a higher level, so that a region is known
+to be a minimum or maximum without visiting its neighbours.  Only the
+neighbours of actual pulses are visited, to find the new level and to
+move their counts.  Both engines give the same pulses.
+
+The value of each region is kept in a separate array, of the type of
+the image, and `_level` and `_run` are specialised for every supported
+type.  Heights are computed exactly, as int64 for integer images and
+float64 for float images.
+
+"""
+
+import numpy as np
+cimport numpy as np
+
+from libc.stdlib cimport malloc, calloc, realloc, free, qsort
+from libc.string cimport memcpy
+
+from lulu.ccomp import label_runs, label_runs3d, _row_links
+from lulu.pulse_table import PulseTable
+
+ctypedef struct Buffer:
+    int* buf
+    int size
+    int cap
+
+cdef int _reserve(Buffer* b, int n) nogil:
+    """Make room for n more elements.  Returns -1 if out of memory.
+
+    """
+    cdef int cap = b.cap
+    cdef int* buf
+
+    if b.size + n <= cap:
+        return 0
+
+    if cap < 4:
+        cap = 4
+    while cap < b.size + n:
+        cap *= 2
+
+    buf = <int*>realloc(b.buf, sizeof(int) * cap)
+    if buf == NULL:
+        return -1
+
+    b.buf = buf
+    b.cap = cap
+    return 0
+
+cdef inline int _push(Buffer* b, int value) nogil:
+    if b.size == b.cap and _reserve(b, 1) == -1:
+        return -1
+    b.buf[b.size] = value
+    b.size += 1
+    return 0
+
+# Pulse height: int64 for integer images, float64 for float images
+ctypedef union Height:
+    np.int64_t i
+    double d
+
+ctypedef struct HeightBuffer:
+    Height* buf
+    int size
+    int cap
+
+cdef inline int _push_height(HeightBuffer* b, Height value) nogil:
+    cdef Height* buf
+
+    if b.size == b.cap:
+        buf = <Height*>realloc(b.buf, sizeof(Height) * (2 * b.cap + 4))
+        if buf == NULL:
+            return -1
+        b.buf = buf
+        b.cap = 2 * b.cap + 4
+
+    b.buf[b.size] = value
+    b.size += 1
+    return 0
+
+ctypedef fused value_t:
+    np.uint8_t
+    np.uint16_t
+    np.int32_t
+    np.int64_t
+    np.float32_t
+    np.float64_t
+
+# Regions by area: keys are area << 32 | region, so that regions of the
+# same area are visited by label
+ctypedef struct KeyHeap:
+    np.int64_t* buf
+    int size
+    int cap
+
+cdef int _heap_push(KeyHeap* h, int area, int r) nogil:
+    """Add region r, of the given area, to the min-heap h.
+
+    """
+    cdef np.int64_t key = (<np.int64_t>area << 32) | r
+    cdef np.int64_t* buf
+    cdef int i, parent
+
+    if h.size == h.cap:
+        buf = <np.int64_t*>realloc(h.buf,
+                                   sizeof(np.int64_t) * (2 * h.cap + 4))
+        if buf == NULL:
+            return -1
+        h.buf = buf
+        h.cap = 2 * h.cap + 4
+
+    i = h.size
+    h.size += 1
+    while i > 0:
+        parent = (i - 1) / 2
+        if h.buf[parent] <= key:
+            break
+        h.buf[i] = h.buf[parent]
+        i = parent
+    h.buf[i] = key
+
+    return 0
+
+cdef inline int _heap_area(KeyHeap* h) nogil:
+    return <int>(h.buf[0] >> 32)
+
+cdef int _heap_pop(KeyHeap* h) nogil:
+    """Remove the smallest key from h, and return its region.
+
+    """
+    cdef np.int64_t top = h.buf[0], last
+    cdef int i = 0, child
+
+    h.size -= 1
+    last = h.buf[h.size]
+
+    while True:
+        child = 2 * i + 1
+        if child >= h.size:
+            break
+        if child + 1 < h.size and h.buf[child + 1] < h.buf[child]:
+            child += 1
+        if h.buf[child] >= last:
+            break
+        h.buf[i] = h.buf[child]
+        i = child
+
+    if h.size > 0:
+        h.buf[i] = last
+
+    return <int>(top & 0xffffffffLL)
+
+cdef int _compare_int(const void* a, const void* b) nogil:
+    return (<int*>a)[0] - (<int*>b)[0]
+
+cdef struct State:
+    # Volumes are processed as planes * rows rows of cols pixels
+    int planes, rows, cols, n_labels, n_runs
+    bint volume
+
+    # Runs (row, start, end, label) in raster order, and the first run
+    # of every row
+    int* runs
+    int* row_first
+
+    int* forest
+    int* size
+
+    # Runs of each region
+    int* head
+    int* tail
+    int* next_run
+
+    # Neighbours of each region; mark/stamp remove duplicates
+    Buffer* neighbours
+    int* mark
+    int stamp
+
+    KeyHeap heap
+    Buffer level
+    Buffer merges
+
+    # Level engine: neighbours are stored as (label, count) pairs, count
+    # being the number of adjacencies, and the adjacencies of every
+    # region are counted by whether the neighbour is at a lower, equal
+    # or higher level.  Regions at equal levels are merged at the end
+    # of every pass, so that all equal adjacencies of merged regions
+    # are internal ones.
+    bint levels
+    int* slot
+    int* lower
+    int* equal
+    int* higher
+
+    # Pulses: area, height and first run
+    Buffer pulse_area
+    HeightBuffer pulse_height
+    Buffer pulse_head
+
+cdef class _Kernel:
+    """Owner of the memory of a State.
+
+    """
+    cdef State s
+
+    def __dealloc__(self):
+        cdef State* s = &self.s
+        cdef int i
+
+        if s.neighbours != NULL:
+            for i in range(s.n_labels):
+                free(s.neighbours[i].buf)
+
+        free(s.neighbours)
+        free(s.forest)
+        free(s.size)
+        free(s.head)
+        free(s.tail)
+        free(s.next_run)
+        free(s.mark)
+        free(s.slot)
+        free(s.lower)
+        free(s.equal)
+        free(s.higher)
+        free(s.heap.buf)
+        free(s.level.buf)
+        free(s.merges.buf)
+        free(s.pulse_area.buf)
+        free(s.pulse_height.buf)
+        free(s.pulse_head.buf)
+
+cdef inline int _find(int* forest, int n) nogil:
+    while forest[n] != n:
+        forest[n] = forest[forest[n]]
+        n = forest[n]
+    return n
+
+cdef inline int _add_neighbour(State* s, int a, int b) nogil:
+    """Record that b neighbours a.  Runs of the same neighbour are
+    collapsed here; other duplicates are removed by _compact.
+
+    """
+    cdef Buffer* nb = &s.neighbours[a]
+
+    if s.levels:
+        if nb.size > 0 and nb.buf[nb.size - 2] == b:
+            nb.buf[nb.size - 1] += 1
+            return 0
+        if _push(nb, b) == -1:
+            return -1
+        return _push(nb, 1)
+
+    if nb.size == 0 or nb.buf[nb.size - 1] != b:
+        return _push(nb, b)
+    return 0
+
+cdef Buffer* _compact(State* s, int r) nogil:
+    """Resolve the neighbours of region r through the forest, and remove
+    duplicates, in place.  For the level engine, the counts of
+    duplicates are added up.
+
+    """
+    cdef Buffer* nb = &s.neighbours[r]
+    cdef int i, root, n = 0
+
+    s.stamp += 1
+    s.mark[r] = s.stamp
+
+    if s.levels:
+        for i in range(0, nb.size, 2):
+            root = _find(s.forest, nb.buf[i])
+            if s.mark[root] != s.stamp:
+                s.mark[root] = s.stamp
+                s.slot[root] = n
+                nb.buf[n] = root
+                nb.buf[n + 1] = nb.buf[i + 1]
+                n += 2
+            elif root != r:
+                nb.buf[s.slot[root] + 1] += nb.buf[i + 1]
+
+        nb.size = n
+        return nb
+
+    for i in range(nb.size):
+        root = _find(s.forest, nb.buf[i])
+        if s.mark[root] != s.stamp:
+            s.mark[root] = s.stamp
+            nb.buf[n] = root
+            n += 1
+
+    nb.size = n
+    return nb
+
+cdef int _link_rows(State* s, int i, int n, int touch) nogil:
+    """Record the neighbours among the runs on rows i and n, including
+    diagonal ones if `touch`.
+
+    """
+    cdef int* runs = s.runs
+    cdef int j, k, m = s.row_first[n], a, b
+
+    for k in range(s.row_first[i], s.row_first[i + 1]):
+        while m < s.row_first[n + 1] and \
+              runs[4 * m + 2] + touch <= runs[4 * k + 1]:
+            m += 1
+
+        j = m
+        while j < s.row_first[n + 1] and \
+              runs[4 * j + 1] < runs[4 * k + 2] + touch:
+            a = runs[4 * k + 3]
+            b = runs[4 * j + 3]
+            if a != b:
+                if _add_neighbour(s, a, b) == -1 or \
+                   _add_neighbour(s, b, a) == -1:
+                    return -1
+            j += 1
+
+    return 0
+
+cdef int _setup(State* s, int* links, int n_links) nogil:
+    """Initialise regions, neighbours and the area heap.
+
+    `links` holds n_links (plane, row, touch) triples, as used by
+    `lulu.ccomp._join_rows`, for the rows that precede a row.
+
+    """
+    cdef int* runs = s.runs
+    cdef int n = s.n_labels
+    cdef int i, k, l, a, b, plane, row
+
+    s.forest = <int*>malloc(sizeof(int) * n)
+    s.size = <int*>malloc(sizeof(int) * n)
+    s.head = <int*>malloc(sizeof(int) * n)
+    s.tail = <int*>malloc(sizeof(int) * n)
+    s.mark = <int*>malloc(sizeof(int) * n)
+    s.next_run = <int*>malloc(sizeof(int) * s.n_runs)
+    s.neighbours = <Buffer*>calloc(n, sizeof(Buffer))
+
+    if s.forest == NULL or s.size == NULL or \
+       s.head == NULL or s.tail == NULL or s.mark == NULL or \
+       s.next_run == NULL or s.neighbours == NULL:
+        return -1
+
+    if s.levels:
+        s.slot = <int*>malloc(sizeof(int) * n)
+        s.lower = <int*>malloc(sizeof(int) * n)
+        s.equal = <int*>malloc(sizeof(int) * n)
+        s.higher = <int*>malloc(sizeof(int) * n)
+        if s.slot == NULL or s.lower == NULL or s.equal == NULL or \
+           s.higher == NULL:
+            return -1
+
+    for i in range(n):
+        s.forest[i] = i
+        s.size[i] = 0
+        s.head[i] = -1
+        s.mark[i] = 0
+
+    # Run lists, in raster order
+    for k in range(s.n_runs):
+        a = runs[4 * k + 3]
+        if s.head[a] == -1:
+            s.head[a] = k
+        else:
+            s.next_run[s.tail[a]] = k
+        s.tail[a] = k
+        s.next_run[k] = -1
+        s.size[a] += runs[4 * k + 2] - runs[4 * k + 1]
+
+    # Consecutive runs on a row always neighbour each other
+    for k in range(1, s.n_runs):
+        if runs[4 * k] == runs[4 * (k - 1)]:
+            a = runs[4 * k + 3]
+            b = runs[4 * (k - 1) + 3]
+            if _add_neighbour(s, a, b) == -1 or \
+               _add_neighbour(s, b, a) == -1:
+                return -1
+
+    for i in range(s.planes * s.rows):
+        plane = i / s.rows
+        row = i - plane * s.rows
+
+        for l in range(n_links):
+            if plane + links[3 * l] < 0 or row + links[3 * l + 1] < 0 or \
+               row + links[3 * l + 1] >= s.rows:
+                continue
+
+            if _link_rows(s, i, i + links[3 * l] * s.rows + links[3 * l + 1],
+                          links[3 * l + 2]) == -1:
+                return -1
+
+    for i in range(n):
+        _compact(s, i)
+
+    for i in range(n):
+        if _heap_push(&s.heap, s.size[i], i) == -1:
+            return -1
+
+    return 0
+
+cdef int _merge(State* s) nogil:
+    """Merge all pairs of regions recorded in s.merges.
+
+    """
+    cdef int i, a, b, t
+    cdef Buffer nb
+
+    for i in range(0, s.merges.size, 2):
+        a = _find(s.forest, s.merges.buf[i])
+        b = _find(s.forest, s.merges.buf[i + 1])
+        if a == b:
+            continue
+
+        # Union by size, ties broken by label for reproducibility
+        if s.size[b] > s.size[a] or (s.size[b] == s.size[a] and b < a):
+            t = a
+            a = b
+            b = t
+
+        s.forest[b] = a
+        s.size[a] += s.size[b]
+
+        s.next_run[s.tail[a]] = s.head[b]
+        s.tail[a] = s.tail[b]
+
+        # Join neighbours, keeping the larger buffer
+        if s.neighbours[b].size > s.neighbours[a].size:
+            nb = s.neighbours[a]
+            s.neighbours[a] = s.neighbours[b]
+            s.neighbours[b] = nb
+
+        if _reserve(&s.neighbours[a], s.neighbours[b].size) == -1:
+            return -1
+        memcpy(s.neighbours[a].buf + s.neighbours[a].size,
+               s.neighbours[b].buf, sizeof(int) * s.neighbours[b].size)
+        s.neighbours[a].size += s.neighbours[b].size
+
+        free(s.neighbours[b].buf)
+        s.neighbours[b].buf = NULL
+        s.neighbours[b].size = 0
+        s.neighbours[b].cap = 0
+
+        if s.levels:
+            s.lower[a] += s.lower[b]
+            s.higher[a] += s.higher[b]
+            s.equal[a] = 0
+
+        # The region is scheduled again at its new area; its old entry
+        # is skipped when it comes up
+        if _heap_push(&s.heap, s.size[a], a) == -1:
+            return -1
+
+    s.merges.size = 0
+    return 0
+
+cdef inline Height _height(value_t old_value, value_t new_value) nogil:
+    cdef Height h
+    if value_t is np.float32_t or value_t is np.float64_t:
+        h.d = <double>old_value - <double>new_value
+    else:
+        h.i = <np.int64_t>old_value - <np.int64_t>new_value
+    return h
+
+cdef int _level(State* s, value_t* value, int area, int mode) nogil:
+    """Find the pulses of this area among the regions in s.level (mode 0:
+    raise minima, 1: lower maxima), and merge the regions involved.
+
+    """
+    cdef Buffer* nb
+    cdef int i, j, r
+    cdef value_t k, b_min, b_max, old_value, new_value
+
+    for i in range(s.level.size):
+        r = s.level.buf[i]
+
+        # Skip regions merged at the other mode
+        if s.forest[r] != r or s.size[r] != area:
+            continue
+
+        nb = _compact(s, r)
+        old_value = new_value = value[r]
+
+        # The region covering the whole image is the last pulse
+        if nb.size == 0:
+            if mode == 0 and old_value != 0:
+                value[r] = 0
+                if _push(&s.pulse_area, area) == -1 or \
+                   _push_height(&s.pulse_height,
+                                _height(old_value, value[r])) == -1 or \
+                   _push(&s.pulse_head, s.head[r]) == -1:
+                    return -1
+            continue
+
+        b_min = b_max = value[nb.buf[0]]
+        for j in range(1, nb.size):
+            k = value[nb.buf[j]]
+            if k < b_min:
+                b_min = k
+            if k > b_max:
+                b_max = k
+
+        if mode == 0 and b_min > old_value:
+            new_value = b_min
+        elif mode == 1 and b_max < old_value:
+            new_value = b_max
+
+        if new_value == old_value:
+            continue
+
+        value[r] = new_value
+
+        if _push(&s.pulse_area, area) == -1 or \
+           _push_height(&s.pulse_height,
+                        _height(old_value, new_value)) == -1 or \
+           _push(&s.pulse_head, s.head[r]) == -1:
+            return -1
+
+        for j in range(nb.size):
+            if value[nb.buf[j]] == new_value:
+                if _push(&s.merges, r) == -1 or \
+                   _push(&s.merges, nb.buf[j]) == -1:
+                    return -1
+
+    return _merge(s)
+
+cdef void _count(State* s, value_t* value, int r) nogil:
+    """Count the adjacencies of region r by level.
+
+    """
+    cdef Buffer* nb = &s.neighbours[r]
+    cdef int j
+    cdef value_t v = value[r]
+
+    s.lower[r] = s.equal[r] = s.higher[r] = 0
+    for j in range(0, nb.size, 2):
+        _recount(s, r, nb.buf[j + 1], value[nb.buf[j]], v, 1)
+
+cdef inline void _recount(State* s, int r, int count, value_t level,
+                          value_t v, int sign) nogil:
+    """Add `count` adjacencies of region r, at level v, to a region at
+    `level` (or remove them, if `sign` is negative).
+
+    """
+    if level < v:
+        s.lower[r] += sign * count
+    elif level > v:
+        s.higher[r] += sign * count
+    else:
+        s.equal[r] += sign * count
+
+cdef int _level_counted(State* s, value_t* value, int area, int mode) nogil:
+    """As `_level`, for the level engine.
+
+    A region is a minimum if none of its adjacencies is to a lower or
+    equal level, so that only the neighbours of the pulses are visited.
+
+    """
+    cdef Buffer* nb
+    cdef int i, j, n, r
+    cdef value_t k, old_value, new_value
+
+    for i in range(s.level.size):
+        r = s.level.buf[i]
+
+        # Skip regions merged at the other mode
+        if s.forest[r] != r or s.size[r] != area:
+            continue
+
+        if s.equal[r] > 0 or (mode == 0 and s.lower[r] > 0) or \
+           (mode == 1 and s.higher[r] > 0):
+            continue
+
+        old_value = value[r]
+
+        # The region covering the whole image is the last pulse
+        if s.lower[r] == 0 and s.higher[r] == 0:
+            if mode == 0 and old_value != 0:
+                value[r] = 0
+                if _push(&s.pulse_area, area) == -1 or \
+                   _push_height(&s.pulse_height,
+                                _height(old_value, value[r])) == -1 or \
+                   _push(&s.pulse_head, s.head[r]) == -1:
+                    return -1
+            continue
+
+        nb = _compact(s, r)
+
+        new_value = value[nb.buf[0]]
+        for j in range(2, nb.size, 2):
+            k = value[nb.buf[j]]
+            if (mode == 0 and k < new_value) or (mode == 1 and k > new_value):
+                new_value = k
+
+        value[r] = new_value
+
+        if _push(&s.pulse_area, area) == -1 or \
+           _push_height(&s.pulse_height,
+                        _height(old_value, new_value)) == -1 or \
+           _push(&s.pulse_head, s.head[r]) == -1:
+            return -1
+
+        # Adjacencies to r change level, on both sides
+        s.lower[r] = s.equal[r] = s.higher[r] = 0
+        for j in range(0, nb.size, 2):
+            n = nb.buf[j]
+            k = value[n]
+            _recount(s, r, nb.buf[j + 1], k, new_value, 1)
+            _recount(s, n, nb.buf[j + 1], old_value, k, -1)
+            _recount(s, n, nb.buf[j + 1], new_value, k, 1)
+
+            if k == new_value:
+                if _push(&s.merges, r) == -1 or \
+                   _push(&s.merges, n) == -1:
+                    return -1
+
+    return _merge(s)
+
+cdef int _run(State* s, value_t* value, bint order, int max_area) nogil:
+    """The area loop, over regions with the given values.
+
+    """
+    cdef int area, r
+
+    while s.heap.size > 0:
+        area = _heap_area(&s.heap)
+        if max_area >= 0 and area > max_area:
+            break
+
+        # Regions of this area; entries of regions that have since been
+        # merged, or have grown, are stale
+        s.level.size = 0
+        while s.heap.size > 0 and _heap_area(&s.heap) == area:
+            r = _heap_pop(&s.heap)
+            if s.forest[r] == r and s.size[r] == area:
+                if _push(&s.level, r) == -1:
+                    return -1
+
+        if s.levels:
+            if _level_counted(s, value, area, 1 - order) == -1 or \
+               _level_counted(s, value, area, order) == -1:
+                return -1
+        elif _level(s, value, area, 1 - order) == -1 or \
+             _level(s, value, area, order) == -1:
+            return -1
+
+    return 0
+
+cdef int _decompose_values(State* s, value_t* value, value_t* residual,
+                           bint order, int max_area) nogil:
+    """Run the area loop, and set the residual of every pixel to the
+    final value of its region.
+
+    """
+    cdef int k, j
+    cdef value_t v
+    cdef value_t* out
+
+    if s.levels:
+        for k in range(s.n_labels):
+            _count(s, value, k)
+
+    if _run(s, value, order, max_area) == -1:
+        return -1
+
+    for k in range(s.n_runs):
+        v = value[_find(s.forest, s.runs[4 * k + 3])]
+        out = residual + <Py_ssize_t>s.runs[4 * k] * s.cols
+        for j in range(s.runs[4 * k + 1], s.runs[4 * k + 2]):
+            out[j] = v
+
+    return 0
+
+cdef void _sort_runs(int* runs, int* members, int* tmp, int* count,
+                     int n) nogil:
+    """Sort the run indices of a pulse, i.e. sort its runs in raster
+    order.
+
+    Large pulses are sorted by first column and then, stably, by row,
+    using counting sorts over their bounding box.  `tmp` holds n ints,
+    and `count` as many as there are rows or columns, plus two.
+
+    """
+    cdef int i, row, col
+    cdef int row0 = runs[4 * members[0]], row1 = row0
+    cdef int col0 = runs[4 * members[0] + 1], col1 = col0
+
+    if n < 64:
+        qsort(members, n, sizeof(int), _compare_int)
+        return
+
+    for i in range(1, n):
+        row = runs[4 * members[i]]
+        col = runs[4 * members[i] + 1]
+        if row < row0:
+            row0 = row
+        elif row > row1:
+            row1 = row
+        if col < col0:
+            col0 = col
+        elif col > col1:
+            col1 = col
+
+    # Sparse pulses are cheaper to sort by comparison
+    if (row1 - row0) + (col1 - col0) > 4 * n:
+        qsort(members, n, sizeof(int), _compare_int)
+        return
+
+    for i in range(col1 - col0 + 2):
+        count[i] = 0
+    for i in range(n):
+        count[runs[4 * members[i] + 1] - col0 + 1] += 1
+    for i in range(col1 - col0):
+        count[i + 1] += count[i]
+    for i in range(n):
+        col = runs[4 * members[i] + 1] - col0
+        tmp[count[col]] = members[i]
+        count[col] += 1
+
+    for i in range(row1 - row0 + 2):
+        count[i] = 0
+    for i in range(n):
+        count[runs[4 * tmp[i]] - row0 + 1] += 1
+    for i in range(row1 - row0):
+        count[i + 1] += count[i]
+    for i in range(n):
+        row = runs[4 * tmp[i]] - row0
+        members[count[row]] = tmp[i]
+        count[row] += 1
+
+cdef int _materialise(State* s, Buffer* start_row, Buffer* offsets,
+                      Buffer* rowptr, Buffer* colptr,
+                      Buffer* row_index) nogil:
+    """Convert the recorded pulses to rows and column runs.
+
+    Only rows that hold part of a pulse are stored.  For a volume, the
+    table row of each is stored in `row_index`, alongside `rowptr`.
+
+    """
+    cdef int* runs = s.runs
+    cdef int i, j, k, n, row, start, end, prev_row, prev_end
+    cdef int status = 0
+    cdef Buffer members, tmp
+    cdef int* count
+
+    # Counts for sorting by row or by column
+    n = s.planes * s.rows
+    if s.cols > n:
+        n = s.cols
+    count = <int*>malloc(sizeof(int) * (n + 2))
+
+    members.buf = tmp.buf = NULL
+    members.size = members.cap = tmp.size = tmp.cap = 0
+
+    if count == NULL or _push(offsets, 0) == -1:
+        free(count)
+        return -1
+
+    for i in range(s.pulse_area.size):
+        # Runs of the pulse, in raster order
+        members.size = 0
+        k = s.pulse_head.buf[i]
+        n = 0
+        while n < s.pulse_area.buf[i]:
+            if _push(&members, k) == -1:
+                status = -1
+                break
+            n += runs[4 * k + 2] - runs[4 * k + 1]
+            k = s.next_run[k]
+        if status == -1:
+            break
+
+        if _reserve(&tmp, members.size) == -1:
+            status = -1
+            break
+        _sort_runs(runs, members.buf, tmp.buf, count, members.size)
+
+        n = members.size
+        if _reserve(colptr, 2 * n) == -1 or \
+           _reserve(rowptr, n + 1) == -1 or \
+           (s.volume and _reserve(row_index, n + 1) == -1) or \
+           _push(start_row, runs[4 * members.buf[0]]) == -1:
+            status = -1
+            break
+
+        prev_row = -1
+        prev_end = -1
+        for j in range(n):
+            k = members.buf[j]
+            row = runs[4 * k]
+            start = runs[4 * k + 1]
+            end = runs[4 * k + 2]
+
+            if row != prev_row:
+                rowptr.buf[rowptr.size] = colptr.size
+                rowptr.size += 1
+                if s.volume:
+                    row_index.buf[row_index.size] = row
+                    row_index.size += 1
+            elif start == prev_end:
+                # Runs of different initial regions, now one
+                colptr.buf[colptr.size - 1] = end
+                prev_end = end
+                continue
+
+            colptr.buf[colptr.size] = start
+            colptr.buf[colptr.size + 1] = end
+            colptr.size += 2
+
+            prev_row = row
+            prev_end = end
+
+        rowptr.buf[rowptr.size] = colptr.size
+        rowptr.size += 1
+        if s.volume:
+            row_index.buf[row_index.size] = prev_row + 1
+            row_index.size += 1
+
+        if _push(offsets, rowptr.size) == -1:
+            status = -1
+            break
+
+    free(members.buf)
+    free(tmp.buf)
+    free(count)
+    return status
+
+cdef np.ndarray _to_array(Buffer* b):
+    cdef np.ndarray out = np.empty(b.size, dtype=np.int32)
+    if b.size > 0:
+        memcpy(out.data, b.buf, sizeof(int) * b.size)
+    return out
+
+cdef np.ndarray _heights(HeightBuffer* b, dtype):
+    """Pulse heights, as float64 for float images and int64 otherwise.
+
+    """
+    cdef np.ndarray out = np.empty(b.size, dtype=np.float64
+                                   if dtype.kind == 'f' else np.int64)
+    if b.size > 0:
+        memcpy(out.data, b.buf, sizeof(Height) * b.size)
+    return out
+
+# Types of the images handled by _decompose_values
+_VALUE_TYPES = [np.dtype(t) for t in (np.uint8, np.uint16, np.int32,
+                                      np.int64, np.float32, np.float64)]
+
+def _as_image(img):
+    """Return `img` in a type handled natively by the labelling routines:
+    uint8, uint16, int32, int64, float32 or float64.
+
+    """
+    img = np.asarray(img)
+    kind, size = img.dtype.kind, img.dtype.itemsize
+
+    if kind == 'f':
+        dtype = np.float32 if size <= 4 else np.float64
+    elif kind == 'u' and size <= 2:
+        dtype = np.uint8 if size == 1 else np.uint16
+    elif kind == 'b':
+        dtype = np.uint8
+    elif kind in 'iu':
+        dtype = np.int32 if size < 4 or img.dtype == np.int32 else np.int64
+    else:
+        raise ValueError("Unsupported data type %s." % img.dtype)
+
+    return np.ascontiguousarray(img, dtype=dtype)
+
+MAX_LEVELS = 4096
+
+def decompose(img, bint order=True, int max_area=-1,
+              int connectivity=26, int threads=1, levels=None):
+    """Decompose a two- or three-dimensional signal into pulses, without
+    holding the GIL during the area loop.
+
+    Parameters
+    ----------
+    img : 2-D or 3-D ndarray
+        Input signal.  uint8, uint16, int32, int64, float32 and float64
+        images are processed without conversion.
+    order : bool
+        If True, apply U before L at every area ('LU'), otherwise L
+        before U.
+    max_area : int
+        If non-negative, stop after this area.
+    connectivity : {6, 18, 26}
+        Connectivity of volumes.  Images are always 8-connected.
+    threads : int
+        Number of threads used to label the signal.  See
+        `lulu.ccomp.label_runs`.
+    levels : bool, optional
+        Whether to use the level engine.  By default, it is used for
+        integer signals spanning fewer than `MAX_LEVELS` levels.  The
+        pulses do not depend on the engine.
+
+    Returns
+    -------
+    pulses : PulseTable
+        For a volume, row ``p * rows + r`` of the table is row r of
+        plane p, and the table has a `row_index`.  Heights are float64
+        for float images, and int64 otherwise.
+    residual : ndarray
+        The input with all pulses removed, of the same type as the
+        (converted) input.
+
+    """
+    img = _as_image(img)
+    shape = img.shape
+
+    if img.ndim == 2:
+        runs = label_runs(img, threads, return_labels=False)[1]
+        links = _row_links(8)
+    elif img.ndim == 3:
+        runs = label_runs3d(img, connectivity, threads,
+                            return_labels=False)[1]
+        links = _row_links(connectivity)
+    else:
+        raise ValueError("Input must be two- or three-dimensional.")
+
+    cdef int cols = shape[len(shape) - 1]
+    cdef int n_rows = np.prod(shape[:-1])
+    cdef np.ndarray[np.int32_t, ndim=2] runs_arr = runs
+    cdef np.ndarray[np.int32_t, ndim=1] row_first = \
+         np.searchsorted(runs[:, 0], np.arange(n_rows + 1)).astype(np.int32)
+
+    # Value of every region, taken from its first run
+    cdef np.ndarray values = \
+         np.empty(runs[:, 3].max() + 1 if len(runs) else 0, dtype=img.dtype)
+    values[runs[:, 3]] = img.reshape((n_rows, cols))[runs[:, 0], runs[:, 1]]
+    cdef np.ndarray[np.int32_t, ndim=1] links_arr = \
+         np.array(links, dtype=np.int32).ravel()
+
+    cdef _Kernel k = _Kernel()
+    cdef State* s = &k.s
+    cdef char* values_data = values.data
+    cdef int value_type = _VALUE_TYPES.index(img.dtype)
+    cdef int* links_data = <int*>links_arr.data
+    cdef int n_links = links_arr.shape[0] / 3
+    cdef Buffer start_row, offsets, rowptr, colptr, row_index
+    cdef int status
+
+    if levels is None:
+        levels = img.dtype.kind in 'iu' and img.size > 0 and \
+                 int(img.max()) - int(img.min()) < MAX_LEVELS
+
+    s.planes = shape[0] if len(shape) == 3 else 1
+    s.rows = shape[len(shape) - 2]
+    s.cols = cols
+    s.volume = len(shape) == 3
+    s.n_labels = values.shape[0]
+    s.n_runs = runs_arr.shape[0]
+    s.runs = <int*>runs_arr.data
+    s.levels = levels
+    s.row_first = <int*>row_first.data
+
+    start_row.buf = offsets.buf = rowptr.buf = colptr.buf = NULL
+    start_row.size = offsets.size = rowptr.size = colptr.size = 0
+    start_row.cap = offsets.cap = rowptr.cap = colptr.cap = 0
+    row_index.buf = NULL
+    row_index.size = row_index.cap = 0
+
+    cdef np.ndarray residual = np.empty(shape, dtype=img.dtype)
+    cdef char* residual_data = residual.data
+
+    with nogil:
+        status = _setup(s, links_data, n_links)
+        if status == 0:
+            if value_type == 0:
+                status = _decompose_values(s, <np.uint8_t*>values_data,
+                                           <np.uint8_t*>residual_data,
+                                           order, max_area)
+            elif value_type == 1:
+                status = _decompose_values(s, <np.uint16_t*>values_data,
+                                           <np.uint16_t*>residual_data,
+                                           order, max_area)
+            elif value_type == 2:
+                status = _decompose_values(s, <np.int32_t*>values_data,
+                                           <np.int32_t*>residual_data,
+                                           order, max_area)
+            elif value_type == 3:
+                status = _decompose_values(s, <np.int64_t*>values_data,
+                                           <np.int64_t*>residual_data,
+                                           order, max_area)
+            elif value_type == 4:
+                status = _decompose_values(s, <np.float32_t*>values_data,
+                                           <np.float32_t*>residual_data,
+                                           order, max_area)
+            else:
+                status = _decompose_values(s, <np.float64_t*>values_data,
+                                           <np.float64_t*>residual_data,
+                                           order, max_area)
+        if status == 0:
+            status = _materialise(s, &start_row, &offsets, &rowptr, &colptr,
+                                  &row_index)
+
+    try:
+        if status == -1:
+            raise MemoryError("Out of memory during decomposition.")
+
+        pulses = PulseTable(shape, _to_array(&s.pulse_area),
+                            _heights(&s.pulse_height, img.dtype),
+                            _to_array(&start_row), _to_array(&offsets),
+                            _to_array(&rowptr), _to_array(&colptr),
+                            _to_array(&row_index) if s.volume else None)
+    finally:
+        free(start_row.buf)
+        free(offsets.buf)
+        free(rowptr.buf)
+        free(colptr.buf)
+        free(row_index.buf)
+
+    return pulses, residual
@@ -0,0 +1,264 @@
+"""
+Process-parallel drivers for the discrete pulse transform.
+
+"""
+
+__all__ = ['decompose_tiled', 'decompose_many']
+
+import multiprocessing
+import secrets
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from lulu.base import decompose
+from lulu.pulse_table import PulseTable, _columns, _column_sizes
+
+def _tiles(shape, tile_shape, halo):
+    """Yield the core and the window, including halo, of every tile.
+
+    Both are given as (row0, row1, col0, col1).
+
+    """
+    rows, cols = shape
+    tile_rows, tile_cols = tile_shape
+
+    for r0 in range(0, rows, tile_rows):
+        for c0 in range(0, cols, tile_cols):
+            r1 = min(r0 + tile_rows, rows)
+            c1 = min(c0 + tile_cols, cols)
+
+            yield ((r0, r1, c0, c1),
+                   (max(r0 - halo, 0), min(r1 + halo, rows),
+                    max(c0 - halo, 0), min(c1 + halo, cols)))
+
+def _decompose_tile(args):
+    """Decompose one tile, and return the pulses it owns (in image
+    coordinates) and the residual of its core.
+
+    """
+    window, core, origin, max_area, kwargs = args
+
+    pulses, residual = decompose(window, quiet=True, output='table',
+                                 max_area=max_area, return_residual=True,
+                                 **kwargs)
+
+    # A pulse is owned by the tile whose core contains its first pixel
+    r0, r1, c0, c1 = core
+    wr, wc = origin
+
+    rows, cols = pulses.anchors()
+    rows += wr
+    cols += wc
+    own = (rows >= r0) & (rows < r1) & (cols >= c0) & (cols < c1)
+    pulses = pulses.take(own)
+
+    pulses.start_row += wr
+    pulses.colptr += wc
+
+    return pulses, residual[r0 - wr:r1 - wr, c0 - wc:c1 - wc]
+
+def decompose_tiled(img, max_area, tile_shape=(512, 512), workers=None,
+                    halo=None, **kwargs):
+    """Decompose an image into pulses of area up to `max_area`, tile by
+    tile, in a pool of processes.
+
+    Pulses of limited area depend only on a neighbourhood of the pixels
+    they cover.  Each tile is therefore decomposed along with a halo of
+    surrounding pixels, and only keeps the pulses whose first pixel (in
+    raster order) lies inside the tile.
+
+    Parameters
+    ----------
+    img : 2-D ndarray of ints
+        Input signal.
+    max_area : int
+        Largest pulse area to extract.  See `decompose`.
+    tile_shape : tuple of int
+        Shape of the tiles, excluding the halo.
+    workers : int, optional
+        Number of processes.  By default, one per CPU.  If 1, the tiles
+        are processed in this process.
+    halo : int, optional
+        Width of the halo around each tile.  Default is `max_area`.
+    kwargs
+        Passed on to `decompose`, e.g. `operator` or `engine`.
+
+    Returns
+    -------
+    pulses : PulseTable
+        Pulses of all tiles, ordered by area.
+    residual : 2-D ndarray of ints
+        Image smoothed up to area `max_area`.  See `decompose`.
+
+    """
+    img = np.asarray(img)
+    if img.ndim != 2:
+        raise ValueError("Input must be two-dimensional.")
+
+    if halo is None:
+        halo = max_area
+
+    jobs = [(img[w0:w1, v0:v1], core, (w0, v0), max_area, kwargs)
+            for core, (w0, w1, v0, v1) in _tiles(img.shape, tile_shape,
+                                                 halo)]
+
+    if workers == 1:
+        results = [_decompose_tile(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(_decompose_tile, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    residual = np.empty_like(img)
+    for (pulses, tile_residual), job in zip(results, jobs):
+        r0, r1, c0, c1 = job[1]
+        residual[r0:r1, c0:c1] = tile_residual
+
+    pulses = PulseTable.concatenate([p for p, r in results], img.shape)
+    pulses = pulses.take(np.argsort(pulses.area, kind='mergesort'))
+
+    return pulses, residual
+
+def _decompose_shared(args):
+    """Decompose one image, and store the resulting PulseTable in the
+    shared memory block of the given name.  Returns what is needed to
+    interpret the block.
+
+    The block holds the heights, in their own type, followed by the
+    remaining int32 columns.  It stays registered with the resource
+    tracker until the parent unlinks it, so that it is freed even if
+    it is never collected.
+
+    """
+    i, img, name, kwargs = args
+
+    pulses = decompose(img, quiet=True, output='table', **kwargs)
+    columns = _columns(pulses)
+    height = columns.pop(1)
+    total = sum(len(c) for c in columns)
+
+    shm = shared_memory.SharedMemory(name=name, create=True,
+                                     size=max(height.nbytes + total * 4, 1))
+    try:
+        out = np.ndarray(height.shape, dtype=height.dtype, buffer=shm.buf)
+        out[:] = height
+        data = np.ndarray((total,), dtype=np.int32, buffer=shm.buf,
+                          offset=height.nbytes)
+        start = 0
+        for c in columns:
+            data[start:start + len(c)] = c
+            start += len(c)
+        del out, data
+    finally:
+        shm.close()
+
+    return i, pulses.shape, height.dtype.str, \
+           (len(pulses), len(pulses.rowptr), len(pulses.colptr),
+            pulses.row_index is not None)
+
+def _collect_shared(name, shape, height_type, counts):
+    """Copy a PulseTable out of a shared memory block, and free it.
+
+    """
+    sizes = _column_sizes(*counts)
+    height_size = sizes.pop(1)
+
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        height = np.ndarray((height_size,), dtype=height_type,
+                            buffer=shm.buf)
+        data = np.ndarray((sum(sizes),), dtype=np.int32, buffer=shm.buf,
+                          offset=height.nbytes)
+        height = height.copy()
+        data = data.copy()
+    finally:
+        shm.close()
+        shm.unlink()
+
+    columns = []
+    start = 0
+    for size in sizes:
+        columns.append(data[start:start + size])
+        start += size
+    columns.insert(1, height)
+
+    return PulseTable(shape, *columns)
+
+def _unlink_shared(name):
+    """Free a shared memory block, if it was created.
+
+    """
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+
+    shm.close()
+    shm.unlink()
+
+def decompose_many(images, workers=None, chunksize=1, ordered=True,
+                   **kwargs):
+    """Decompose many images in a pool of processes.
+
+    Workers return their pulses through shared memory, rather than
+    pickling them.
+
+    Parameters
+    ----------
+    images : iterable of 2-D ndarray
+        Input signals.  These are consumed lazily.  See `decompose` for
+        the supported types.
+    workers : int, optional
+        Number of processes.  By default, one per CPU.
+    chunksize : int
+        Number of images sent to a worker at a time.
+    ordered : bool
+        Whether to return results in the order of `images`, or as soon
+        as they complete.
+    kwargs
+        Passed on to `decompose`, e.g. `operator` or `engine`.
+
+    Returns
+    -------
+    results : iterator of (int, PulseTable)
+        Index of each image in `images`, and its pulses.
+
+    Examples
+    --------
+    >>> pulses = [p for i, p in decompose_many(images)]
+
+    """
+    # Names of the blocks of the images sent out, but not yet collected
+    pending = {}
+
+    def jobs():
+        for i, img in enumerate(images):
+            pending[i] = name = 'lulu_' + secrets.token_hex(8)
+            yield i, img, name, kwargs
+
+    # Workers share the resource tracker of this process, so that
+    # blocks are not freed when a worker exits
+    resource_tracker.ensure_running()
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        if ordered:
+            results = pool.imap(_decompose_shared, jobs(), chunksize)
+        else:
+            results = pool.imap_unordered(_decompose_shared, jobs(),
+                                          chunksize)
+
+        for i, shape, height_type, counts in results:
+            yield i, _collect_shared(pending.pop(i), shape, height_type,
+                                     counts)
+    finally:
+        pool.terminate()
+        pool.join()
+
+        # Free the results that were not collected
+        for name in list(pending.values()):
+            _unlink_shared(name)
@@ -0,0 +1,32 @@
+# -*- python -*-
+
+from connected_region cimport ConnectedRegion
+from int_array cimport IntArray
+
+cdef class PulseTableBuilder:
+    cdef IntArray area
+    cdef IntArray height
+    cdef IntArray start_row
+    cdef IntArray offsets
+    cdef IntArray rowptr
+    cdef IntArray colptr
+
+cdef append(PulseTableBuilder b, ConnectedRegion cr, int area, int height)
+cdef finalise(PulseTableBuilder b, tuple shape)
+
+cdef class PulseStats:
+    # Accumulators of the current area
+    cdef int _area
+    cdef long _count
+    cdef long _positive
+    cdef long _negative
+    cdef double _positive_volume
+    cdef double _negative_volume
+    cdef double _min_height
+    cdef double _max_height
+
+    # Completed areas, as rows and as arrays of columns
+    cdef list _rows
+    cdef list _chunks
+
+cdef add_pulse(PulseStats s, int area, double height)
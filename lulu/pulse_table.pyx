@@ -0,0 +1,856 @@
+#cython: cdivision=True
+# -*- python -*-
+"""
+Columnar storage for the output of the discrete pulse transform.
+
+A dictionary of ConnectedRegions costs several Python objects per pulse.
+A PulseTable stores all pulses in a handful of contiguous arrays instead.
+
+On disk, a PulseTable is stored as follows (all values little-endian)::
+
+    magic      6 bytes, b'LULUPT'
+    version    uint16, currently 2
+    type       8 bytes, type of the heights, e.g. b'<i8' or b'<f8'
+    header     int64 x 8: ndim, shape (padded with 0 to 3 values),
+               pulses, len(rowptr), len(colptr), whether the table
+               has a row_index
+    height     pulses values of the type above
+    area       int32 x pulses
+    start_row  int32 x pulses
+    offsets    int32 x (pulses + 1)
+    rowptr     int32 x len(rowptr)
+    colptr     int32 x len(colptr)
+    row_index  int32 x len(rowptr), if present
+
+Pulses are stored in order of increasing area, so that pulses in an area
+band occupy a contiguous part of each array.  Heights are stored in
+their own type, which keeps int64 and float64 heights exact, and first,
+so that they are aligned in a memory map.
+
+"""
+
+__all__ = ['PulseTable', 'PulseStats', 'save_pulses', 'load_pulses']
+
+import numpy as np
+cimport numpy as np
+
+from libc.string cimport memcpy
+from libc.math cimport INFINITY
+
+cimport int_array as iarr
+from int_array cimport IntArray
+from connected_region cimport ConnectedRegion, _rowptr, _colptr, reserve
+
+cdef class PulseTableBuilder:
+    """Accumulate pulses, to be converted to a PulseTable.
+
+    See pulse_table.pxd for members.
+
+    """
+    def __cinit__(self):
+        self.area = IntArray()
+        self.height = IntArray()
+        self.start_row = IntArray()
+        self.offsets = IntArray()
+        self.rowptr = IntArray()
+        self.colptr = IntArray()
+
+        iarr.append(self.offsets, 0)
+
+cdef append(PulseTableBuilder b, ConnectedRegion cr, int area, int height):
+    """Add the connected region cr as a pulse.
+
+    """
+    cdef int* rp = _rowptr(cr)
+    cdef int n = cr._n_rowptr
+    cdef int i, base = b.colptr.size - rp[0]
+
+    iarr.append(b.area, area)
+    iarr.append(b.height, height)
+    iarr.append(b.start_row, cr._start_row)
+
+    for i in range(n):
+        iarr.append(b.rowptr, rp[i] + base)
+    iarr.append(b.offsets, b.rowptr.size)
+
+    iarr.extend(b.colptr, _colptr(cr) + rp[0], rp[n - 1] - rp[0])
+
+ctypedef fused image_t:
+    np.uint8_t
+    np.int16_t
+    np.int32_t
+    np.int64_t
+    np.float32_t
+    np.float64_t
+
+ctypedef fused height_t:
+    np.int64_t
+    np.float64_t
+
+def _paint(np.ndarray[image_t, ndim=2, mode='c'] out,
+           np.ndarray[height_t, ndim=1] height,
+           np.ndarray[np.int32_t, ndim=1] start_row,
+           np.ndarray[np.int32_t, ndim=1] row_index,
+           np.ndarray[np.int32_t, ndim=1] offsets,
+           np.ndarray[np.int32_t, ndim=1] rowptr,
+           np.ndarray[np.int32_t, ndim=1] colptr,
+           np.ndarray[np.intp_t, ndim=1] index):
+    """Add the heights of the pulses in `index` to out.
+
+    Bounds are checked once per run, rather than per pixel.  If
+    `row_index` is empty, the rows of a pulse are consecutive.
+
+    int64 heights are added to integer images exactly, wrapping around
+    like numpy integer arithmetic.
+
+    """
+    cdef int rows = out.shape[0], cols = out.shape[1]
+    cdef image_t* data = <image_t*>out.data
+    cdef int* rp = <int*>rowptr.data
+    cdef int* cp = <int*>colptr.data
+    cdef int* ri = <int*>row_index.data
+    cdef bint has_rows = row_index.shape[0] > 0
+    cdef image_t* row_data
+    cdef image_t value
+    cdef int p, r, row, i, k, start, end
+    cdef Py_ssize_t n
+
+    with nogil:
+        for n in range(index.shape[0]):
+            p = index[n]
+            value = <image_t>height[p]
+
+            for r in range(offsets[p + 1] - offsets[p] - 1):
+                if has_rows:
+                    row = ri[offsets[p] + r]
+                else:
+                    row = start_row[p] + r
+                if row < 0 or row >= rows:
+                    continue
+
+                row_data = data + <Py_ssize_t>row * cols
+
+                for i in range(rp[offsets[p] + r], rp[offsets[p] + r + 1], 2):
+                    start = cp[i]
+                    end = cp[i + 1]
+                    if start < 0:
+                        start = 0
+                    if end > cols:
+                        end = cols
+
+                    for k in range(start, end):
+                        row_data[k] += value
+
+def _feature_maps(np.ndarray[np.float64_t, ndim=1] strength,
+                  np.ndarray[np.int32_t, ndim=1] area,
+                  np.ndarray[np.int32_t, ndim=1] start_row,
+                  np.ndarray[np.int32_t, ndim=1] row_index,
+                  np.ndarray[np.int32_t, ndim=1] offsets,
+                  np.ndarray[np.int32_t, ndim=1] rowptr,
+                  np.ndarray[np.int32_t, ndim=1] colptr,
+                  np.ndarray[np.intp_t, ndim=1] index,
+                  int rows, int cols,
+                  np.ndarray[np.int32_t, ndim=1] count_map,
+                  np.ndarray[np.float64_t, ndim=1] strength_map,
+                  np.ndarray[np.float64_t, ndim=1] peak_map,
+                  np.ndarray[np.int32_t, ndim=1] scale_map):
+    """Accumulate per-pixel maps over the pulses in `index`, in a single
+    pass over their runs.
+
+    Maps of length zero are skipped.  `strength` is the absolute height
+    of each pulse.  A pixel's scale is the area of the strongest pulse
+    covering it; the peak map must be given along with the scale map.
+    See `_paint` for `row_index`.
+
+    """
+    cdef int* rp = <int*>rowptr.data
+    cdef int* cp = <int*>colptr.data
+    cdef int* ri = <int*>row_index.data
+    cdef bint has_rows = row_index.shape[0] > 0
+    cdef int* count_data = <int*>count_map.data
+    cdef double* strength_data = <double*>strength_map.data
+    cdef double* peak_data = <double*>peak_map.data
+    cdef int* scale_data = <int*>scale_map.data
+    cdef bint do_count = count_map.shape[0] > 0
+    cdef bint do_strength = strength_map.shape[0] > 0
+    cdef bint do_scale = scale_map.shape[0] > 0
+    cdef double h
+    cdef int a, p, r, row, i, k, start, end
+    cdef Py_ssize_t n, base
+
+    with nogil:
+        for n in range(index.shape[0]):
+            p = index[n]
+            h = strength[p]
+            a = area[p]
+
+            for r in range(offsets[p + 1] - offsets[p] - 1):
+                if has_rows:
+                    row = ri[offsets[p] + r]
+                else:
+                    row = start_row[p] + r
+                if row < 0 or row >= rows:
+                    continue
+
+                base = <Py_ssize_t>row * cols
+
+                for i in range(rp[offsets[p] + r], rp[offsets[p] + r + 1], 2):
+                    start = cp[i]
+                    end = cp[i + 1]
+                    if start < 0:
+                        start = 0
+                    if end > cols:
+                        end = cols
+
+                    if do_count:
+                        for k in range(start, end):
+                            count_data[base + k] += 1
+                    if do_strength:
+                        for k in range(start, end):
+                            strength_data[base + k] += h
+                    if do_scale:
+                        for k in range(start, end):
+                            if h > peak_data[base + k]:
+                                peak_data[base + k] = h
+                                scale_data[base + k] = a
+
+cdef np.ndarray _to_array(IntArray arr):
+    cdef np.ndarray out = np.empty(arr.size, dtype=np.int32)
+    memcpy(out.data, arr.buf, sizeof(int) * arr.size)
+    return out
+
+cdef finalise(PulseTableBuilder b, tuple shape):
+    """Return the accumulated pulses as a PulseTable.
+
+    """
+    return PulseTable(shape, _to_array(b.area), _to_array(b.height),
+                      _to_array(b.start_row), _to_array(b.offsets),
+                      _to_array(b.rowptr), _to_array(b.colptr))
+
+cdef ConnectedRegion _region(tuple shape, int area, int height, int start_row,
+                             np.ndarray[np.int32_t, ndim=1] rowptr,
+                             np.ndarray[np.int32_t, ndim=1] colptr):
+    """Construct a ConnectedRegion from a slice of a PulseTable.
+
+    """
+    cdef ConnectedRegion cr = ConnectedRegion(shape=shape, value=height,
+                                              start_row=start_row)
+    cdef int* rp = <int*>rowptr.data
+    cdef int i, n = rowptr.shape[0], m = rp[n - 1] - rp[0]
+
+    reserve(cr, n + m)
+    for i in range(n):
+        cr._buf[i] = rp[i] - rp[0]
+    memcpy(cr._buf + n, <int*>colptr.data + rp[0], sizeof(int) * m)
+    cr._n_rowptr = n
+    cr._n_colptr = m
+    cr._nnz = area
+
+    return cr
+
+def _rows_shape(shape):
+    """Shape of the table rows: for a volume, row ``p * rows + r`` is
+    row r of plane p.
+
+    """
+    if len(shape) == 2:
+        return shape
+    return (shape[0] * shape[1], shape[2])
+
+def _ranges(start, length):
+    """Concatenate the ranges [start[i], start[i] + length[i]).
+
+    """
+    length = np.asarray(length, dtype=np.intp)
+    base = np.repeat(np.cumsum(length) - length, length)
+    return np.arange(length.sum(), dtype=np.intp) - base + \
+           np.repeat(start, length)
+
+def _table_rows(table):
+    """The `row_index` of a table, computed from `start_row` if it has
+    none.
+
+    """
+    if table.row_index is not None:
+        return table.row_index
+
+    return _ranges(table.start_row, np.diff(table.offsets)).astype(np.int32)
+
+def _row_index(table):
+    """The `row_index` of a table, or an empty array if its rows are
+    consecutive.  See `_paint`.
+
+    """
+    if table.row_index is None:
+        return np.zeros(0, dtype=np.int32)
+    return table.row_index
+
+class PulseTable(object):
+    """Pulses of a discrete pulse transform, stored column-wise.
+
+    Each pulse is a connected region in the Compressed Sparse Row format
+    used by ConnectedRegion.  For a volume of shape (planes, rows, cols),
+    row ``p * rows + r`` of the table is row r of plane p.  The row
+    pointers of all pulses are concatenated into `rowptr`, and their
+    column pointers into `colptr`.
+
+    The rows of a pulse in an image are consecutive.  Those of a pulse
+    in a volume need not be, e.g. for a column through several planes,
+    so only the rows that hold part of the pulse are stored, and
+    `row_index` tells which rows these are.
+
+    Attributes
+    ----------
+    shape : tuple
+        Shape of the decomposed image.
+    area, height, start_row : ndarray of int32
+        Area, height and first row of each pulse.  Heights are float64
+        for pulses of float images.
+    offsets : ndarray of int32
+        The row pointers of pulse i are
+        ``rowptr[offsets[i]:offsets[i + 1]]``.
+    rowptr : ndarray of int32
+        Row pointers of all pulses.  These index into `colptr`.
+    colptr : ndarray of int32
+        Column pointers of all pulses.  See `ConnectedRegion`.
+    row_index : ndarray of int32 or None
+        Table row of every row pointer: row r of pulse i is table row
+        ``row_index[offsets[i] + r]``, and the last entry of each pulse
+        is one past its last row.  If None, the rows of pulse i are
+        consecutive from ``start_row[i]``.
+
+    """
+    def __init__(self, shape, area, height, start_row, offsets,
+                 rowptr, colptr, row_index=None):
+        self.shape = tuple(shape)
+        self.area = area
+        self.height = height
+        self.start_row = start_row
+        self.offsets = offsets
+        self.rowptr = rowptr
+        self.colptr = colptr
+        self.row_index = row_index
+
+    def __len__(self):
+        return len(self.area)
+
+    def __repr__(self):
+        return "<PulseTable of %d pulses, shape %s>" % (len(self), self.shape)
+
+    def paint(self, out, index=None):
+        """Add pulses to an image.
+
+        Parameters
+        ----------
+        out : 2-D or 3-D ndarray
+            C-contiguous array of shape `self.shape`, of dtype uint8,
+            int16, int32, int64, float32 or float64.
+        index : 1-D ndarray, optional
+            Indices or boolean mask of the pulses to add.  By default,
+            all pulses are added.
+
+        """
+        if out.shape != self.shape:
+            raise ValueError("Output shape %s does not match %s." % \
+                             (out.shape, self.shape))
+
+        # Volumes are painted as planes * rows rows
+        if out.ndim == 3:
+            if not out.flags.c_contiguous:
+                raise ValueError("Output must be C-contiguous.")
+            out = out.reshape(_rows_shape(self.shape))
+
+        if index is None:
+            index = np.arange(len(self), dtype=np.intp)
+        else:
+            index = np.asarray(index)
+            if index.dtype == bool:
+                index = np.flatnonzero(index)
+            index = index.astype(np.intp)
+
+        # Integer heights are painted exactly
+        if self.height.dtype.kind == 'f' and out.dtype.kind == 'f':
+            height = self.height.astype(np.float64)
+        else:
+            height = self.height.astype(np.int64)
+
+        _paint(out, height, self.start_row,
+               _row_index(self), self.offsets, self.rowptr, self.colptr,
+               index)
+
+    def anchors(self):
+        """Return the first pixel, in raster order, of every pulse.
+
+        Returns
+        -------
+        rows, cols : ndarray of int32
+
+        """
+        return (self.start_row.copy(),
+                self.colptr[self.rowptr[self.offsets[:-1]]])
+
+    def take(self, index):
+        """Return a PulseTable of the selected pulses.
+
+        Parameters
+        ----------
+        index : 1-D ndarray
+            Indices or boolean mask of the pulses to select, in the
+            order in which they should appear.
+
+        """
+        index = np.asarray(index)
+        if index.dtype == bool:
+            index = np.flatnonzero(index)
+        index = index.astype(np.intp)
+
+        # Segments of rowptr, and the colptr spans they point to
+        seg_start = self.offsets[index].astype(np.intp)
+        seg_end = self.offsets[index + 1].astype(np.intp)
+        seg_len = seg_end - seg_start
+
+        col_start = self.rowptr[seg_start].astype(np.intp)
+        col_len = self.rowptr[seg_end - 1] - col_start
+
+        offsets = np.zeros(len(index) + 1, dtype=np.int32)
+        np.cumsum(seg_len, out=offsets[1:])
+        col_base = np.zeros(len(index) + 1, dtype=np.intp)
+        np.cumsum(col_len, out=col_base[1:])
+
+        segments = _ranges(seg_start, seg_len)
+        rowptr = self.rowptr[segments] + \
+                 np.repeat(col_base[:-1] - col_start, seg_len)
+        colptr = self.colptr[_ranges(col_start, col_len)]
+
+        row_index = None
+        if self.row_index is not None:
+            row_index = self.row_index[segments]
+
+        return PulseTable(self.shape, self.area[index], self.height[index],
+                          self.start_row[index], offsets,
+                          rowptr.astype(np.int32), colptr, row_index)
+
+    @classmethod
+    def concatenate(cls, tables, shape=None):
+        """Join PulseTables, in the given order.
+
+        Parameters
+        ----------
+        tables : sequence of PulseTable
+        shape : tuple, optional
+            Shape of the output table.  By default, that of the first
+            table.
+
+        """
+        tables = list(tables)
+        if shape is None:
+            shape = tables[0].shape if tables else (0, 0)
+
+        offsets = [np.zeros(1, dtype=np.int32)]
+        rowptr = []
+        n_rowptr = n_colptr = 0
+
+        for t in tables:
+            offsets.append(t.offsets[1:] + n_rowptr)
+            rowptr.append(t.rowptr + n_colptr)
+            n_rowptr += len(t.rowptr)
+            n_colptr += len(t.colptr)
+
+        def join(arrays, dtype=np.int32):
+            return np.concatenate([np.zeros(0, dtype=dtype)] + \
+                                  list(arrays)).astype(dtype)
+
+        height_type = np.result_type(np.int32, *[t.height for t in tables])
+
+        row_index = None
+        if any(t.row_index is not None for t in tables):
+            row_index = join(_table_rows(t) for t in tables)
+
+        return cls(shape, join(t.area for t in tables),
+                   join((t.height for t in tables), height_type),
+                   join(t.start_row for t in tables),
+                   join(offsets), join(rowptr),
+                   join(t.colptr for t in tables), row_index)
+
+    def region(self, i):
+        """Return pulse i as a ConnectedRegion.
+
+        """
+        if self.height.dtype.kind == 'f':
+            raise ValueError("ConnectedRegions hold integer heights only.")
+
+        rowptr = self.rowptr[self.offsets[i]:self.offsets[i + 1]]
+
+        # Fill in the rows that the pulse skips
+        if self.row_index is not None:
+            rows = self.row_index[self.offsets[i]:self.offsets[i + 1]]
+            rowptr = rowptr[np.searchsorted(rows,
+                                            np.arange(rows[0], rows[-1] + 1))]
+
+        return _region(_rows_shape(self.shape), self.area[i],
+                       self.height[i], self.start_row[i], rowptr,
+                       self.colptr)
+
+    @classmethod
+    def from_dict(cls, dict pulses, shape=None):
+        """Construct a PulseTable from the output of `decompose`.
+
+        Parameters
+        ----------
+        pulses : dict
+            ConnectedRegions, indexed by pulse area.
+        shape : tuple, optional
+            Shape of the decomposed image.  By default, the shape of
+            the regions is used.
+
+        """
+        cdef PulseTableBuilder b = PulseTableBuilder()
+        cdef ConnectedRegion cr
+
+        for area in sorted(pulses):
+            for cr in pulses[area]:
+                if shape is None:
+                    shape = (cr._rows, cr._cols)
+                append(b, cr, area, cr._value)
+
+        if shape is None:
+            shape = (0, 0)
+
+        return finalise(b, tuple(shape))
+
+    def to_dict(self):
+        """Return the pulses as a dictionary of ConnectedRegions, indexed
+        by pulse area.
+
+        """
+        cdef dict out = {}
+        cdef int i
+
+        for i in range(len(self)):
+            out.setdefault(int(self.area[i]), []).append(self.region(i))
+
+        return out
+
+_MAGIC = b'LULUPT'
+_VERSION = 2
+_HEADER = np.dtype([('magic', 'S6'), ('version', '<u2'), ('height', 'S8'),
+                    ('ndim', '<i8'), ('shape', '<i8', 3), ('pulses', '<i8'),
+                    ('rowptr', '<i8'), ('colptr', '<i8'),
+                    ('row_index', '<i8')])
+
+# Columns of the statistics, see PulseStats._collect
+STAT_COLUMNS = ('area', 'count', 'positive', 'negative', 'positive_volume',
+                'negative_volume', 'min_height', 'max_height')
+
+cdef class PulseStats:
+    """Statistics of pulses, per area.
+
+    Pass an instance to `decompose` or `iter_decompose` to have it
+    updated with every pulse found, including pulses that are not kept.
+    The same instance may be used for several decompositions, to
+    gather statistics over many images.
+
+    Attributes
+    ----------
+    area : ndarray of int
+        Areas at which pulses occur, in increasing order.  The other
+        attributes have one entry per area.
+    count : ndarray of int
+        Number of pulses.
+    positive, negative : ndarray of int
+        Number of pulses with positive and negative heights.
+    volume : ndarray of float
+        Total volume of the pulses, i.e. the sum of area times absolute
+        height.
+    positive_volume, negative_volume : ndarray of float
+        Volume of the pulses with positive and negative heights.
+    min_height, max_height : ndarray of float
+        Smallest and largest pulse height.
+
+    Examples
+    --------
+    >>> stats = PulseStats()
+    >>> for area, pulses in iter_decompose(img, keep=lambda a, h: False,
+    ...                                    stats=stats):
+    ...     pass
+    >>> stats.volume.sum()
+
+    """
+    def __cinit__(self):
+        self._area = -1
+        self._rows = []
+        self._chunks = []
+
+    def update(self, pulses):
+        """Add the pulses of a decomposition.
+
+        Parameters
+        ----------
+        pulses : dict or PulseTable
+            Pulses, as returned by `decompose`.
+
+        """
+        cdef ConnectedRegion cr
+
+        if not isinstance(pulses, PulseTable):
+            for area in sorted(pulses):
+                for cr in pulses[area]:
+                    add_pulse(self, area, cr._value)
+            return
+
+        area = pulses.area.astype(np.float64)
+        height = pulses.height.astype(np.float64)
+        volume = area * np.abs(height)
+
+        self._chunks.append(np.column_stack(
+            [area, np.ones_like(area), height > 0, height < 0,
+             np.where(height > 0, volume, 0), np.where(height < 0, volume, 0),
+             height, height]))
+
+    def _collect(self):
+        """Return the statistics as an array, with one row per area and
+        the columns listed in `STAT_COLUMNS`.
+
+        """
+        _flush(self)
+
+        if self._rows:
+            self._chunks.append(np.array(self._rows, dtype=np.float64))
+            self._rows = []
+
+        if not self._chunks:
+            return np.zeros((0, len(STAT_COLUMNS)))
+
+        data = np.concatenate(self._chunks)
+        areas, index = np.unique(data[:, 0], return_inverse=True)
+
+        out = np.empty((len(areas), len(STAT_COLUMNS)))
+        out[:, 0] = areas
+        for j in range(1, 6):
+            out[:, j] = np.bincount(index, weights=data[:, j],
+                                    minlength=len(areas))
+        out[:, 6] = np.inf
+        out[:, 7] = -np.inf
+        np.minimum.at(out[:, 6], index, data[:, 6])
+        np.maximum.at(out[:, 7], index, data[:, 7])
+
+        self._chunks = [out]
+        return out
+
+    @property
+    def area(self):
+        return self._collect()[:, 0].astype(np.int_)
+
+    @property
+    def count(self):
+        return self._collect()[:, 1].astype(np.int_)
+
+    @property
+    def positive(self):
+        return self._collect()[:, 2].astype(np.int_)
+
+    @property
+    def negative(self):
+        return self._collect()[:, 3].astype(np.int_)
+
+    @property
+    def volume(self):
+        data = self._collect()
+        return data[:, 4] + data[:, 5]
+
+    @property
+    def positive_volume(self):
+        return self._collect()[:, 4]
+
+    @property
+    def negative_volume(self):
+        return self._collect()[:, 5]
+
+    @property
+    def min_height(self):
+        return self._collect()[:, 6]
+
+    @property
+    def max_height(self):
+        return self._collect()[:, 7]
+
+    def __repr__(self):
+        return "<PulseStats of %d pulses at %d areas>" % \
+               (self.count.sum(), len(self.area))
+
+cdef _flush(PulseStats s):
+    """Store the statistics of the current area as a row.
+
+    """
+    if s._area >= 0:
+        s._rows.append((s._area, s._count, s._positive, s._negative,
+                        s._positive_volume, s._negative_volume,
+                        s._min_height, s._max_height))
+
+    s._area = -1
+    s._count = s._positive = s._negative = 0
+    s._positive_volume = s._negative_volume = 0
+    s._min_height = INFINITY
+    s._max_height = -INFINITY
+
+cdef add_pulse(PulseStats s, int area, double height):
+    """Add a pulse to the statistics.
+
+    Pulses of the same area are accumulated in C until a pulse of
+    another area is added.
+
+    """
+    if area != s._area:
+        _flush(s)
+        s._area = area
+
+    s._count += 1
+    if height > 0:
+        s._positive += 1
+        s._positive_volume += area * height
+    elif height < 0:
+        s._negative += 1
+        s._negative_volume -= area * height
+
+    if height < s._min_height:
+        s._min_height = height
+    if height > s._max_height:
+        s._max_height = height
+
+def _column_sizes(n, n_rowptr, n_colptr, has_rows=False):
+    """Lengths of the columns of a PulseTable, in storage order.
+    `has_rows` tells whether the table has a `row_index`.
+
+    """
+    sizes = [n, n, n, n + 1, n_rowptr, n_colptr]
+    if has_rows:
+        sizes.append(n_rowptr)
+    return sizes
+
+def _columns(table):
+    """Columns of a PulseTable, in storage order.
+
+    """
+    columns = [table.area, table.height, table.start_row, table.offsets,
+               table.rowptr, table.colptr]
+    if table.row_index is not None:
+        columns.append(table.row_index)
+    return columns
+
+def _from_columns(shape, height, data, *counts):
+    """Construct a PulseTable from its heights, and the other columns
+    stored consecutively in `data`.  `counts` are as for `_column_sizes`.
+
+    The columns are views into `height` and `data`, unless they need to
+    be converted to native types.
+
+    """
+    sizes = _column_sizes(*counts)
+    del sizes[1]
+
+    columns = []
+    start = 0
+    for size in sizes:
+        columns.append(data[start:start + size].astype(np.int32, copy=False))
+        start += size
+
+    columns.insert(1, height.astype(height.dtype.newbyteorder('='),
+                                    copy=False))
+
+    return PulseTable(shape, *columns)
+
+def save_pulses(path, pulses):
+    """Save pulses to disk.
+
+    Parameters
+    ----------
+    path : str
+        Output filename.
+    pulses : dict or PulseTable
+        Output of `decompose`.
+
+    See Also
+    --------
+    load_pulses
+
+    """
+    if not isinstance(pulses, PulseTable):
+        pulses = PulseTable.from_dict(pulses)
+
+    # Stable, so that pulses of equal area keep their order
+    if np.any(np.diff(pulses.area) < 0):
+        pulses = pulses.take(np.argsort(pulses.area, kind='mergesort'))
+
+    columns = _columns(pulses)
+    height = columns.pop(1)
+    height_type = height.dtype.newbyteorder('<')
+
+    header = np.zeros((), dtype=_HEADER)
+    header['magic'] = _MAGIC
+    header['version'] = _VERSION
+    header['height'] = height_type.str.encode()
+    header['ndim'] = len(pulses.shape)
+    header['shape'][:len(pulses.shape)] = pulses.shape
+    header['pulses'] = len(pulses)
+    header['rowptr'] = len(pulses.rowptr)
+    header['colptr'] = len(pulses.colptr)
+    header['row_index'] = pulses.row_index is not None
+
+    with open(path, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(height.astype(height_type, copy=False).tobytes())
+        for column in columns:
+            f.write(np.asarray(column, dtype='<i4').tobytes())
+
+def load_pulses(path, mmap=True):
+    """Load pulses saved by `save_pulses`.
+
+    Parameters
+    ----------
+    path : str
+        Input filename.
+    mmap : bool
+        Whether to memory map the file.  Only the parts of the file
+        that are accessed, e.g. by reconstructing an area band, are
+        then read from disk.  The map is copy-on-write: the file is
+        never modified.
+
+    Returns
+    -------
+    pulses : PulseTable
+
+    """
+    with open(path, 'rb') as f:
+        header = np.frombuffer(f.read(_HEADER.itemsize), dtype=_HEADER)
+
+    if len(header) != 1 or header['magic'][0] != _MAGIC:
+        raise ValueError("%s is not a pulse file." % path)
+    header = header[0]
+
+    if header['version'] != _VERSION:
+        raise ValueError("Unsupported pulse file version %d." % \
+                         header['version'])
+
+    counts = (int(header['pulses']), int(header['rowptr']),
+              int(header['colptr']), bool(header['row_index']))
+    height_type = np.dtype(header['height'].decode())
+    height_size = counts[0] * height_type.itemsize
+    total = sum(_column_sizes(*counts)) - counts[0]
+
+    if mmap:
+        height = np.memmap(path, dtype=height_type, mode='c',
+                           offset=_HEADER.itemsize, shape=(counts[0],))
+        data = np.memmap(path, dtype='<i4', mode='c',
+                         offset=_HEADER.itemsize + height_size,
+                         shape=(total,))
+    else:
+        height = np.fromfile(path, dtype=height_type, count=counts[0],
+                             offset=_HEADER.itemsize)
+        data = np.fromfile(path, dtype='<i4', count=total,
+                           offset=_HEADER.itemsize + height_size)
+        if len(height) != counts[0] or len(data) != total:
+            raise ValueError("%s is truncated." % path)
+
+    shape = tuple(int(s) for s in header['shape'][:header['ndim']])
+
+    return _from_columns(shape, height, data, *counts)
@@ -0,0 +1,38 @@
+import numpy as np
+from numpy.testing import assert_equal, assert_raises, run_module_suite
+
+import lulu.area_queue as aq
+from lulu.area_queue import AreaQueue
+
+def test_order():
+    q = AreaQueue()
+    x = np.random.randint(1000, size=200)
+    for a in x:
+        aq.push(q, a)
+
+    out = []
+    while not aq.empty(q):
+        out.append(aq.pop(q))
+
+    assert_equal(out, np.unique(x))
+
+def test_monotone_push():
+    q = AreaQueue()
+    aq.push(q, 1)
+    aq.push(q, 5)
+    assert_equal(aq.pop(q), 1)
+
+    aq.push(q, 3)
+    aq.push(q, 5)
+    assert_equal(aq.peek(q), 3)
+    assert_equal(aq.pop(q), 3)
+    assert_equal(aq.pop(q), 5)
+    assert aq.empty(q)
+
+def test_empty():
+    q = AreaQueue()
+    assert_raises(IndexError, aq.pop, q)
+    assert_raises(IndexError, aq.peek, q)
+
+if __name__ == "__main__":
+    run_module_suite()
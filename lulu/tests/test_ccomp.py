@@ -1,7 +1,8 @@
 import numpy as np
-from numpy.testing import assert_array_equal, run_module_suite
+from numpy.testing import assert_array_equal, assert_equal, \
+     run_module_suite
 
-from lulu.ccomp import label
+from lulu.ccomp import label, label_runs, label3d, label_runs3d
 
 class TestConnectedComponents:
     def setup(self):
@@ -30,6 +31,44 @@ class TestConnectedComponents:
             values = x[labels == i]
             assert np.all(values == values[0])
 
+    def test_dtypes(self):
+        x = (np.random.random((20, 30)) * 5).astype(int)
+        labels = label(x)
+
+        for dtype in (np.uint8, np.uint16, np.int32, np.float32, np.float64):
+            y = x.astype(dtype)
+            assert_array_equal(label(y), labels)
+            assert_array_equal(y, x)
+
+    def test_runs(self):
+        x = np.array([[0, 0, 3, 2],
+                      [0, 1, 1, 0]])
+        labels, runs = label_runs(x)
+
+        assert_equal(labels.dtype, np.int32)
+        assert_array_equal(labels, [[0, 0, 1, 2],
+                                    [0, 3, 3, 4]])
+        assert_array_equal(runs, [[0, 0, 2, 0],
+                                  [0, 2, 3, 1],
+                                  [0, 3, 4, 2],
+                                  [1, 0, 1, 0],
+                                  [1, 1, 3, 3],
+                                  [1, 3, 4, 4]])
+
+    def test_column(self):
+        x = np.array([[0], [0], [1], [0]])
+        assert_array_equal(label(x).ravel(), [0, 0, 1, 2])
+        assert_array_equal(label(x.T).ravel(), [0, 0, 1, 2])
+
+    def test_strips(self):
+        x = (np.random.random((37, 30)) * 3).astype(int)
+        labels, runs = label_runs(x)
+
+        for threads in (2, 3, 8, 100):
+            labels_, runs_ = label_runs(x, threads=threads)
+            assert_array_equal(labels_, labels)
+            assert_array_equal(runs_, runs)
+
     def test_diag(self):
         x = np.array([[0, 0, 1],
                       [0, 1, 0],
@@ -37,5 +76,44 @@ class TestConnectedComponents:
         assert_array_equal(label(x),
                            x)
 
+    def test_3d(self):
+        # Voxels touching at a corner
+        x = np.zeros((2, 2, 2), dtype=int)
+        x[0, 0, 0] = x[1, 1, 1] = 1
+
+        assert_array_equal(label3d(x, 26).ravel(), [0, 1, 1, 1, 1, 1, 1, 0])
+        assert_array_equal(label3d(x, 18).ravel(), [0, 1, 1, 1, 1, 1, 1, 2])
+        assert_array_equal(label3d(x, 6).ravel(), [0, 1, 1, 1, 1, 1, 1, 2])
+
+        # Voxels touching along an edge
+        x = np.zeros((2, 2, 2), dtype=int)
+        x[0, 0, 0] = x[1, 1, 0] = 1
+
+        assert label3d(x, 26).max() == 1
+        assert label3d(x, 18).max() == 1
+        assert label3d(x, 6).max() == 2
+
+        # A single plane is labelled as an 8-connected image
+        y = (np.random.random((20, 30)) * 3).astype(int)
+        assert_array_equal(label3d(y[None], 26)[0], label(y))
+
+    def test_runs3d(self):
+        x = (np.random.random((4, 6, 7)) * 3).astype(int)
+
+        for connectivity in (6, 18, 26):
+            labels, runs = label_runs3d(x, connectivity)
+            assert_array_equal(labels, label3d(x, connectivity))
+
+            # Rows of the runs count through the planes
+            for row, start, end, l in runs:
+                assert_array_equal(labels.reshape((-1, 7))[row, start:end],
+                                   l)
+
+            for threads in (2, 5):
+                labels_, runs_ = label_runs3d(x, connectivity, threads,
+                                              return_labels=False)
+                assert labels_ is None
+                assert_array_equal(runs_, runs)
+
 if __name__ == "__main__":
     run_module_suite()
@@ -28,6 +28,23 @@ class TestConnectedRegion:
 
         assert crh.todense(d) == crh.todense(c)
 
+    def test_copy_large(self):
+        # Too many pointers to be stored inside the region
+        rows = 10
+        c = ConnectedRegion(shape=(rows, 3), value=1,
+                            rowptr=list(range(0, 2 * rows + 1, 2)),
+                            colptr=[0, 1] * rows)
+        d = crh.copy(c)
+        assert_equal(crh.get_rowptr(d), crh.get_rowptr(c))
+        assert_equal(crh.get_colptr(d), crh.get_colptr(c))
+        assert_equal(crh.get_shape(d), (rows, 3))
+        assert_equal(crh.nnz(d), rows)
+
+        crh.merge(d, ConnectedRegion(shape=(rows, 3), value=1,
+                                     rowptr=[0, 2], colptr=[1, 3]))
+        assert_equal(crh.nnz(d), rows + 2)
+        assert_equal(crh.get_colptr(c), [0, 1] * rows)
+
     def test_reshape(self):
         d = crh.copy(self.c)
         crh.reshape(d, (4, 5))
@@ -89,6 +106,43 @@ class TestConnectedRegion:
         assert_array_equal(iarr.to_list(x),
                            [-1, 0, 1, -1, 1, 2, -1, 0, 2, 0, 1, 2])
 
+    def test_outside_boundary_runs(self):
+        b = crh.outside_boundary_runs(self.c)
+        y, x = crh.outside_boundary(self.c)
+
+        assert_equal(crh.get_start_row(b), 0)
+        assert_equal(crh.get_rowptr(b), [0, 2, 8, 12, 16, 18])
+        assert_equal(crh.get_colptr(b), [1, 6, -1, 2, 3, 4, 5, 6, -1, 0,
+                                         3, 6, -1, 2, 5, 6, 1, 6])
+        assert_equal(crh.nnz(b), len(iarr.to_list(x)))
+
+    def test_merge_cached_boundary(self):
+        a = ConnectedRegion(shape=(4, 4), value=1,
+                            start_row=1,
+                            rowptr=[0, 4, 8, 10],
+                            colptr=[0, 1, 2, 3, 0, 1, 2, 3, 0, 3])
+        b = ConnectedRegion(shape=(4, 4), value=1,
+                            rowptr=[0, 2, 6, 10],
+                            colptr=[1, 4, 1, 2, 3, 4, 1, 2, 3, 4])
+        c = ConnectedRegion(shape=(4, 4), value=1,
+                            start_row=3,
+                            rowptr=[0, 2],
+                            colptr=[3, 4])
+
+        caches = [[], [], []]
+        for cr, cache in zip((a, b, c), caches):
+            crh.outside_boundary_runs(cr, cache)
+
+        crh.merge(a, b)
+        crh.merge(a, c)
+
+        cached = crh.outside_boundary_runs(a, sum(caches, []))
+        fresh = crh.outside_boundary_runs(crh.copy(a))
+
+        assert_equal(crh.get_start_row(cached), crh.get_start_row(fresh))
+        assert_equal(crh.get_rowptr(cached), crh.get_rowptr(fresh))
+        assert_equal(crh.get_colptr(cached), crh.get_colptr(fresh))
+
     def test_boundary_single(self):
         c = ConnectedRegion(shape=(1,1), value=1, rowptr=[0, 2], colptr=[0, 1])
         y, x = crh.outside_boundary(c)
@@ -194,6 +248,25 @@ class TestConnectedRegion:
                             [1, 1, 1, 1],
                             [1, 1, 1, 0]])
 
+    def test_merge_many(self):
+        a = ConnectedRegion(shape=(3, 3), value=1, start_row=1,
+                            rowptr=[0, 2], colptr=[1, 2])
+        parts = [ConnectedRegion(shape=(3, 3), value=1,
+                                 rowptr=[0, 2, 2, 4], colptr=[0, 3, 0, 3]),
+                 ConnectedRegion(shape=(3, 3), value=1, start_row=1,
+                                 rowptr=[0, 2], colptr=[0, 1]),
+                 ConnectedRegion(shape=(3, 3), value=1, start_row=1,
+                                 rowptr=[0, 2], colptr=[2, 3])]
+
+        crh.merge_many(a, parts)
+        assert_array_equal(crh.todense(a), np.ones((3, 3)))
+        assert_equal(crh.get_rowptr(a), [0, 2, 4, 6])
+        assert_equal(crh.nnz(a), 9)
+
+        b = crh.copy(a)
+        crh.merge_many(b, [])
+        assert_equal(crh.get_colptr(b), crh.get_colptr(a))
+
     def test_set_array(self):
         x = np.zeros((5, 5), dtype=int)
         crh.set_array(x, self.c, 5)
@@ -205,6 +278,35 @@ class TestConnectedRegion:
         crh.set_array(x, self.c, 5, 'add')
         assert_array_equal(x, self.dense * 5 * 2)
 
+    def test_paint(self):
+        a = ConnectedRegion(shape=(2, 3), value=3,
+                            rowptr=[0, 2, 4], colptr=[0, 2, 1, 3])
+        b = ConnectedRegion(shape=(2, 3), value=-1, start_row=1,
+                            rowptr=[0, 2], colptr=[0, 2])
+
+        x = np.zeros((2, 3), dtype=int)
+        crh.paint(x, [a, b])
+        assert_array_equal(x, [[3, 3, 0], [-1, -1, 3]])
+
+        x = np.zeros((2, 3), dtype=np.float32)
+        crh.paint(x, [a, b], [0.5, 2], mode='add')
+        assert_array_equal(x, [[0.5, 0.5, 0], [2, 2.5, 0.5]])
+
+        x = np.zeros((2, 3), dtype=np.int32)
+        crh.paint(x, [a, b], mode='max')
+        assert_array_equal(x, [[3, 3, 0], [0, 3, 3]])
+
+        x = np.zeros((2, 3), dtype=np.uint8)
+        crh.paint(x, (a, b, a), mode='count')
+        assert_array_equal(x, [[2, 2, 0], [1, 3, 2]])
+
+        # Regions are clipped to the array
+        x = np.zeros((1, 1), dtype=int)
+        crh.paint(x, [a, b], 7)
+        assert_array_equal(x, [[7]])
+
+        assert_raises(ValueError, crh.paint, x, [a], mode='min')
+
     def test_bounding_box(self):
         assert_equal(crh.bounding_box(self.c),
                      (1, 0, 3, 4))
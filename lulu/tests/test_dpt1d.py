@@ -0,0 +1,64 @@
+import numpy as np
+from numpy.testing import assert_array_equal, assert_array_almost_equal, \
+                          assert_equal, assert_raises, run_module_suite
+
+import lulu
+
+class TestDPT1D:
+    def test_basic(self):
+        x = np.array([3, 3, 1, 5, 5, 2, 2, 2])
+        start, length, height = lulu.decompose1d(x)
+
+        assert_array_equal(length, np.sort(length))
+        assert_array_equal(lulu.reconstruct1d((start, length, height),
+                                              len(x)), x)
+        assert_equal(length[-1], len(x))
+
+    def test_match_2d(self):
+        x = np.random.randint(20, size=60)
+
+        for operator in ('LU', 'UL'):
+            start, length, height = lulu.decompose1d(x, operator=operator)
+            pulses = lulu.decompose(x.reshape((1, -1)), output='table',
+                                    operator=operator)
+            rows, cols = pulses.anchors()
+
+            # The 1-D transform always ends in a whole-signal pulse, even
+            # if its height is zero
+            keep = height != 0
+            assert_equal(sorted(zip(length[keep], height[keep], start[keep])),
+                         sorted(zip(pulses.area, pulses.height, cols)))
+
+    def test_dtypes(self):
+        x = np.random.random(200) * 10
+
+        for dtype in (np.uint8, np.int16, np.int64, np.float32, np.float64):
+            signal = x.astype(dtype)
+            pulses = lulu.decompose1d(signal)
+            y = lulu.reconstruct1d(pulses, len(signal))
+
+            assert_equal(y.dtype.kind, signal.dtype.kind if
+                         signal.dtype.kind != 'u' else 'i')
+            assert_array_almost_equal(y, signal, decimal=4)
+
+        assert_raises(ValueError, lulu.decompose1d, np.zeros((2, 2)))
+
+    def test_extreme(self):
+        # Heights of integer signals are int64, and do not overflow
+        x = np.array([-2e9, 2e9, -2e9], 'int32')
+        pulses = lulu.decompose1d(x)
+
+        assert_equal(pulses[2].dtype, np.int64)
+        assert_array_equal(lulu.reconstruct1d(pulses, len(x)), x)
+
+    def test_selection(self):
+        x = np.random.randint(255, size=100)
+        pulses = lulu.decompose1d(x)
+        start, length, height = pulses
+
+        small = lulu.reconstruct1d(pulses, len(x), max_area=5)
+        large = lulu.reconstruct1d(pulses, len(x), min_area=6)
+        assert_array_equal(small + large, x)
+
+if __name__ == "__main__":
+    run_module_suite()
@@ -41,5 +41,35 @@ def test_min():
     assert iarr.min(x) == -2
     assert iarr.max(x) == 12
 
+def test_pool():
+    assert iarr.pool_size() == 0
+
+    # Buffers are only cached while the pool is held
+    x = IntArray()
+    iarr.from_list(x, list(range(100)))
+    del x
+    assert iarr.pool_size() == 0
+
+    iarr.acquire_pool()
+    x = IntArray()
+    iarr.from_list(x, list(range(100)))
+    del x
+    cached = iarr.pool_size()
+    assert cached > 0
+
+    # Buffers are reused, and their contents replaced
+    y = IntArray()
+    iarr.from_list(y, list(range(50, 150)))
+    assert iarr.to_list(y) == list(range(50, 150))
+    assert iarr.pool_size() < cached
+
+    # Cached buffers are freed once the last hold is released
+    iarr.acquire_pool()
+    del y
+    iarr.release_pool()
+    assert iarr.pool_size() > 0
+    iarr.release_pool()
+    assert iarr.pool_size() == 0
+
 if __name__ == "__main__":
     run_module_suite()
@@ -59,5 +59,446 @@ class TestReconstruction:
         assert_equal(np.sum(img_ != img) / float(np.prod(img.shape)) * 100,
                      0, "Percentage mismatch =")
 
+    def test_engines(self):
+        img = np.random.randint(255, size=(50, 60))
+
+        pulses = lulu.decompose(img, quiet=True, engine='pixel')
+
+        for engine in ('rag', 'nogil'):
+            other = lulu.decompose(img, quiet=True, engine=engine)
+
+            assert_equal(sorted(pulses.keys()), sorted(other.keys()))
+            for area in pulses:
+                assert_equal(sorted(crh.get_value(cr) for cr in pulses[area]),
+                             sorted(crh.get_value(cr) for cr in other[area]))
+
+            img_, areas, area_count = lulu.reconstruct(other, img.shape)
+            assert_array_equal(img_, img)
+
+        assert_raises(ValueError, lulu.decompose, img, engine='unknown')
+
+    def test_default_engine(self):
+        # Dictionaries come from the 'pixel' engine by default
+        img = np.random.randint(255, size=(20, 30))
+
+        ref = lulu.decompose(img, quiet=True, engine='pixel')
+        pulses = lulu.decompose(img, quiet=True)
+        assert_equal(sorted(ref.keys()), sorted(pulses.keys()))
+        for area in ref:
+            assert_equal(sorted(crh.todense(cr).shape for cr in pulses[area]),
+                         sorted(crh.todense(cr).shape for cr in ref[area]))
+
+    def test_boundary_cache(self):
+        img = np.random.randint(255, size=(40, 50))
+        ref = lulu.decompose(img, quiet=True, output='table')
+
+        for limit in (0, 2000, 64 * 1024 * 1024):
+            cache = lulu.BoundaryCache(limit)
+            pulses = lulu.decompose(img, quiet=True, engine='pixel',
+                                    output='table', boundary_cache=cache)
+            assert_equal(sorted(zip(pulses.area, pulses.height)),
+                         sorted(zip(ref.area, ref.height)))
+            assert cache.peak <= limit
+            assert_equal(cache.limit, limit)
+
+        assert cache.peak > 0
+
+        # Only the 'pixel' engine caches boundaries
+        cache = lulu.BoundaryCache()
+        lulu.decompose(img, quiet=True, engine='rag', boundary_cache=cache)
+        assert_equal(cache.peak, 0)
+
+    def test_engines_pulse_count(self):
+        # Small value ranges often leave a whole-image pulse of height zero
+        np.random.seed(0)
+        for shape in ((6, 7), (1, 20), (15, 12)):
+            img = np.random.randint(-3, 4, shape)
+            counts = [len(lulu.decompose(img, quiet=True, engine=engine,
+                                         output='table'))
+                      for engine in ('pixel', 'rag', 'nogil')]
+            assert_equal(counts, [counts[0]] * 3)
+
+    def test_threads(self):
+        import threading
+
+        images = [np.random.randint(255, size=(40, 50)) for i in range(4)]
+        results = [None] * len(images)
+
+        def work(i):
+            results[i] = lulu.decompose(images[i], output='table')
+
+        threads = [threading.Thread(target=work, args=(i,))
+                   for i in range(len(images))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        for img, pulses in zip(images, results):
+            img_, areas, area_count = lulu.reconstruct(pulses, img.shape)
+            assert_array_equal(img_, img)
+
+        # Labelling in strips gives the same pulses
+        pulses = lulu.decompose(images[0], output='table', threads=3)
+        assert_array_equal(pulses.area, results[0].area)
+        assert_array_equal(pulses.colptr, results[0].colptr)
+
+    def test_pool(self):
+        import lulu.int_array as iarr
+
+        images = [np.random.randint(255, size=(30, 40)) for i in range(2)]
+        refs = [lulu.decompose(img, quiet=True, output='table')
+                for img in images]
+
+        # Interleaved decompositions share the pool; it is emptied once
+        # both are done, or abandoned
+        a = lulu.iter_decompose(images[0])
+        b = lulu.iter_decompose(images[1])
+        next(b)
+        pulses = dict(a)
+        assert iarr.pool_size() > 0
+        del b
+        assert_equal(iarr.pool_size(), 0)
+
+        img_, areas, area_count = lulu.reconstruct(pulses, images[0].shape)
+        assert_array_equal(img_, images[0])
+        assert_array_equal(areas, np.unique(refs[0].area))
+
+    def test_selection(self):
+        img = np.random.randint(255, size=(40, 50))
+
+        pulses = lulu.decompose(img, quiet=True)
+        table = lulu.decompose(img, quiet=True, output='table')
+
+        ref = np.zeros(img.shape, dtype=int)
+        count = {}
+        for area in pulses:
+            if not 3 <= area <= 20:
+                continue
+            for cr in pulses[area]:
+                if crh.get_value(cr) >= 0:
+                    crh.set_array(ref, cr, crh.get_value(cr), 'add')
+                    count[area] = count.get(area, 0) + 1
+
+        for p in (pulses, table):
+            img_, areas, area_count = lulu.reconstruct(p, img.shape,
+                                                       min_area=3,
+                                                       max_area=20,
+                                                       min_height=0)
+            assert_array_equal(img_, ref)
+            assert_array_equal(areas, sorted(count))
+            assert_array_equal(area_count, [count[a] for a in sorted(count)])
+
+        out = np.ones(img.shape, dtype=np.float32)
+        img_, areas, area_count = lulu.reconstruct(table, img.shape, out=out)
+        assert img_ is out
+        assert_array_equal(out, img)
+
+        img_, areas, area_count = lulu.reconstruct(table, img.shape,
+                                                   dtype=np.uint8)
+        assert_equal(img_.dtype, np.uint8)
+        assert_array_equal(img_, img)
+
+    def test_cache(self):
+        img = np.random.randint(-50, 50, size=(40, 50))
+        pulses = lulu.decompose(img, quiet=True)
+
+        bands = [(3, 20, None, None), (5, 30, None, None),
+                 (1, 2, None, None), (100, 2000, None, None),
+                 (0, 2000, None, None), (5, 30, 0, None),
+                 (10, 40, -10, 10), (2, 40, None, None),
+                 (None, None, None, None)]
+
+        for checkpoints in (None, [2, 10, 50]):
+            cache = lulu.ReconstructionCache(pulses, img.shape,
+                                             checkpoints=checkpoints)
+            for a0, a1, h0, h1 in bands:
+                ref, areas, area_count = \
+                     lulu.reconstruct(pulses, img.shape,
+                                      -1 if a0 is None else a0,
+                                      -1 if a1 is None else a1,
+                                      min_height=h0, max_height=h1)
+                assert_array_equal(cache.update(a0, a1, h0, h1), ref)
+
+        assert_array_equal(cache.image, img)
+
+    def test_feature_maps(self):
+        img = np.random.randint(-50, 50, size=(30, 40))
+        pulses = lulu.decompose(img, quiet=True)
+
+        count = np.zeros(img.shape, dtype=int)
+        strength = np.zeros(img.shape, dtype=int)
+        peak = np.zeros(img.shape, dtype=int)
+        scale = np.zeros(img.shape, dtype=int)
+        for area in sorted(pulses):
+            if not 2 <= area <= 50:
+                continue
+            for cr in pulses[area]:
+                mask = np.zeros(img.shape, dtype=int)
+                crh.set_array(mask, cr, 1)
+                mask = mask != 0
+                height = abs(crh.get_value(cr))
+                count[mask] += 1
+                strength[mask] += height
+                stronger = mask & (height > peak)
+                peak[stronger] = height
+                scale[stronger] = area
+
+        maps = lulu.feature_maps(pulses, img.shape, area_range=(2, 50),
+                                 maps=['count', 'strength', 'scale', 'peak'])
+        assert_array_equal(maps['count'], count)
+        assert_array_equal(maps['strength'], strength)
+        assert_array_equal(maps['scale'], scale)
+        assert_array_equal(maps['peak'], peak)
+
+        table = lulu.decompose(img, quiet=True, output='table')
+        maps = lulu.feature_maps(table, maps=['count'])
+        assert_equal(sorted(maps), ['count'])
+        assert_equal(maps['count'].sum(), table.area.sum())
+
+        assert_raises(ValueError, lulu.feature_maps, table, maps=['area'])
+
+    def test_iter_decompose(self):
+        img = np.random.randint(255, size=(30, 40))
+
+        pulses = lulu.decompose(img, quiet=True)
+        streamed = list(lulu.iter_decompose(img))
+
+        areas = [area for area, level in streamed]
+        assert_equal(areas, sorted(pulses))
+        for area, level in streamed:
+            assert_equal(sorted(crh.get_value(cr) for cr in level),
+                         sorted(crh.get_value(cr) for cr in pulses[area]))
+
+        keep = lambda area, height: area <= 10 and height > 0
+        for area, level in lulu.iter_decompose(img, keep=keep):
+            assert area <= 10
+            assert len(level) > 0
+            assert all(crh.get_value(cr) > 0 for cr in level)
+
+    def test_max_area(self):
+        img = np.random.randint(255, size=(30, 40))
+
+        pulses = lulu.decompose(img, quiet=True)
+        partial, residual = lulu.decompose(img, quiet=True, max_area=20,
+                                           return_residual=True)
+
+        assert_equal(sorted(partial), [a for a in sorted(pulses) if a <= 20])
+
+        img_, areas, area_count = lulu.reconstruct(partial, img.shape)
+        assert_array_equal(img_ + residual, img)
+
+        smooth, areas, area_count = lulu.reconstruct(pulses, img.shape,
+                                                     min_area=21)
+        assert_array_equal(residual, smooth)
+
+    def test_stats(self):
+        img = np.random.randint(-50, 50, size=(30, 40))
+
+        pulses = lulu.decompose(img, quiet=True, output='table')
+        area, height = pulses.area, pulses.height
+        areas = np.unique(area)
+
+        for engine in ('nogil', 'pixel', 'rag'):
+            stats = lulu.PulseStats()
+            lulu.decompose(img, quiet=True, engine=engine, stats=stats)
+
+            assert_array_equal(stats.area, areas)
+            assert_array_equal(stats.count, np.bincount(area)[areas])
+            assert_array_equal(stats.positive,
+                               np.bincount(area[height > 0],
+                                           minlength=area.max() + 1)[areas])
+            assert_array_equal(stats.positive + stats.negative,
+                               np.bincount(area[height != 0],
+                                           minlength=area.max() + 1)[areas])
+            assert_array_equal(stats.volume,
+                               np.bincount(area, area * np.abs(height))[areas])
+            assert_array_equal(stats.min_height,
+                               [height[area == a].min() for a in areas])
+            assert_array_equal(stats.max_height,
+                               [height[area == a].max() for a in areas])
+
+        # Pulses that are not kept are counted, and statistics add up
+        stats = lulu.PulseStats()
+        for i in range(2):
+            for level in lulu.iter_decompose(img, keep=lambda a, h: False,
+                                             stats=stats):
+                pass
+
+        assert_array_equal(stats.area, areas)
+        assert_array_equal(stats.count, 2 * np.bincount(area)[areas])
+
+class TestDtypes:
+    def test_integer(self):
+        # Values outside [0, 255], including negative ones
+        img = np.random.randint(-1000, 3000, size=(30, 40))
+        ref = lulu.decompose(img, quiet=True, engine='pixel')
+
+        for dtype in (np.int16, np.int32, np.int64):
+            pulses, residual = lulu.decompose(img.astype(dtype),
+                                              return_residual=True)
+            assert_equal(sorted(pulses), sorted(ref))
+            assert not residual.any()
+
+            img_, areas, area_count = lulu.reconstruct(pulses, img.shape)
+            assert_array_equal(img_, img)
+
+    def test_unsigned(self):
+        for dtype, high in ((np.uint8, 256), (np.uint16, 65536)):
+            img = np.random.randint(high, size=(30, 40)).astype(dtype)
+            pulses, residual = lulu.decompose(img, output='table',
+                                              return_residual=True)
+            assert_equal(residual.dtype, dtype)
+            assert_equal(pulses.height.dtype, np.int64)
+
+            img_, areas, area_count = lulu.reconstruct(pulses, img.shape)
+            assert_array_equal(img_, img)
+
+    def test_paint(self):
+        # Heights are painted exactly, including negative ones into
+        # unsigned images
+        img = np.full((20, 30), 255, dtype=np.uint8)
+        img[5:10, 5:10] = 0
+        img[12:15, 20:25] = 252
+
+        pulses = lulu.decompose(img, output='table')
+        assert_array_equal(sorted(pulses.height), [-255, -3, 255])
+
+        # Partial sums leave the range of the image, and wrap around
+        img_, areas, area_count = lulu.reconstruct(pulses, img.shape,
+                                                   dtype=np.uint8)
+        assert_array_equal(img_, img)
+
+        img = np.array([[2 ** 53 + 1, 2 ** 53, 2 ** 53 + 1]])
+        pulses = lulu.decompose(img, output='table')
+        img_, areas, area_count = lulu.reconstruct(pulses, img.shape,
+                                                   dtype=np.int64)
+        assert_array_equal(img_, img)
+
+    def test_float(self):
+        img = np.random.random((30, 40)).astype(np.float32)
+        pulses = lulu.decompose(img, output='table')
+        assert_equal(pulses.height.dtype, np.float64)
+
+        img_, areas, area_count = lulu.reconstruct(pulses, img.shape)
+        assert_array_almost_equal(img_, img)
+
+        assert_raises(ValueError, lulu.decompose, img)
+        assert_raises(ValueError, lulu.decompose, img, output='table',
+                      engine='pixel')
+
+    def test_extreme(self):
+        # Heights are exact, even if they do not fit in the image type
+        for values, dtype, heights in \
+                (([-2000000000, 2000000000, -2000000000], np.int32,
+                  [-4000000000, -4000000000, 2000000000]),
+                 ([2 ** 53 + 1, 2 ** 53, 2 ** 53 + 1], np.int64,
+                  [-1, 2 ** 53 + 1])):
+            img = np.array([values], dtype=dtype)
+            pulses = lulu.decompose(img, output='table')
+            assert_equal(pulses.height.dtype, np.int64)
+            assert_equal(pulses.height.tolist(), heights)
+
+            pulses, residual = lulu.decompose(img, output='table',
+                                              max_area=1,
+                                              return_residual=True)
+            assert_equal(residual.dtype, dtype)
+            assert_array_equal(residual, [[heights[-1]] * 3])
+
+    def test_final_pulse(self):
+        # The region covering the whole image is a single pulse
+        img = np.full((3, 4), 7)
+        pulses = lulu.decompose(img, output='table')
+        assert_array_equal(pulses.area, [12])
+        assert_array_equal(pulses.height, [7])
+
+    def test_levels(self):
+        # The level engine finds the same pulses as the generic one
+        from lulu.kernel import decompose
+
+        def pulse_set(pulses, shape):
+            out = []
+            for i in range(len(pulses.area)):
+                img = np.zeros(shape, dtype=np.int64)
+                pulses.paint(img, np.array([i]))
+                out.append((pulses.area[i], pulses.height[i],
+                            tuple(np.flatnonzero(img))))
+            return sorted(out)
+
+        for img in (np.random.randint(256, size=(20, 30)).astype(np.uint8),
+                    np.random.randint(-8, 8, size=(25, 20)),
+                    np.random.randint(4, size=(4, 6, 7)).astype(np.uint16)):
+            for order in (True, False):
+                for max_area in (-1, 5):
+                    ref, ref_residual = decompose(img, order, max_area,
+                                                  levels=False)
+                    pulses, residual = decompose(img, order, max_area,
+                                                 levels=True)
+
+                    assert_equal(pulse_set(pulses, img.shape),
+                                 pulse_set(ref, img.shape))
+                    assert_array_equal(residual, ref_residual)
+
+class TestVolume:
+    vol = np.random.randint(5, size=(6, 7, 8))
+
+    def test_reconstruct(self):
+        for connectivity in (6, 18, 26):
+            pulses = lulu.decompose(self.vol, output='table',
+                                    connectivity=connectivity)
+            assert_equal(pulses.shape, self.vol.shape)
+
+            img_, areas, area_count = lulu.reconstruct(pulses,
+                                                       self.vol.shape)
+            assert_array_equal(img_, self.vol)
+
+    def test_symmetry(self):
+        # The transform does not depend on the order of the axes
+        for connectivity in (6, 26):
+            ref = lulu.decompose(self.vol, output='table',
+                                 connectivity=connectivity)
+
+            vol = np.ascontiguousarray(self.vol.transpose((2, 0, 1)))
+            pulses = lulu.decompose(vol, output='table',
+                                    connectivity=connectivity)
+
+            assert_equal(sorted(zip(pulses.area, pulses.height)),
+                         sorted(zip(ref.area, ref.height)))
+
+    def test_column(self):
+        # Only the rows a pulse crosses are stored
+        vol = np.zeros((10, 5, 5), dtype=int)
+        vol[:, 2, 2] = 1
+
+        pulses = lulu.decompose(vol, output='table', connectivity=6)
+        i = np.flatnonzero(pulses.area == 10)[0]
+        rows = pulses.row_index[pulses.offsets[i]:pulses.offsets[i + 1]]
+        assert_array_equal(rows, list(range(2, 50, 5)) + [48])
+
+        img_, areas, area_count = lulu.reconstruct(pulses, vol.shape)
+        assert_array_equal(img_, vol)
+
+        # Through a dictionary, which stores the rows in between
+        region = pulses.to_dict()[10][0]
+        assert_array_equal(crh.todense(region), vol.reshape((50, 5)))
+
+        part = pulses.take([i])
+        out = np.zeros(vol.shape, dtype=int)
+        part.paint(out)
+        assert_array_equal(out, vol)
+
+    def test_single_plane(self):
+        img = np.random.randint(255, size=(20, 30))
+
+        ref = lulu.decompose(img, output='table')
+        pulses = lulu.decompose(img[None], output='table')
+
+        for name in ('area', 'height', 'start_row', 'rowptr', 'colptr'):
+            assert_array_equal(getattr(pulses, name), getattr(ref, name))
+
+        assert_raises(ValueError, lulu.decompose, img[None])
+        assert_raises(ValueError, lulu.decompose, img[None],
+                      output='table', engine='pixel')
+
 if __name__ == "__main__":
     run_module_suite()
@@ -0,0 +1,72 @@
+import numpy as np
+from numpy.testing import assert_array_equal, assert_equal, run_module_suite
+
+import lulu
+import lulu.connected_region_handler as crh
+
+def _pulse_set(table):
+    pulses = table.to_dict()
+    return sorted((area, crh.get_value(cr), crh.get_start_row(cr),
+                   tuple(crh.get_rowptr(cr)), tuple(crh.get_colptr(cr)))
+                  for area in pulses for cr in pulses[area])
+
+class TestDecomposeTiled:
+    img = np.random.randint(255, size=(45, 50))
+
+    def test_tiled(self):
+        for max_area, workers in [(3, 1), (10, 1), (10, 2)]:
+            ref, ref_residual = lulu.decompose(self.img, quiet=True,
+                                               output='table',
+                                               max_area=max_area,
+                                               return_residual=True)
+            pulses, residual = lulu.decompose_tiled(self.img, max_area,
+                                                    tile_shape=(16, 20),
+                                                    workers=workers)
+
+            assert_array_equal(residual, ref_residual)
+            assert_equal(_pulse_set(pulses), _pulse_set(ref))
+            assert_array_equal(pulses.area, np.sort(pulses.area))
+
+class TestDecomposeMany:
+    images = [np.random.randint(255, size=(20 + i, 25)) for i in range(5)]
+
+    def test_many(self):
+        for ordered in (True, False):
+            results = list(lulu.decompose_many(self.images, workers=2,
+                                               ordered=ordered))
+
+            if ordered:
+                assert_equal([i for i, p in results], list(range(5)))
+            assert_equal(sorted(i for i, p in results), list(range(5)))
+
+            for i, pulses in results:
+                ref = lulu.decompose(self.images[i], quiet=True,
+                                     output='table')
+                assert_equal(pulses.shape, self.images[i].shape)
+                assert_equal(_pulse_set(pulses), _pulse_set(ref))
+
+    def test_float(self):
+        images = [img / 7. for img in self.images[:3]]
+
+        for i, pulses in lulu.decompose_many(images, workers=2):
+            ref = lulu.decompose(images[i], quiet=True, output='table')
+            assert_equal(pulses.height.dtype, ref.height.dtype)
+            for name in ('area', 'height', 'start_row', 'offsets',
+                         'rowptr', 'colptr'):
+                assert_array_equal(getattr(pulses, name), getattr(ref, name))
+
+    def test_close(self):
+        import os
+        if not os.path.isdir('/dev/shm'):
+            return
+
+        # Results that are not collected are freed as well
+        results = lulu.decompose_many(self.images, workers=2)
+        next(results)
+        results.close()
+
+        assert_equal([f for f in os.listdir('/dev/shm')
+                      if f.startswith('lulu_')], [])
+
+if __name__ == "__main__":
+    run_module_suite()
@@ -0,0 +1,122 @@
+import os
+import tempfile
+
+import numpy as np
+from numpy.testing import assert_array_equal, assert_array_almost_equal, \
+     assert_equal, run_module_suite
+
+import lulu
+import lulu.connected_region_handler as crh
+from lulu import PulseTable
+
+def _pulse_set(pulses):
+    return sorted((area, crh.get_value(cr), crh.get_start_row(cr),
+                   tuple(crh.get_rowptr(cr)), tuple(crh.get_colptr(cr)))
+                  for area in pulses for cr in pulses[area])
+
+class TestPulseTable:
+    img = np.random.randint(255, size=(30, 40))
+    pulses = lulu.decompose(img, quiet=True)
+
+    def test_decompose(self):
+        table = lulu.decompose(self.img, quiet=True, output='table')
+
+        assert isinstance(table, PulseTable)
+        assert_equal(table.shape, self.img.shape)
+        assert_equal(len(table), sum(len(p) for p in self.pulses.values()))
+        assert_equal(_pulse_set(table.to_dict()), _pulse_set(self.pulses))
+
+    def test_roundtrip(self):
+        table = PulseTable.from_dict(self.pulses)
+
+        assert_equal(table.shape, self.img.shape)
+        assert_equal(len(table.offsets), len(table) + 1)
+        assert_equal(table.rowptr[-1], len(table.colptr))
+        assert_equal(_pulse_set(table.to_dict()), _pulse_set(self.pulses))
+
+    def test_region(self):
+        table = PulseTable.from_dict(self.pulses)
+        i = np.argmax(table.area)
+        cr = table.region(i)
+
+        assert_equal(crh.nnz(cr), table.area[i])
+        assert_equal(crh.get_value(cr), table.height[i])
+        assert_array_equal(crh.todense(cr) != 0, table.height[i] != 0)
+
+    def test_empty(self):
+        table = PulseTable.from_dict({}, shape=(3, 3))
+        assert_equal(len(table), 0)
+        assert_equal(table.to_dict(), {})
+
+    def test_take_concatenate(self):
+        table = PulseTable.from_dict(self.pulses)
+        index = np.arange(len(table))[::-1]
+
+        assert_equal(_pulse_set(table.take(index).to_dict()),
+                     _pulse_set(self.pulses))
+
+        half = len(table) // 2
+        joined = PulseTable.concatenate([table.take(index[:half]),
+                                         table.take(index[half:])])
+        assert_equal(joined.shape, table.shape)
+        assert_equal(_pulse_set(joined.to_dict()), _pulse_set(self.pulses))
+
+        rows, cols = table.anchors()
+        i = np.argmax(table.area)
+        first = np.argmax(crh.todense(table.region(i)).ravel() != 0)
+        assert_equal((rows[i], cols[i]), divmod(first, table.shape[1]))
+
+    def test_save_load(self):
+        table = PulseTable.from_dict(self.pulses)
+
+        fd, path = tempfile.mkstemp(suffix='.pulses')
+        os.close(fd)
+        try:
+            lulu.save_pulses(path, self.pulses)
+
+            for mmap in (True, False):
+                loaded = lulu.load_pulses(path, mmap=mmap)
+
+                assert_equal(loaded.shape, table.shape)
+                for name in ('area', 'height', 'start_row', 'offsets',
+                             'rowptr', 'colptr'):
+                    assert_array_equal(getattr(loaded, name),
+                                       getattr(table, name))
+
+                img, areas, area_count = lulu.reconstruct(loaded,
+                                                          loaded.shape)
+                assert_array_equal(img, self.img)
+        finally:
+            os.remove(path)
+
+    def test_save_load_types(self):
+        # Heights keep their type, volumes their row_index, and pulses
+        # are saved in order of increasing area
+        images = (np.array([[2 ** 53 + 1, 2 ** 53, 2 ** 53 + 1]]),
+                  np.random.random((20, 30)),
+                  np.random.randint(5, size=(4, 6, 7)))
+
+        fd, path = tempfile.mkstemp(suffix='.pulses')
+        os.close(fd)
+        try:
+            for image in images:
+                table = lulu.decompose(image, output='table')
+                reverse = table.take(np.arange(len(table))[::-1])
+                lulu.save_pulses(path, reverse)
+
+                for mmap in (True, False):
+                    loaded = lulu.load_pulses(path, mmap=mmap)
+
+                    assert_equal(loaded.shape, image.shape)
+                    assert_equal(loaded.height.dtype, table.height.dtype)
+                    assert np.all(np.diff(loaded.area) >= 0)
+                    assert_equal(loaded.row_index is None, image.ndim == 2)
+
+                    img, areas, area_count = lulu.reconstruct(loaded,
+                                                              loaded.shape)
+                    assert_array_almost_equal(img, image)
+        finally:
+            os.remove(path)
+
+if __name__ == "__main__":
+    run_module_suite()
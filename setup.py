@@ -25,9 +25,13 @@ setup(name='lulu',
 
       cmdclass={'build_ext': build_ext},
       ext_modules=[cext('int_array'),
+                   cext('area_queue'),
                    cext('connected_region'),
                    cext('connected_region_handler'),
+                   cext('pulse_table'),
                    cext('ccomp'),
+                   cext('kernel'),
+                   cext('dpt1d'),
                    cext('base')],
 
       package_data={'': ['*.txt', '*.png', '*.jpg']},